@@ -0,0 +1,6 @@
+"""
+Synthetic Munin fixtures and end-to-end benchmarks for munin-influxdb
+
+Run from the repository root:
+    $ python -m benchmark.run --hosts 20 --plugins 10
+"""
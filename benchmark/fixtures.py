@@ -0,0 +1,184 @@
+from __future__ import print_function
+import os
+import errno
+import random
+import struct
+import subprocess
+
+from munininfluxdb.settings import Settings, Defaults
+
+
+# (pdp_per_row, nb_rows) of a default Munin RRD: 2 days/5min, 9 days/30min, 45 days/2h, 450 days/1d
+MUNIN_RRAS = [(1, 576), (6, 432), (24, 540), (288, 450)]
+
+FIELD_TYPES = ["GAUGE", "DERIVE", "COUNTER", "GAUGE"]
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def write_rrd_xml(filename, last_update, step=300, rras=MUNIN_RRAS):
+    """
+    Writes a file following the layout of "rrdtool dump" output for a single datasource RRD
+    """
+    with open(filename, "w") as f:
+        f.write("<?xml version=\"1.0\" encoding=\"utf-8\"?>\n<rrd>\n")
+        f.write("\t<version>0003</version>\n\t<step>{0}</step>\n\t<lastupdate>{1}</lastupdate>\n".format(step, last_update))
+        f.write("\t<ds>\n\t\t<name> 42 </name>\n\t\t<type> GAUGE </type>\n\t</ds>\n")
+
+        for cf in ("AVERAGE", "MIN", "MAX"):
+            for pdp_per_row, nb_rows in rras:
+                entry_delta = pdp_per_row*step
+                entry_date = last_update - last_update % entry_delta - (nb_rows-1)*entry_delta
+
+                f.write("\t<rra>\n\t\t<cf>{0}</cf>\n\t\t<pdp_per_row>{1}</pdp_per_row>\n\t\t<database>\n".format(cf, pdp_per_row))
+                for i in range(nb_rows):
+                    value = "NaN" if random.random() < 0.02 else "{0:.10e}".format(random.random()*1000)
+                    f.write("\t\t\t<!-- {0} --> <row><v>{1}</v></row>\n".format(entry_date, value))
+                    entry_date += entry_delta
+                f.write("\t\t</database>\n\t</rra>\n")
+
+        f.write("</rrd>\n")
+
+
+def _storable_item(data):
+    """
+    Minimal Perl Storable (network order) serializer, enough for Munin state files
+    """
+    if isinstance(data, dict):
+        body = struct.pack(">I", len(data))
+        for key, value in data.items():
+            body += _storable_item(value) + struct.pack(">I", len(key)) + key
+        return "\x04\x03" + body
+    elif isinstance(data, (list, tuple)):
+        return "\x04\x02" + struct.pack(">I", len(data)) + "".join(_storable_item(value) for value in data)
+    elif data is None:
+        return "\x05"
+    else:
+        data = str(data)
+        if len(data) < 256:
+            return "\x0a" + struct.pack("B", len(data)) + data
+        return "\x01" + struct.pack(">I", len(data)) + data
+
+
+def write_state_file(filename, data):
+    with open(filename, "wb") as f:
+        # 'pst0' + nstore header, the top level reference is implicit
+        f.write("pst0\x05\x07" + _storable_item(data)[1:])
+
+
+def write_www(folder, tree):
+    """
+    Writes the overview and domain pages munin-html would generate (navigation links outside of "content")
+
+    @param tree: {domain: {host: [plugin, ...]}}
+    """
+    _makedirs(folder)
+    header = '<html><head><title>Munin</title></head><body>\n<div id="nav"><a href="{0}index.html">Overview</a></div>\n'
+
+    with open(os.path.join(folder, "index.html"), "w") as f:
+        f.write(header.format(""))
+        f.write('<div id="content">\n<ul class="groupview">\n')
+        for domain, hosts in sorted(tree.items()):
+            f.write('<li><span class="domain"><a href="{0}/index.html">{0}</a></span>\n<ul>\n'.format(domain))
+            for host in sorted(hosts):
+                f.write('<li><span class="host"><a href="{0}/{1}/index.html">{1}</a></span></li>\n'.format(domain, host))
+            f.write('</ul></li>\n')
+        f.write('</ul>\n</div>\n</body></html>\n')
+
+    for domain, hosts in tree.items():
+        _makedirs(os.path.join(folder, domain))
+        with open(os.path.join(folder, domain, "index.html"), "w") as f:
+            f.write(header.format("../"))
+            f.write('<div id="content">\n<ul class="groupview">\n')
+            for host, plugins in sorted(hosts.items()):
+                f.write('<li><span class="host"><a href="{0}/index.html">{0}</a></span>\n<div class="graphs">\n'.format(host))
+                for p, plugin in enumerate(plugins):
+                    f.write('<div><a href="{0}/{1}.html">Plugin {2} &amp; more</a><br/></div>\n'.format(host, plugin, p))
+                f.write('</div></li>\n')
+            f.write('</ul>\n</div>\n</body></html>\n')
+
+
+def generate_tree(folder, domains=1, hosts=4, plugins=5, fields=4, rras=MUNIN_RRAS, last_update=1476000000,
+                  restore_rrd=False):
+    """
+    Generates a synthetic Munin installation in 'folder':
+      - <folder>/munin/datafile
+      - <folder>/munin/<domain>/<host>-<plugin>-<field>-<type>.rrd (empty placeholders unless restore_rrd is set)
+      - <folder>/munin/state-<domain>-<host>.storable
+      - <folder>/xml/<domain>-<host>-<plugin>-<field>-<type>.xml as produced by "rrdtool dump"
+      - <folder>/www/index.html and <folder>/www/<domain>/index.html as produced by munin-html
+
+    @return: Settings pointing to the generated tree
+    """
+    munin_folder = os.path.join(folder, "munin")
+
+    settings = Settings()
+    settings.interactive = False
+    settings.paths.update({
+        "munin": munin_folder,
+        "datafile": os.path.join(munin_folder, "datafile"),
+        "fetch_config": os.path.join(folder, "munin-fetch-config.json"),
+        "www": os.path.join(folder, "www"),
+        "xml": os.path.join(folder, "xml"),
+    })
+    settings.grafana['filename'] = os.path.join(folder, "munin-grafana.json")
+
+    _makedirs(munin_folder)
+    _makedirs(settings.paths['xml'])
+
+    www = {}
+    with open(settings.paths['datafile'], "w") as datafile:
+        datafile.write("version 2.0.25\n")
+
+        for d in range(domains):
+            domain = "domain{0}.example.org".format(d)
+            _makedirs(os.path.join(munin_folder, domain))
+
+            for h in range(hosts):
+                host = "host{0}.{1}".format(h, domain)
+                state = {}
+                www.setdefault(domain, {})[host] = ["plugin{0}".format(p) for p in range(plugins)]
+
+                for p in range(plugins):
+                    plugin = "plugin{0}".format(p)
+                    datafile.write("{0};{1}:{2}.graph_title Plugin {3}\n".format(domain, host, plugin, p))
+                    datafile.write("{0};{1}:{2}.graph_vlabel units per ${{graph_period}}\n".format(domain, host, plugin))
+                    datafile.write("{0};{1}:{2}.graph_order {3}\n".format(domain, host, plugin,
+                                                                          " ".join("field{0}".format(f) for f in range(fields))))
+
+                    for f in range(fields):
+                        field = "field{0}".format(f)
+                        datatype = FIELD_TYPES[f % len(FIELD_TYPES)]
+                        datafile.write("{0};{1}:{2}.{3}.label Field {4}\n".format(domain, host, plugin, field, f))
+                        datafile.write("{0};{1}:{2}.{3}.type {4}\n".format(domain, host, plugin, field, datatype))
+                        if datatype != "GAUGE":
+                            datafile.write("{0};{1}:{2}.{3}.min 0\n".format(domain, host, plugin, field))
+                        datafile.write("{0};{1}:{2}.{3}.draw {4}\n".format(domain, host, plugin, field,
+                                                                           "AREASTACK" if f else "AREA"))
+
+                        basename = "{0}-{1}-{2}-{3}".format(host, plugin, field, datatype.lower()[0])
+                        rrd_filename = os.path.join(munin_folder, domain, basename + ".rrd")
+                        xml_filename = os.path.join(settings.paths['xml'], "{0}-{1}.xml".format(domain, basename))
+
+                        write_rrd_xml(xml_filename, last_update, rras=rras)
+                        if restore_rrd:
+                            subprocess.check_call(['rrdtool', 'restore', '-f', xml_filename, rrd_filename])
+                        else:
+                            open(rrd_filename, "w").close()
+
+                        state["{0}:{1}".format(rrd_filename, Defaults.DEFAULT_RRD_INDEX)] = {
+                            "current": [str(last_update), "{0:.6f}".format(random.random()*1000)],
+                            "previous": [str(last_update-300), "{0:.6f}".format(random.random()*1000)],
+                        }
+
+                write_state_file(os.path.join(munin_folder, "state-{0}-{1}.storable".format(domain, host)),
+                                 {"spoolfetch": str(last_update), "value": state})
+
+    write_www(settings.paths['www'], www)
+    return settings
@@ -0,0 +1,102 @@
+from __future__ import print_function
+import json
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, code, body=None):
+        self.send_response(code)
+        if body is not None:
+            content = json.dumps(body)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        else:
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    def _query(self, params):
+        query = params.get('q', [""])[0].strip().upper()
+        self.server.stub.queries += 1
+
+        if query.startswith("SHOW DATABASES"):
+            series = [{"name": "databases", "columns": ["name"], "values": [[db] for db in self.server.stub.databases]}]
+        else:
+            series = []
+            if query.startswith("CREATE DATABASE"):
+                self.server.stub.databases.add(params['q'][0].split()[-1].strip('"'))
+
+        self._reply(200, {"results": [{"statement_id": 0, "series": series}]})
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path == "/ping":
+            self._reply(204)
+        elif url.path == "/query":
+            self._query(urlparse.parse_qs(url.query))
+        else:
+            self._reply(404)
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+
+        if url.path == "/write":
+            self.server.stub.record_write(body)
+            self._reply(204)
+        elif url.path == "/query":
+            params = urlparse.parse_qs(url.query)
+            params.update(urlparse.parse_qs(body))
+            self._query(params)
+        else:
+            self._reply(404)
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class InfluxDBStub:
+    """
+    Local stand-in for the InfluxDB HTTP API: accepts /ping, /query and /write
+    and only records what would have been written (requests, points, bytes)
+    """
+    def __init__(self, host="127.0.0.1", port=0, databases=("munin",)):
+        self.databases = set(databases)
+        self.queries = 0
+        self.writes = 0
+        self.points = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+        self.server = _Server((host, port), _Handler)
+        self.server.stub = self
+        self.host, self.port = self.server.server_address
+        self.thread = None
+
+    def record_write(self, body):
+        with self._lock:
+            self.writes += 1
+            self.bytes += len(body)
+            self.points += len([line for line in body.split("\n") if line])
+
+    def reset(self):
+        with self._lock:
+            self.queries = self.writes = self.points = self.bytes = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,138 @@
+from __future__ import print_function
+import time
+import random
+import threading
+import SocketServer
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    def _send(self, *lines):
+        self.wfile.write("".join(line + "\n" for line in lines))
+
+    def handle(self):
+        stub = self.server.stub
+        with stub._lock:
+            stub.connections += 1
+        if stub.latency:
+            time.sleep(stub.latency)
+
+        self._send("# munin node at {0}".format(stub.name))
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command, _, argument = line.strip().partition(" ")
+
+            if command == "cap":
+                self._send("cap multigraph" + (" spool" if stub.spool_interval else ""))
+            elif command == "list":
+                self._send(" ".join(sorted(stub.plugins)))
+            elif command in ("fetch", "config"):
+                if argument not in stub.plugins:
+                    self._send("# Unknown service", ".")
+                elif command == "fetch":
+                    self._send(*(stub.fetch(argument) + ["."]))
+                else:
+                    self._send(*(stub.config(argument) + ["."]))
+            elif command == "spoolfetch" and stub.spool_interval:
+                self._send(*(stub.spoolfetch(int(argument)) + ["."]))
+            elif command == "quit":
+                return
+            else:
+                self._send("# Unknown command. Try cap, list, nodes, config, fetch, version or quit")
+
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MuninNodeStub:
+    """
+    Local stand-in for a munin-node daemon answering cap/list/fetch/config/quit
+
+    @param plugins: {plugin: {field: type}}, a plugin name containing "multigraph" answers
+                    with two graphs: <plugin> and <plugin>.sub
+    @param spool_interval: if set, the node acts as munin-async and answers "spoolfetch" with a sample every
+                           spool_interval seconds over the last spool_history seconds
+    """
+    def __init__(self, plugins, name="node.example.org", host="127.0.0.1", port=0, latency=0.,
+                 spool_interval=None, spool_history=86400):
+        self.plugins = plugins
+        self.name = name
+        self.latency = latency
+        self.spool_interval = spool_interval
+        self.spool_history = spool_history
+        self.connections = 0
+        self.counters = {}
+        self._lock = threading.Lock()
+
+        self.server = _Server((host, port), _Handler)
+        self.server.stub = self
+        self.host, self.port = self.server.server_address
+        self.thread = None
+
+    def _graphs(self, plugin):
+        if "multigraph" in plugin:
+            return [plugin, plugin + ".sub"]
+        return [plugin]
+
+    def fetch(self, plugin):
+        lines = []
+        for graph in self._graphs(plugin):
+            if graph != plugin or "multigraph" in plugin:
+                lines.append("multigraph " + graph)
+            for field, datatype in sorted(self.plugins[plugin].items()):
+                if datatype == "GAUGE":
+                    value = random.uniform(0, 100)
+                else:
+                    # monotonic counters
+                    with self._lock:
+                        value = self.counters[(graph, field)] = \
+                            self.counters.get((graph, field), 0) + random.randint(0, 1000)
+                lines.append("{0}.value {1}".format(field, value))
+        return lines
+
+    def _graph_config(self, plugin, graph):
+        lines = ["graph_title {0}".format(graph)]
+        for field, datatype in sorted(self.plugins[plugin].items()):
+            lines.append("{0}.label {0}".format(field))
+            lines.append("{0}.type {1}".format(field, datatype))
+            if datatype != "GAUGE":
+                lines.append("{0}.min 0".format(field))
+        return lines
+
+    def config(self, plugin):
+        lines = []
+        for graph in self._graphs(plugin):
+            if graph != plugin or "multigraph" in plugin:
+                lines.append("multigraph " + graph)
+            lines.extend(self._graph_config(plugin, graph))
+        return lines
+
+    def spoolfetch(self, since):
+        now = int(time.time())
+        first = max(since, now - self.spool_history)
+        first += self.spool_interval - first % self.spool_interval
+
+        lines = []
+        for plugin in sorted(self.plugins):
+            for graph in self._graphs(plugin):
+                lines.append("multigraph " + graph)
+                lines.extend(self._graph_config(plugin, graph))
+                for timestamp in range(first, now + 1, self.spool_interval):
+                    for f, (field, datatype) in enumerate(sorted(self.plugins[plugin].items())):
+                        # counters grow with time so that any range of samples gives consistent rates
+                        value = random.uniform(0, 100) if datatype == "GAUGE" else timestamp * (f + 1)
+                        lines.append("{0}.value {1}:{2}".format(field, timestamp, value))
+        return lines
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
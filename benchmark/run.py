@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import os
+import sys
+import imp
+import json
+import time
+import shutil
+import resource
+import argparse
+import tempfile
+from collections import defaultdict
+
+from munininfluxdb import munin
+from munininfluxdb import rrd
+from munininfluxdb.settings import Settings
+from munininfluxdb.influxdbclient import InfluxdbClient
+from munininfluxdb.export import LineProtocolFiles
+from munininfluxdb.cache import SeriesCache
+from munininfluxdb.grafana import Dashboard
+from munininfluxdb.utils import Color, Symbol
+
+from benchmark.fixtures import generate_tree, MUNIN_RRAS
+from benchmark.influxdb_stub import InfluxDBStub
+
+fetch = imp.load_source('fetch', os.path.join(os.path.dirname(__file__), os.pardir, 'bin', 'fetch.py'))
+
+
+class StageResult:
+    def __init__(self, name, wall_time, points, peak_rss):
+        self.name = name
+        self.wall_time = wall_time
+        self.points = points
+        self.peak_rss = peak_rss
+
+    @property
+    def points_per_sec(self):
+        return self.points / self.wall_time if self.wall_time else 0.
+
+    def to_json(self):
+        return {
+            "stage": self.name,
+            "wall_time": self.wall_time,
+            "points": self.points,
+            "points_per_sec": self.points_per_sec,
+            "peak_rss_kb": self.peak_rss,
+        }
+
+
+def run_stage(results, name, func, *args):
+    """
+    Runs func(*args) which must return the number of points (or items) it processed
+    Peak RSS is the process high-water mark when the stage completes
+    """
+    start = time.time()
+    points = func(*args)
+    wall_time = time.time() - start
+    results.append(StageResult(name, wall_time, points, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+    print("  {0} {1}: {2:.3f}s".format(Symbol.OK_GREEN, name, wall_time))
+
+
+def stage_discover_from_datafile(settings):
+    munin.discover_from_datafile(settings)
+    rrd.check_rrd_files(settings)
+    return settings.nb_fields
+
+
+def stage_discover_from_www(settings):
+    discovered = Settings()
+    discovered.paths = settings.paths
+    munin.discover_from_www(discovered)
+    return discovered.nb_plugins
+
+
+def stage_discover_from_rrd(settings):
+    discovered = Settings()
+    discovered.paths = settings.paths
+    rrd.discover_from_rrd(discovered)
+    return discovered.nb_fields
+
+
+def stage_export_to_xml(settings):
+    return rrd.export_to_xml(settings)
+
+
+def stage_read_xml_file(settings, contents):
+    points = 0
+    for domain, host, plugin, field in settings.iter_fields():
+        _field = settings.domains[domain].hosts[host].plugins[plugin].fields[field]
+        if _field.rrd_exported:
+            contents[_field.xml_filename] = rrd.read_xml_file(_field.xml_filename)
+            points += len(contents[_field.xml_filename])
+    return points
+
+
+def stage_read_cache(settings, contents):
+    """
+    Writes every parsed series to the cache then reads them back, as an import run after a first one would
+    """
+    cache = SeriesCache(settings.paths['cache'])
+    for domain, host, plugin, field in settings.iter_fields():
+        _field = settings.domains[domain].hosts[host].plugins[plugin].fields[field]
+        if _field.xml_filename in contents:
+            cache.put(_field.rrd_filename, contents[_field.xml_filename])
+
+    points = 0
+    for domain, host, plugin, field in settings.iter_fields():
+        _field = settings.domains[domain].hosts[host].plugins[plugin].fields[field]
+        if _field.xml_filename in contents:
+            points += len(cache.get(_field.rrd_filename))
+    return points
+
+
+def join_series(settings, contents):
+    """
+    Same join as InfluxdbClient.import_from_xml (grouped mode), kept outside of the timed stages
+    """
+    series = []
+    for domain, host, plugin in settings.iter_plugins():
+        _plugin = settings.domains[domain].hosts[host].plugins[plugin]
+        field_names = ['time']
+        values = defaultdict(list)
+
+        for field in _plugin.fields:
+            _field = _plugin.fields[field]
+            if _field.xml_filename in contents:
+                field_names.append(field)
+                [values[key].append(value) for key, value in contents[_field.xml_filename].items()]
+
+                _field.influxdb_measurement = plugin
+                _field.influxdb_field = field
+                _field.xml_imported = True
+
+        tags = {"domain": domain, "host": host, "plugin": plugin}
+        series.append((plugin, tags, field_names, [[k]+v for k, v in values.items()]))
+
+    return series
+
+
+def stage_write_series(client, series, stub):
+    stub.reset()
+    for measurement, tags, field_names, values in series:
+        client.write_series(measurement, tags, field_names, values)
+    return stub.points
+
+
+def stage_export_to_files(series, folder):
+    files = LineProtocolFiles(folder, "munin", shards=4, compress=True)
+    points = 0
+    for measurement, tags, field_names, values in series:
+        body = InfluxdbClient.make_points(measurement, tags, field_names, values)
+        files.write_points(body)
+        points += len(body)
+    files.close()
+    return points
+
+
+def stage_read_state_files(config, states):
+    for statefile in config['statefiles']:
+        states.append(fetch.read_state_file(statefile))
+    return sum(len(values[0]) for values in states)
+
+
+def stage_pack_values(config, states):
+    return sum(len(point['fields']) for values in states for point in fetch.pack_values(config, values))
+
+
+def stage_grafana_generate(settings):
+    dashboard = Dashboard(settings)
+    dashboard.generate()
+    return sum(len(row.panels) for row in dashboard.rows)
+
+
+def print_report(results):
+    print("\n{0}{1:<24}{2:>12}{3:>14}{4:>16}{5:>14}{6}".format(Color.BOLD, "stage", "wall time", "points",
+                                                               "points/sec", "peak RSS (MB)", Color.CLEAR))
+    for result in results:
+        print("{0:<24}{1:>11.3f}s{2:>14}{3:>16.0f}{4:>14.1f}".format(result.name, result.wall_time, result.points,
+                                                                     result.points_per_sec, result.peak_rss/1024.))
+
+
+def main(args):
+    folder = args.folder or tempfile.mkdtemp(prefix="munin-influxdb-bench-")
+    rras = [(pdp_per_row, max(1, int(nb_rows*args.rows_scale))) for pdp_per_row, nb_rows in MUNIN_RRAS]
+
+    print("{0}Generating synthetic Munin tree{1} ({2})".format(Color.BOLD, Color.CLEAR, folder))
+    start = time.time()
+    settings = generate_tree(folder, domains=args.domains, hosts=args.hosts, plugins=args.plugins,
+                             fields=args.fields, rras=rras, restore_rrd=args.rrd)
+    print("  {0} Generated in {1:.1f}s".format(Symbol.OK_GREEN, time.time() - start))
+
+    stub = InfluxDBStub().start()
+    settings.influxdb.update({"host": stub.host, "port": stub.port, "database": "munin"})
+
+    results = []
+    try:
+        print("\n{0}Running stages{1}".format(Color.BOLD, Color.CLEAR))
+        run_stage(results, "discover_from_datafile", stage_discover_from_datafile, settings)
+        run_stage(results, "discover_from_www", stage_discover_from_www, settings)
+        run_stage(results, "discover_from_rrd", stage_discover_from_rrd, settings)
+
+        if args.rrd:
+            run_stage(results, "export_to_xml", stage_export_to_xml, settings)
+        else:
+            # XML files are generated directly, as if already dumped
+            for domain, host, plugin, field in settings.iter_fields():
+                settings.domains[domain].hosts[host].plugins[plugin].fields[field].rrd_exported = True
+
+        contents = {}
+        run_stage(results, "read_xml_file", stage_read_xml_file, settings, contents)
+        settings.paths['cache'] = os.path.join(folder, "cache")
+        run_stage(results, "SeriesCache.get", stage_read_cache, settings, contents)
+
+        client = InfluxdbClient(settings)
+        client.connect()
+        series = join_series(settings, contents)
+        contents.clear()
+        run_stage(results, "write_series", stage_write_series, client, series, stub)
+        run_stage(results, "export_to_files", stage_export_to_files, series, os.path.join(folder, "export"))
+        del series
+
+        settings.save_fetch_config()
+        with open(settings.paths['fetch_config']) as f:
+            config = json.load(f)
+
+        states = []
+        run_stage(results, "read_state_file", stage_read_state_files, config, states)
+        run_stage(results, "fetch.pack_values", stage_pack_values, config, states)
+        run_stage(results, "Dashboard.generate", stage_grafana_generate, settings)
+    finally:
+        stub.stop()
+        if not args.folder and not args.keep:
+            shutil.rmtree(folder)
+
+    print_report(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "scale": {"domains": args.domains, "hosts": args.hosts, "plugins": args.plugins,
+                          "fields": args.fields, "rows_scale": args.rows_scale},
+                "stages": [result.to_json() for result in results]
+            }, f, indent=2, separators=(',', ': '))
+        print("\n{0} Results written to {1}".format(Symbol.OK_GREEN, args.output))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="""
+    Generates a synthetic Munin installation and runs each import/fetch stage against a local stand-in
+    InfluxDB server, reporting wall time, points/sec and peak RSS per stage.
+    """)
+    parser.add_argument('--domains', default=1, type=int, help='number of Munin domains (default: %(default)s)')
+    parser.add_argument('--hosts', default=4, type=int, help='number of hosts per domain (default: %(default)s)')
+    parser.add_argument('--plugins', default=5, type=int, help='number of plugins per host (default: %(default)s)')
+    parser.add_argument('--fields', default=4, type=int, help='number of fields per plugin (default: %(default)s)')
+    parser.add_argument('--rows-scale', default=1.0, type=float,
+                        help='scale factor applied to the number of rows of each Munin RRA (default: %(default)s)')
+    parser.add_argument('--rrd', action='store_true',
+                        help='build real RRD files with "rrdtool restore" and benchmark "rrdtool dump" as well')
+    parser.add_argument('--folder', help='generate the Munin tree in this folder (kept afterwards)')
+    parser.add_argument('--keep', action='store_true', help='keep the generated temporary folder')
+    parser.add_argument('-o', '--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    try:
+        main(args)
+    except KeyboardInterrupt:
+        print("\n{0} Canceled.".format(Symbol.NOK_RED))
+        sys.exit(1)
@@ -0,0 +1,161 @@
+from __future__ import print_function
+import os
+import shlex
+import time
+import socket
+import threading
+
+import paramiko
+
+
+class _SFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+class _SFTPServer(paramiko.SFTPServerInterface):
+    """
+    Read-only SFTP over the local filesystem, paths taken as they are
+    """
+    def _stat(self, path, func):
+        try:
+            return paramiko.SFTPAttributes.from_stat(func(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        return self._stat(path, os.stat)
+
+    def lstat(self, path):
+        return self._stat(path, os.lstat)
+
+    def list_folder(self, path):
+        try:
+            names = os.listdir(path)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        attributes = []
+        for name in names:
+            attr = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(path, name)))
+            attr.filename = name
+            attributes.append(attr)
+        return attributes
+
+    def open(self, path, flags, attr):
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            return paramiko.SFTP_PERMISSION_DENIED
+        try:
+            f = open(path, "rb")
+        except IOError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        handle = _SFTPHandle(flags)
+        handle.readfile = f
+        handle.filename = path
+        return handle
+
+
+class _Server(paramiko.ServerInterface):
+    def __init__(self, stub):
+        self.stub = stub
+
+    def get_allowed_auths(self, username):
+        return "publickey,password"
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED_OPEN_REQUEST
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self.stub.execute, args=(channel, command))
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+class SSHMasterStub:
+    """
+    Local stand-in for a Munin master reachable over SSH: SFTP (read-only) and "rrdtool dump" over exec channels,
+    any user and key or password being accepted
+
+    @param xml_folder: "rrdtool dump <munin>/<domain>/<name>.rrd" answers with <xml_folder>/<domain>-<name>.xml, the
+                       layout of fixtures.generate_tree()
+    """
+    def __init__(self, xml_folder, host="127.0.0.1", port=0):
+        self.xml_folder = xml_folder
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.dumps = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen(5)
+        self.host, self.port = self.socket.getsockname()
+        self.transports = []
+        self.thread = None
+
+    def execute(self, channel, command):
+        # the transport thread replies to the exec request after check_channel_exec_request() returns: closing the
+        # channel before would fail exec_command() on the client
+        time.sleep(0.05)
+        args = shlex.split(command)
+        try:
+            if args[:2] != ["rrdtool", "dump"] or len(args) != 3:
+                channel.sendall_stderr("unsupported command: {0}\n".format(command))
+                channel.send_exit_status(127)
+                return
+
+            folder, name = os.path.split(args[2])
+            xml_filename = os.path.join(self.xml_folder, "{0}-{1}.xml".format(os.path.basename(folder),
+                                                                              name[:-len(".rrd")]))
+            try:
+                f = open(xml_filename, "rb")
+            except IOError:
+                channel.sendall_stderr("ERROR: opening '{0}': No such file or directory\n".format(args[2]))
+                channel.send_exit_status(1)
+                return
+            with f:
+                while True:
+                    data = f.read(65536)
+                    if not data:
+                        break
+                    channel.sendall(data)
+            with self._lock:
+                self.dumps += 1
+            channel.send_exit_status(0)
+        finally:
+            channel.close()
+
+    def _serve(self):
+        while True:
+            try:
+                client, _ = self.socket.accept()
+            except socket.error:
+                return
+            transport = paramiko.Transport(client)
+            transport.use_compression(True)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler("sftp", paramiko.SFTPServer, _SFTPServer)
+            transport.start_server(server=_Server(self))
+            with self._lock:
+                self.connections += 1
+                self.transports.append(transport)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.socket.close()
+        for transport in self.transports:
+            transport.close()
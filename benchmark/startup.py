@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+from munininfluxdb.utils import Color, Symbol
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+# (name, python arguments) each run in a fresh interpreter
+COMMANDS = [
+    ("interpreter", ["-c", "pass"]),
+    ("fetch --help", [os.path.join(ROOT, "bin", "fetch.py"), "--help"]),
+    ("import influxdb", ["-c", "import influxdb"]),
+]
+
+
+def measure(arguments, repeat):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    timings = []
+    with open(os.devnull, "w") as devnull:
+        for _ in range(repeat):
+            start = time.time()
+            subprocess.check_call([sys.executable] + arguments, stdout=devnull, env=env, cwd=ROOT)
+            timings.append(time.time() - start)
+    return sorted(timings)
+
+
+def main(args):
+    print("{0}Startup time{1} ({2} runs, {3})".format(Color.BOLD, Color.CLEAR, args.repeat, sys.executable))
+
+    results = {}
+    for name, arguments in COMMANDS:
+        try:
+            timings = measure(arguments, args.repeat)
+        except subprocess.CalledProcessError as e:
+            print("  {0} {1}: {2}".format(Symbol.NOK_RED, name, e))
+            continue
+
+        results[name] = {"min": timings[0], "median": timings[len(timings)//2]}
+        print("  {0:<20} min {1:>7.1f} ms   median {2:>7.1f} ms".format(name, timings[0]*1000,
+                                                                         timings[len(timings)//2]*1000))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, separators=(',', ': '))
+        print("{0} Results written to {1}".format(Symbol.OK_GREEN, args.output))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="""
+    Measures the startup cost of the 'fetch' command (module imports and argument parsing) in fresh interpreters.
+    """)
+    parser.add_argument('-n', '--repeat', default=20, type=int, help='number of runs per command (default: %(default)s)')
+    parser.add_argument('-o', '--output', help='write results as JSON to this file')
+    main(parser.parse_args())
@@ -7,15 +7,14 @@ import sys
 import argparse
 from collections import defaultdict
 
-from munininfluxdb.utils import Symbol
-from munininfluxdb.settings import Defaults
-
-import influxdb
-
-try:
-    import storable
-except ImportError:
-    from vendor import storable
+# keep imports minimal: fetch runs from cron every few minutes and startup time dominates
+# (no influxdb client, profiling, crontab or storable until actually needed)
+from munininfluxdb.utils import Symbol, compute_rate
+from munininfluxdb.defaults import Defaults, DATA_TYPES
+from munininfluxdb.telemetry import Telemetry
+from munininfluxdb.lineprotocol import LineProtocolWriter, LineProtocolError
+from munininfluxdb.deadband import Deadband
+from munininfluxdb.aggregate import DomainAggregator
 
 try:
     pwd.getpwnam('munin')
@@ -24,18 +23,44 @@ except KeyError:
 else:
     CRON_USER = 'munin'
 
+# Munin update period, in seconds
+MUNIN_STEP = 300
+
 # Cron job comment is used to uninstall and must not be manually deleted from the crontab
 CRON_COMMENT = 'Update InfluxDB with fresh values from Munin'
 
-def pack_values(config, values):
+def get_datatype(config, name):
+    """
+    Data type and bounds of a metric as saved by 'import', guessed from the RRD filename for older configurations
+    """
+    if name in config.get('datatypes', {}):
+        datatype = config['datatypes'][name]
+        return datatype['type'], datatype.get('min'), datatype.get('max')
+
+    suffix = os.path.splitext(name)[0].rsplit("-", 1)[-1]
+    return DATA_TYPES.get(suffix, "GAUGE"), None, None
+
+def get_tags(config, name, measurement):
+    """
+    Tags of the series a metric is written to, per measurement for configurations saved by older versions
+    """
+    if name in config.get('series', {}):
+        return config['series'][name]
+    return config['tags'][measurement]
+
+def pack_values(config, values, deadband=None, aggregator=None):
     suffix = ":{0}".format(Defaults.DEFAULT_RRD_INDEX)
     metrics, date = values
     date = int(date)
 
     data = defaultdict(dict)
+    tags = {}
+    integers = set(config.get('integers', ()))
 
     for metric in metrics:
-        (latest_date, latest_value), (previous_date, previous_value) = metrics[metric].values()
+        # 'current' and 'previous' samples, as (date, value)
+        latest, previous = sorted(metrics[metric].values(), key=lambda sample: int(sample[0]), reverse=True)
+        latest_date = latest[0]
 
         # usually stored as rrd-filename:42 with 42 being a constant column name for RRD files
         if metric.endswith(suffix):
@@ -46,8 +71,25 @@ def pack_values(config, values):
         if name in config['metrics']:
             measurement, field = config['metrics'][name]
 
+            datatype, minimum, maximum = get_datatype(config, name)
+
+            value = compute_rate(datatype, latest, previous, minimum, maximum)
+            if name in integers and value is not None:
+                # the field was imported as an integer, a float would be rejected
+                value = int(round(value))
             data[measurement]['time'] = int(latest_date)
-            data[measurement][field] = float(latest_value) if latest_value != 'U' else None   # 'U' is Munin value for unknown
+            tags[measurement] = get_tags(config, name, measurement)
+
+            if aggregator:
+                aggregator.add(tags[measurement]['domain'], tags[measurement]['plugin'], measurement,
+                               int(latest_date), {field: value})
+
+            if deadband:
+                plugin = tags[measurement]['plugin']
+                rule = deadband.rule(plugin, field if config['influxdb']['group_fields'] else measurement)
+                if rule and not deadband.keep(name, rule, value, int(latest_date)):
+                    continue
+            data[measurement][field] = value
         else:
             age = (date - int(latest_date)) // (24*3600)
             if age < 7:
@@ -56,59 +98,130 @@ def pack_values(config, values):
 
     return [{
             "measurement": measurement,
-            "tags": config['tags'][measurement],
+            "tags": tags[measurement],
             "time": fields['time'],
             "fields": {key: value for key, value in fields.iteritems() if key != 'time'}
-        } for measurement, fields in data.iteritems()]
+        } for measurement, fields in data.iteritems() if len(fields) > 1]
 
 def read_state_file(filename):
+    try:
+        import storable
+    except ImportError:
+        from vendor import storable
+
     data = storable.retrieve(filename)
     assert 'spoolfetch' in data and 'value' in data
     return data['value'], data['spoolfetch']
 
-def main(config_filename=Defaults.FETCH_CONFIG):
+def main(config_filename=Defaults.FETCH_CONFIG, write_telemetry=False, profiler=None):
+    telemetry = Telemetry("fetch")
+    telemetry.profiler = profiler
     config = None
     with open(config_filename) as f:
         config = json.load(f)
         print("{0} Opened configuration: {1}".format(Symbol.OK_GREEN, f.name))
     assert config
 
-    client = influxdb.InfluxDBClient(config['influxdb']['host'],
-                                     config['influxdb']['port'],
-                                     config['influxdb']['user'],
-                                     config['influxdb']['password']
-                                     )
-    try:
-        client.get_list_database()
-    except influxdb.client.InfluxDBClientError as e:
-        print("  {0} Could not connect to database: {1}".format(Symbol.WARN_YELLOW, e))
-        sys.exit(1)
+    if config['influxdb'].get('targets'):
+        # series spread over several servers, sent where 'import' wrote their history
+        from munininfluxdb.fanout import FanoutWriter, list_targets
+        client = FanoutWriter(list_targets(config['influxdb']), config['influxdb']['database'],
+                              config['influxdb'].get('replicas', 1), config.setdefault('mapping', {}))
+        unreachable = client.ping()
+        for name, error in unreachable:
+            print("  {0} Could not connect to {1}: {2}".format(Symbol.WARN_YELLOW, name, error))
+        if len(unreachable) == len(client.targets):
+            sys.exit(1)
     else:
-        client.switch_database(config['influxdb']['database'])
+        client = LineProtocolWriter(config['influxdb']['host'],
+                                    config['influxdb']['port'],
+                                    config['influxdb']['user'],
+                                    config['influxdb']['password'],
+                                    config['influxdb']['database']
+                                    )
+        try:
+            client.ping()
+        except LineProtocolError as e:
+            print("  {0} Could not connect to database: {1}".format(Symbol.WARN_YELLOW, e))
+            sys.exit(1)
+
+    deadband = None
+    if config.get('deadband', {}).get('rules'):
+        # last written values are kept in the configuration between runs
+        deadband = Deadband(config['deadband']['rules'], config['deadband']['heartbeat'],
+                            config.setdefault('deadband_state', {}))
+
+    aggregator = None
+    if config.get('aggregate'):
+        # hosts are updated at slightly different times of the same Munin cycle
+        aggregator = DomainAggregator(config['aggregate'], step=MUNIN_STEP)
 
     for statefile in config['statefiles']:
         try:
-            values = read_state_file(statefile)
+            with telemetry.stage("parse"):
+                values = read_state_file(statefile)
 
         except Exception as e:
             print("{0} Could not read state file {1}: {2}".format(Symbol.NOK_RED, statefile, e))
+            telemetry.count("errors")
             continue
         else:
             print("{0} Parsed: {1}".format(Symbol.OK_GREEN, statefile))
+            telemetry.count("statefiles")
 
-        data = pack_values(config, values)
+        dropped = deadband.dropped if deadband else 0
+        with telemetry.stage("pack"):
+            data = pack_values(config, values, deadband, aggregator)
         if len(data):
-            # print(data)
             try:
-                client.write_points(data, time_precision='s')
-            except influxdb.client.InfluxDBClientError as e:
+                with telemetry.stage("write"):
+                    size = client.write_points(data, precision='s')
+            except LineProtocolError as e:
                 print("  {0} Could not write data to database: {1}".format(Symbol.WARN_YELLOW, e))
+                telemetry.count("errors")
             else:
                 config['lastupdate'] = max(config['lastupdate'], int(values[1]))
                 print("{0} Successfully written {1} new measurements".format(Symbol.OK_GREEN, len(data)))
+                telemetry.count("points", len(data))
+                telemetry.count("bytes", size)
+        elif deadband and deadband.dropped > dropped:
+            print("{0} No value changed beyond the deadband".format(Symbol.OK_GREEN))
         else:
             print("%s No data found, is Munin still running?", Symbol.NOK_RED)
 
+    if aggregator and aggregator.stale:
+        print("{0} Left {1} values of a previous Munin cycle out of the domain aggregates".format(Symbol.WARN_YELLOW,
+                                                                                                 aggregator.stale))
+    if aggregator and aggregator.accumulators:
+        with telemetry.stage("aggregate"):
+            data = aggregator.to_points()
+        try:
+            with telemetry.stage("write"):
+                size = client.write_points(data, precision='s')
+        except LineProtocolError as e:
+            print("  {0} Could not write domain aggregates: {1}".format(Symbol.WARN_YELLOW, e))
+            telemetry.count("errors")
+        else:
+            print("{0} Successfully written {1} domain aggregates".format(Symbol.OK_GREEN, len(data)))
+            telemetry.count("points", len(data))
+            telemetry.count("bytes", size)
+
+    if config['influxdb'].get('targets'):
+        with telemetry.stage("write"):
+            for name, dropped in client.flush():
+                print("  {0} Gave up writing {1} batches to {2}".format(Symbol.WARN_YELLOW, dropped, name))
+                telemetry.count("errors", dropped)
+        telemetry.count("retries", client.retried)
+
+    if deadband:
+        telemetry.count("deadband_dropped", deadband.dropped)
+    telemetry.print_summary()
+    if write_telemetry or config['influxdb'].get('telemetry'):
+        try:
+            client.write_points(telemetry.to_points(), precision='s')
+        except LineProtocolError as e:
+            print("  {0} Could not write telemetry: {1}".format(Symbol.WARN_YELLOW, e))
+
     with open(config_filename, "w") as f:
         json.dump(config, f)
         print("{0} Updated configuration: {1}".format(Symbol.OK_GREEN, f.name))
@@ -157,11 +270,19 @@ if __name__ == "__main__":
     """)
     parser.add_argument('--config', default=Defaults.FETCH_CONFIG,
                         help='overrides the default configuration file (default: %(default)s)')
+    parser.add_argument('--telemetry', action='store_true',
+                        help='write fetch timings and counters to the "munininfluxdb_internal" measurement '
+                             '(always on if enabled during import)')
+    parser.add_argument('--profile', metavar='DIR',
+                        help='record cProfile statistics of each stage to DIR and print the hottest functions')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='with --profile, also record the peak memory of each stage, and tracemalloc snapshots on '
+                             'Python 3.4+')
     cronargs = parser.add_argument_group('cron job management')
     cronargs.add_argument('--install-cron', dest='script_path',
                         help='install a cron job to updated InfluxDB with fresh data from Munin every <period> minutes')
     cronargs.add_argument('-p', '--period', default=5, type=int,
-                        help="sets the period in minutes between each fetch in the cron job (default: %(default)min)")
+                        help="sets the period in minutes between each fetch in the cron job (default: %(default)s min)")
     cronargs.add_argument('--uninstall-cron', action='store_true',
                         help='uninstall the fetch cron job (any matching the initial comment actually)')
     args = parser.parse_args()
@@ -177,4 +298,13 @@ if __name__ == "__main__":
             print("No matching job found (searching comment \"{1}\" in crontab for user {2})".format(Symbol.WARN_YELLOW,
                                                                                                      CRON_COMMENT, CRON_USER))
     else:
-        main(args.config)
+        profiler = None
+        if args.profile:
+            from munininfluxdb.profiling import Profiler
+            profiler = Profiler(args.profile, args.profile_memory)
+        try:
+            main(args.config, args.telemetry, profiler)
+        finally:
+            if profiler:
+                profiler.save("fetch")
+                profiler.print_summary()
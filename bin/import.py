@@ -1,15 +1,28 @@
 #!/usr/bin/env python
 from __future__ import print_function
 
+import os
 import argparse
+import getpass
+import multiprocessing
 import sys
+import time
+import traceback
+from datetime import datetime
 
 from munininfluxdb import munin
 from munininfluxdb import rrd
 from munininfluxdb.settings import Settings, Defaults
 from munininfluxdb.influxdbclient import InfluxdbClient
-from munininfluxdb.grafana import Dashboard
-from munininfluxdb.utils import Color, Symbol
+from munininfluxdb.grafana import Dashboard, upload_dashboards
+from munininfluxdb.profiling import Profiler
+from munininfluxdb.deadband import parse_rule
+from munininfluxdb.aggregate import FUNCTIONS
+from munininfluxdb.shard import parse_shard, restore_imported
+from munininfluxdb.throttle import lower_priority, IONICE_CLASSES, MUNIN_UPDATE_LIMIT, MUNIN_UPDATE_STATS
+from munininfluxdb.remote import RemoteMaster
+from munininfluxdb.plan import plan_import, print_plan, DUMP_RATE, PARSE_RATE, WRITE_RATE
+from munininfluxdb.utils import Color, Symbol, parse_time, parse_size, parse_duration
 
 
 def retrieve_munin_configuration(settings):
@@ -20,6 +33,9 @@ def retrieve_munin_configuration(settings):
     try:
         settings = munin.discover_from_datafile(settings)
     except Exception as e:
+        if settings.remote:
+            # www pages and RRD tree are not browsed over SSH
+            raise Exception("Could not process datafile of {0}: {1}".format(settings.remote.name, e))
         print("  {0} Could not process datafile ({1}), will read www and RRD cache instead".format(Symbol.NOK_RED, settings.paths['datafile']))
 
         # read /var/cache/munin/www to check what's currently displayed on the dashboard
@@ -40,34 +56,144 @@ def retrieve_munin_configuration(settings):
     return settings
 
 
-def main(args):
-    print("{0}Munin to InfluxDB migration tool{1}".format(Color.BOLD, Color.CLEAR))
-    print("-" * 20)
+def connect_remote(settings, args):
+    """
+    Opens the SSH connection to a remote Munin master and copies its datafile locally, RRD files being dumped there
+    """
+    password = getpass.getpass("SSH password for {0}: ".format(args.ssh)) if args.ssh_password else None
+    settings.remote = RemoteMaster(args.ssh, args.ssh_key, password, not args.ssh_no_compression,
+                                   args.ssh_accept_unknown_host)
+    print("  {0} Connected to Munin master {1} over SSH".format(Symbol.OK_GREEN, settings.remote.name))
 
-    settings = Settings(args)
-    settings = retrieve_munin_configuration(settings)
+    datafile = os.path.join(Defaults.TEMP_FOLDER, settings.remote.name, "datafile")
+    settings.remote.get(settings.paths['datafile'], datafile)
+    settings.paths['datafile'] = datafile
 
-    # export RRD files as XML for (much) easier parsing (but takes much more time)
-    print("\nExporting RRD databases:".format(settings.nb_rrd_files))
-    nb_xml = rrd.export_to_xml(settings)
-    print("  {0} Exported {1} RRD files to XML ({2})".format(Symbol.OK_GREEN, nb_xml, settings.paths['xml']))
 
-    #reads every XML file and export as in the InfluxDB database
-    exporter = InfluxdbClient(settings)
+def connect(exporter):
+    settings = exporter.settings
     if settings.interactive:
         exporter.prompt_setup()
     else:
         # even in non-interactive mode, we ask for the password if empty
-        if not exporter.settings.influxdb['password']:
-            exporter.settings.influxdb['password'] = InfluxdbClient.ask_password()
+        if not settings.influxdb['password']:
+            settings.influxdb['password'] = InfluxdbClient.ask_password()
         exporter.connect()
-        exporter.test_db(exporter.settings.influxdb['database'])    # needed to create db if missing
+        exporter.test_db(settings.influxdb['database'])    # needed to create db if missing
+
+
+def select(settings, exporter, done=()):
+    """
+    Applies the domain/host/plugin/field patterns, the shard and the time window before anything is dumped
+
+    @param done: set of (domain, host, plugin, field) already imported, skipped as well
+    """
+    filters = settings.filters
+    if filters['trim_to_retention']:
+        if not exporter.client:
+            connect(exporter)
+        duration = exporter.retention_duration()
+        if duration:
+            oldest = int(time.time()) - duration
+            filters['since'] = max(filters['since'] or 0, oldest)
+            print("  {0} Retention policy of \"{1}\" keeps {2} days: entries older than {3} are skipped".format(
+                Symbol.OK_GREEN, settings.influxdb['database'], duration // 86400,
+                datetime.utcfromtimestamp(filters['since']).strftime("%Y-%m-%d %H:%M")))
+
+    removed = settings.apply_filters(done)
+    skipped = rrd.filter_time_window(settings)
+    if removed or skipped:
+        print("  {0} Selected {1} RRD files ({2} fields not matching patterns, of other shards or already imported, "
+              "{3} files out of time window)".format(Symbol.OK_GREEN, settings.nb_rrd_files, removed, skipped))
+
+
+def merge_shards(settings):
+    """
+    Marks the fields journaled by every shard as imported, for the 'fetch' configuration and Grafana dashboards
+    """
+    checkpoint = settings.checkpoint
+    missing = sorted(set(range(1, checkpoint.count + 1)) - set(checkpoint.completed()))
+    if missing:
+        print("  {0} Shard(s) {1} did not complete, only the fields they imported so far are merged".format(
+            Symbol.WARN_YELLOW, ", ".join(str(index) for index in missing)))
+
+    entries = checkpoint.load_all()
+    unknown = restore_imported(settings, entries)
+    print("  {0} Merged {1} fields imported by {2} shards ({3})".format(Symbol.OK_GREEN, len(entries) - unknown,
+                                                                     checkpoint.count, checkpoint.folder))
+    if unknown:
+        print("  {0} {1} journaled fields are not part of the current Munin configuration".format(Symbol.WARN_YELLOW,
+                                                                                                   unknown))
+
+
+def main(args, profiler=None):
+    print("{0}Munin to InfluxDB migration tool{1}".format(Color.BOLD, Color.CLEAR))
+    print("-" * 20)
+
+    settings = Settings(args)
+    settings.telemetry.profiler = profiler
+    lower_priority(args.nice, args.ionice)
+    with settings.telemetry.stage("discovery"):
+        if args.ssh:
+            connect_remote(settings, args)
+        settings = retrieve_munin_configuration(settings)
+
+    exporter = InfluxdbClient(settings)
+    if args.merge_shards:
+        with settings.telemetry.stage("discovery"):
+            select(settings, exporter)
+        merge_shards(settings)
+    else:
+        # connect first, unless nothing is written to InfluxDB: no need to wait for the dump to be asked for credentials
+        if not args.plan and not args.export:
+            connect(exporter)
+
+        with settings.telemetry.stage("discovery"):
+            # fields journaled by a previous run of this shard are not imported again
+            select(settings, exporter, settings.checkpoint.done() if settings.checkpoint else ())
+
+        if args.plan:
+            print_plan(plan_import(settings), *args.plan_rates)
+            return
+
+        # export RRD files as XML for (much) easier parsing (but takes much more time)
+        print("\nExporting RRD databases:".format(settings.nb_rrd_files))
+        nb_xml = rrd.export_to_xml(settings)
+        print("  {0} Exported {1} RRD files to XML ({2})".format(Symbol.OK_GREEN, nb_xml, settings.paths['xml']))
 
-    exporter.import_from_xml()
+        #reads every XML file and export as in the InfluxDB database
+        if args.export:
+            # bulk loading: same series written to files instead, no connection needed
+            filenames = exporter.export_to_files(args.export, args.export_shards, args.export_gzip)
+            settings = exporter.get_settings()
+            print("{0} Munin data exported to {1} line protocol files in {2}, load them with: "
+                  "influx -import -precision=s {3}-path=<file>".format(Symbol.OK_GREEN, len(filenames), args.export,
+                                                                       "-compressed " if args.export_gzip else ""))
+        else:
+            exporter.import_from_xml()
 
-    settings = exporter.get_settings()
-    print("{0} Munin data successfully imported to {1}/db/{2}".format(Symbol.OK_GREEN, settings.influxdb['host'],
-                                                                      settings.influxdb['database']))
+            settings = exporter.get_settings()
+            print("{0} Munin data successfully imported to {1}/db/{2}".format(Symbol.OK_GREEN, settings.influxdb['host'],
+                                                                              settings.influxdb['database']))
+
+        if settings.remote:
+            # still needed until then: cache entries are keyed on the remote RRD files
+            settings.remote.close()
+        if settings.throttle.backoffs:
+            settings.telemetry.count("backoffs", settings.throttle.backoffs)
+        settings.telemetry.print_summary()
+        if exporter.scheduler:
+            exporter.scheduler.print_stragglers(20 if settings.verbose > 1 else 5)
+        if settings.influxdb['telemetry'] and not args.export:
+            exporter.write_telemetry()
+
+        if settings.checkpoint:
+            # the 'fetch' configuration and dashboards must cover every shard
+            settings.checkpoint.finish()
+            print("{0} Shard {1}/{2} completed. Once every shard is, run: import --checkpoint {3} --merge-shards {2} "
+                  "(same other options)".format(Symbol.OK_GREEN, settings.checkpoint.index, settings.checkpoint.count,
+                                                settings.checkpoint.folder))
+            return
 
     settings.save_fetch_config()
     print("{0} Configuration for 'munin-influxdb fetch' exported to {1}".format(Symbol.OK_GREEN,
@@ -87,23 +213,36 @@ def main(args):
         if settings.interactive:
             dashboard.prompt_setup()
 
-        dashboard.generate()
+        if settings.grafana['layout'] == "all":
+            dashboard.generate()
+            dashboards = [dashboard]
+        else:
+            dashboards = dashboard.generate_templated(settings.grafana['layout'])
 
-        if settings.grafana['host']:
+        if settings.grafana.get('host'):
             try:
-                dash_url = dashboard.upload()
+                results = upload_dashboards(settings, dashboards, settings.grafana['force_upload'],
+                                            settings.grafana['upload_workers'])
             except Exception as e:
                 print("{0} Didn't quite work uploading: {1}".format(Symbol.NOK_RED, e))
             else:
-                print("{0} A Grafana dashboard has been successfully uploaded to {1}".format(Symbol.OK_GREEN, dash_url))
+                for dashboard, dash_url, error in results:
+                    if error:
+                        print("{0} Didn't quite work uploading {1}: {2}".format(Symbol.NOK_RED, dashboard.title, error))
+                    elif dash_url:
+                        print("{0} A Grafana dashboard has been successfully uploaded to {1}".format(Symbol.OK_GREEN, dash_url))
+                unchanged = len([dash_url for _, dash_url, error in results if not dash_url and not error])
+                if unchanged:
+                    print("{0} {1} unchanged Grafana dashboard(s) not uploaded again".format(Symbol.OK_GREEN, unchanged))
 
-        if settings.grafana['filename']:
-            try:
-                dashboard.save()
-            except Exception as e:
-                print("{0} Could not write Grafana dashboard: {1}".format(Symbol.NOK_RED, e))
-            else:
-                print("{0} A Grafana dashboard has been successfully generated to {1}".format(Symbol.OK_GREEN, settings.grafana['filename']))
+        for dashboard in dashboards:
+            if settings.grafana['filename']:
+                try:
+                    filename = dashboard.save()
+                except Exception as e:
+                    print("{0} Could not write Grafana dashboard: {1}".format(Symbol.NOK_RED, e))
+                else:
+                    print("{0} A Grafana dashboard has been successfully generated to {1}".format(Symbol.OK_GREEN, filename))
     else:
         print("Then we're good! Have a nice day!")
 
@@ -126,12 +265,29 @@ if __name__ == "__main__":
     parser.set_defaults(interactive=True)
     parser.add_argument('--xml-temp-path', default=Defaults.MUNIN_XML_FOLDER,
                         help='set path where to store result of RRD exported files (default: %(default)s)')
+    parser.add_argument('--cache', action='store_true',
+                        help='cache parsed RRD data, unchanged RRD files are neither dumped nor parsed again on later '
+                             'runs')
+    parser.add_argument('--cache-path', default=Defaults.MUNIN_CACHE_FOLDER,
+                        help='set path where parsed RRD data is cached with --cache (default: %(default)s)')
     parser.add_argument('--keep-temp', action='store_true',
                         help='instruct to retain temporary files (mostly RRD\'s XML) after generation')
     parser.add_argument('-v', '--verbose', type=int, default=1,
                         help='set verbosity level (0: quiet, 1: default, 2: debug)')
     parser.add_argument('--fetch-config-path', default=Defaults.FETCH_CONFIG,
                         help='set output configuration file to be used but \'fetch\' command afterwards (default: %(default)s)')
+    parser.add_argument('--plan', action='store_true',
+                        help='only report the series, points and size the import would create for each schema, '
+                             'from RRD headers (nothing is dumped nor written)')
+    parser.add_argument('--plan-rates', nargs=3, type=float, metavar=('DUMP', 'PARSE', 'WRITE'),
+                        default=[DUMP_RATE, PARSE_RATE, WRITE_RATE],
+                        help='throughputs used by --plan to project the import time: RRD files dumped/s, '
+                             'points parsed/s and points written/s (default: %(default)s)')
+    parser.add_argument('--profile', metavar='DIR',
+                        help='record cProfile statistics of each stage to DIR and print the hottest functions')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='with --profile, also record the peak memory of each stage, and tracemalloc snapshots on '
+                             'Python 3.4+')
 
     # InfluxDB
     idbargs = parser.add_argument_group('InfluxDB parameters')
@@ -142,6 +298,33 @@ if __name__ == "__main__":
     parser.add_argument('--no-group-fields', dest='group_fields', action='store_false',
                         help='store each field in its own time series (cannot generate Grafana dashboard))')
     parser.set_defaults(group_fields=True)
+    idbargs.add_argument('--influxdb-target', action='append', metavar='HANDLE',
+                        help='other InfluxDB server to spread series over, by consistent hashing of domain/host/plugin '
+                             '(user, password, port and database default to the main one\'s); can be repeated')
+    idbargs.add_argument('--replicas', default=1, type=int,
+                        help='with --influxdb-target, number of servers each series is written to (default: %(default)s)')
+    idbargs.add_argument('--export', metavar='DIR',
+                        help='write line protocol files to DIR for "influx -import" instead of writing to InfluxDB '
+                             '(database name taken from the handle)')
+    idbargs.add_argument('--export-shards', default=1, type=int,
+                        help='with --export, split series across this many files (default: %(default)s)')
+    idbargs.add_argument('--export-gzip', action='store_true',
+                        help='with --export, gzip-compress the files')
+    idbargs.add_argument('--deadband', action='append', type=parse_rule, metavar='[PLUGIN[.FIELD]=]THRESHOLD[%]',
+                        help='drop values within THRESHOLD (absolute, or relative with %%) of the last written one, '
+                             'for all fields or matching plugins/fields (globs), also applied by fetch; can be repeated, '
+                             'the last matching rule wins. Example: --deadband 0 --deadband "df*=1%%"')
+    idbargs.add_argument('--deadband-heartbeat', default="1h", type=parse_duration, metavar='DURATION',
+                        help='with --deadband, still write a value once DURATION (like 30m or 6h) passed since the last '
+                             'written one (default: %(default)s)')
+    idbargs.add_argument('--aggregate', nargs='+', choices=FUNCTIONS, metavar='FUNCTION',
+                        help='also write the {0} of every plugin field across the hosts of each domain to '
+                             '"<measurement>_domain" series, at import and on every fetch'.format("/".join(FUNCTIONS)))
+    idbargs.add_argument('--integer-fields', action='store_true',
+                        help='write GAUGE fields whose values are all integral (on every host) as integers, compressed '
+                             'much better by InfluxDB; fetch then rounds their fresh values')
+    idbargs.add_argument('--telemetry', action='store_true',
+                        help='write import (and later fetch) timings and counters to the "munininfluxdb_internal" measurement')
 
     # Munin
     munargs = parser.add_argument_group('Munin parameters')
@@ -152,6 +335,74 @@ if __name__ == "__main__":
     munargs.add_argument('--rrd', '--munin-rrd-path', default=Defaults.MUNIN_RRD_FOLDER,
                          help='path to main Munin folder (default: %(default)s)')
 
+    # Remote Munin master
+    sshargs = parser.add_argument_group('Remote Munin master', 'import from another machine over a single SSH '
+                                                               'connection: --munin-path is read on the remote master, '
+                                                               'where "rrdtool dump" runs (--rrdtool-workers dumps at '
+                                                               'once, each on its own channel)')
+    sshargs.add_argument('--ssh', metavar='[USER@]HOST[:PORT]',
+                         help='Munin master to import from, requires paramiko (pip install paramiko)')
+    sshargs.add_argument('--ssh-key', metavar='FILE',
+                         help='private key to authenticate with (default: SSH agent and ~/.ssh/id_*)')
+    sshargs.add_argument('--ssh-password', action='store_true', help='ask for a password to authenticate with')
+    sshargs.add_argument('--ssh-no-compression', action='store_true',
+                         help='disable SSH compression, on by default as XML dumps compress very well')
+    sshargs.add_argument('--ssh-accept-unknown-host', action='store_true',
+                         help='accept and remember a host key missing from ~/.ssh/known_hosts')
+
+    # Selection
+    selargs = parser.add_argument_group('Selection', 'patterns are shell-style globs ("web*") or regular expressions '
+                                                     'between slashes ("/^db[0-9]+$/"), options can be repeated')
+    selargs.add_argument('--domain', action='append', metavar='PATTERN', help='only import matching domains')
+    selargs.add_argument('--host', action='append', metavar='PATTERN', help='only import matching hosts')
+    selargs.add_argument('--plugin', action='append', metavar='PATTERN', help='only import matching plugins')
+    selargs.add_argument('--field', action='append', metavar='PATTERN', help='only import matching fields')
+    selargs.add_argument('--since', type=parse_time, metavar='DATE',
+                         help='skip entries older than DATE: timestamp, YYYY-MM-DD[ HH:MM] (UTC) or duration like 90d')
+    selargs.add_argument('--until', type=parse_time, metavar='DATE', help='skip entries newer than DATE')
+    selargs.add_argument('--trim-to-retention', action='store_true',
+                         help='skip entries older than the default retention policy of the database would keep')
+
+    # Distributed import
+    distargs = parser.add_argument_group('Distributed import', 'machines sharing the Munin RRD tree each import a '
+                                                               'slice of the plugins, then a last run merges them')
+    distargs.add_argument('--shard', type=parse_shard, metavar='I/N',
+                          help='only import the plugins of shard I out of N (stable hash of domain/host/plugin), '
+                               'requires --checkpoint')
+    distargs.add_argument('--checkpoint', metavar='DIR',
+                          help='folder shared by all shards, where each one journals the fields it imported: '
+                               'a restarted shard skips them')
+    distargs.add_argument('--merge-shards', type=int, metavar='N',
+                          help='once the N shards completed, write the \'fetch\' configuration and Grafana dashboards '
+                               'of the whole import from the journals in --checkpoint (nothing is imported)')
+
+    # Resource limits
+    limargs = parser.add_argument_group('Resource limits', 'protect a live Munin master from a full speed import')
+    limargs.add_argument('--max-points-per-sec', type=int, metavar='N', help='cap on points written per second')
+    limargs.add_argument('--max-bytes-per-sec', type=int, metavar='N', help='cap on bytes written per second')
+    limargs.add_argument('--max-rrd-reads-per-sec', type=float, metavar='N', help='cap on RRD files dumped per second')
+    limargs.add_argument('--rrdtool-workers', default=1, type=int, metavar='N',
+                         help='number of concurrent "rrdtool dump" processes (default: %(default)s)')
+    limargs.add_argument('--memory-budget', type=parse_size, metavar='SIZE',
+                         help='memory the plugins being read and written may take together, like 512M, estimated from '
+                              'RRD headers: a plugin larger than that alone is joined by time windows spilled to '
+                              '--xml-temp-path and written window by window (default: unlimited)')
+    limargs.add_argument('--join-workers', default=1, type=int, metavar='N',
+                         help='number of plugins read and joined at once, largest first, within --memory-budget '
+                              '(default: %(default)s)')
+    limargs.add_argument('--nice', default=0, type=int, metavar='N',
+                         help='increase the niceness of the import and its rrdtool processes by N')
+    limargs.add_argument('--ionice', choices=sorted(IONICE_CLASSES),
+                         help='IO scheduling class of the import and its rrdtool processes ("ionice" command)')
+    limargs.add_argument('--adaptive', action='store_true',
+                         help='slow down while the load average or munin-update duration are above the limits below')
+    limargs.add_argument('--max-load', default=float(multiprocessing.cpu_count()), type=float,
+                         help='with --adaptive, 1 minute load average limit (default: %(default)s, number of CPUs)')
+    limargs.add_argument('--max-munin-update', default=MUNIN_UPDATE_LIMIT, type=float, metavar='SECONDS',
+                         help='with --adaptive, munin-update duration limit (default: %(default)s)')
+    limargs.add_argument('--munin-update-stats', default=MUNIN_UPDATE_STATS,
+                         help='munin-update statistics file holding its last duration (default: %(default)s)')
+
     # Grafana
     grafanargs = parser.add_argument_group('Grafana dashboard generation')
     grafanargs.add_argument('--grafana', dest='grafana', action='store_true',
@@ -167,14 +418,46 @@ if __name__ == "__main__":
                             help='path to output json file, will have to be imported manually to Grafana')
     grafanargs.add_argument('--grafana-cols', default=2, type=int, help='number of panel per row')
     grafanargs.add_argument('--grafana-tags', nargs='+', help='grafana dashboard tags')
+    grafanargs.add_argument('--grafana-manifest', default=Defaults.GRAFANA_MANIFEST,
+                            help='file recording the dashboards already uploaded, unchanged ones are skipped (default: %(default)s)')
+    grafanargs.add_argument('--grafana-force-upload', action='store_true',
+                            help='upload every dashboard even if unchanged since the last upload')
+    grafanargs.add_argument('--grafana-upload-workers', default=4, type=int,
+                            help='number of concurrent dashboard uploads (default: %(default)s)')
+    grafanargs.add_argument('--grafana-layout', choices=Dashboard.LAYOUTS, default="all",
+                            help='a single dashboard with every host, or one dashboard per plugin or per domain where '
+                                 'hosts are selected with template variables, better suited to large setups (default: %(default)s)')
 
     args = parser.parse_args()
+    if (args.shard or args.merge_shards) and not args.checkpoint:
+        parser.error("--shard and --merge-shards require --checkpoint")
+    if args.shard and args.merge_shards:
+        parser.error("--merge-shards is a separate run, without --shard")
+    if args.checkpoint and args.export:
+        parser.error("--checkpoint only applies to imports written to InfluxDB, not to --export")
+    if args.shard and args.shard[1] > 1 and args.integer_fields:
+        parser.error("--integer-fields decides field types from every host of a measurement: not supported with --shard")
+    if args.ssh and args.plan:
+        parser.error("--plan reads RRD headers locally: not supported with --ssh")
+    if args.shard and args.shard[1] > 1 and args.aggregate:
+        parser.error("--aggregate needs every host of a domain in the same run: not supported with --shard")
+    if args.aggregate and args.memory_budget:
+        parser.error("--aggregate keeps the rollups of every domain in memory until the end of the import: not "
+                     "supported with --memory-budget")
 
+    profiler = Profiler(args.profile, args.profile_memory) if args.profile else None
     try:
-        main(args)
+        main(args, profiler)
     except KeyboardInterrupt:
         print("\n{0} Canceled.".format(Symbol.NOK_RED))
         sys.exit(1)
     except Exception as e:
         print("{0} Error: {1}".format(Symbol.NOK_RED, e))
+        if args.verbose >= 2:
+            # exceptions of the --join-workers threads carry their own traceback
+            print(getattr(e, 'worker_traceback', None) or traceback.format_exc())
         sys.exit(1)
+    finally:
+        if profiler:
+            profiler.save("import")
+            profiler.print_summary()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import os
+import sys
+import json
+import argparse
+
+from munininfluxdb.utils import Symbol, parse_handle, parse_duration
+from munininfluxdb.defaults import Defaults
+from munininfluxdb.telemetry import Telemetry
+from munininfluxdb.lineprotocol import LineProtocolWriter, LineProtocolError, make_lines
+from munininfluxdb.rfetch import parse_munin_conf, MuninRunner
+
+# points sent per write request
+BATCH_SIZE = 5000
+
+
+def read_state(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def main(args):
+    telemetry = Telemetry("poll")
+
+    hosts = parse_munin_conf(args.munin_conf)
+    if args.host:
+        hosts = {name: entry for name, entry in hosts.items() if entry['host'] in args.host or name in args.host}
+    if not hosts:
+        print("{0} No host with an address found in {1}".format(Symbol.NOK_RED, args.munin_conf))
+        sys.exit(1)
+    print("{0} Found {1} hosts in {2}".format(Symbol.OK_GREEN, len(hosts), args.munin_conf))
+
+    influxdb = parse_handle(args.influxdb)
+    client = LineProtocolWriter(influxdb['host'], influxdb['port'], influxdb['user'], influxdb['password'],
+                                influxdb['database'] or "munin")
+    try:
+        client.ping()
+    except LineProtocolError as e:
+        print("  {0} Could not connect to database: {1}".format(Symbol.WARN_YELLOW, e))
+        sys.exit(1)
+
+    state = read_state(args.state)
+    runner = MuninRunner(hosts, state, args.concurrency, args.timeout, args.group_fields, args.spool, args.spool_backlog)
+    with telemetry.stage("poll"):
+        results = runner.run()
+
+    points = []
+    for host, host_points, error, duration in results:
+        if error:
+            print("  {0} Could not poll {1}: {2}".format(Symbol.NOK_RED, host, error))
+            telemetry.count("errors")
+        else:
+            points.extend(host_points)
+            telemetry.count("hosts")
+
+    # spooled samples span many intervals: batches are written oldest first
+    points.sort(key=lambda point: point['time'])
+
+    for start in range(0, len(points), BATCH_SIZE):
+        with telemetry.stage("serialize"):
+            body = make_lines(points[start:start + BATCH_SIZE])
+        try:
+            with telemetry.stage("write"):
+                client.write(body, precision='s')
+        except LineProtocolError as e:
+            print("  {0} Could not write data to database: {1}".format(Symbol.WARN_YELLOW, e))
+            telemetry.count("write_errors")
+        else:
+            telemetry.count("points", min(BATCH_SIZE, len(points) - start))
+            telemetry.count("bytes", len(body))
+
+    print("{0} Polled {1}/{2} hosts, written {3} points".format(Symbol.OK_GREEN if not telemetry.counters['errors'] else Symbol.WARN_YELLOW,
+                                                                 telemetry.counters['hosts'], len(hosts),
+                                                                 telemetry.counters['points']))
+    telemetry.print_summary()
+    if args.telemetry:
+        try:
+            client.write_points(telemetry.to_points(), precision='s')
+        except LineProtocolError as e:
+            print("  {0} Could not write telemetry: {1}".format(Symbol.WARN_YELLOW, e))
+
+    if telemetry.counters.get('write_errors'):
+        # samples and spool watermarks must not move past what was not written: next run retries from the same point
+        print("  {0} State not saved: {1}".format(Symbol.WARN_YELLOW, args.state))
+        return
+
+    # previous samples are needed to compute DERIVE/COUNTER rates on next run
+    with open(args.state, "w") as f:
+        json.dump(state, f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="""
+    'poll' command collects fresh values directly from the munin-node daemons (TCP 4949) listed in munin.conf
+    and writes them to InfluxDB, without relying on the Munin master update cycle nor its state files.
+
+    Run it periodically (e.g. every 5 minutes from cron): counters (DERIVE, COUNTER, ABSOLUTE) are converted to
+    rates from the previous run's samples, kept in the state file.
+
+    With --spool, nodes running munin-async return all the samples collected since the previous run, at their own
+    resolution: the state file then keeps a watermark per node.
+    """)
+    parser.add_argument('--munin-conf', default=Defaults.MUNIN_CONF,
+                        help='Munin master configuration listing the nodes to poll (default: %(default)s)')
+    parser.add_argument('--host', action='append', metavar='HOST',
+                        help='only poll this host (can be repeated)')
+    parser.add_argument('-c', '--influxdb', default="root@localhost:8086/db/munin",
+                        help='connection handle to InfluxDB server, format [user[:password]]@host[:port][/db] '
+                             '(default: %(default)s)')
+    parser.add_argument('--group-fields', dest='group_fields', action='store_true', default=True,
+                        help='group all fields of a plugin in the same InfluxDB measurement (default)')
+    parser.add_argument('--no-group-fields', dest='group_fields', action='store_false',
+                        help='make one measurement named after each field, holding a "value" field')
+    parser.add_argument('--concurrency', default=50, type=int,
+                        help='maximum number of nodes polled at the same time (default: %(default)s)')
+    parser.add_argument('--timeout', default=10, type=int,
+                        help='network timeout per node in seconds (default: %(default)s)')
+    parser.add_argument('--spool', action='store_true',
+                        help='on nodes running munin-async, read every sample spooled since the previous run '
+                             '("spoolfetch") instead of the current values')
+    parser.add_argument('--spool-backlog', default="1d", type=parse_duration,
+                        help='with --spool, how far back the first run of a node starts (default: %(default)s)')
+    parser.add_argument('--state', default=Defaults.POLL_STATE,
+                        help='file keeping field types and previous samples between runs (default: %(default)s)')
+    parser.add_argument('--telemetry', action='store_true',
+                        help='write poll timings and counters to the "munininfluxdb_internal" measurement')
+    args = parser.parse_args()
+
+    args.state = os.path.expanduser(args.state)
+    main(args)
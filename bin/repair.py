@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import sys
+import json
+import time
+import argparse
+from datetime import datetime
+from collections import defaultdict
+
+from munininfluxdb.utils import Symbol, Color, ProgressBar, parse_time, parse_duration
+from munininfluxdb.defaults import Defaults
+from munininfluxdb.telemetry import Telemetry
+from munininfluxdb.lineprotocol import LineProtocolWriter, LineProtocolError, make_lines
+from munininfluxdb.rrd import read_rrd_file, count_rrd_entries_per_bucket
+from munininfluxdb.deadband import Deadband
+
+# points sent per write request
+BATCH_SIZE = 5000
+
+
+def tags_key(tags):
+    return tags['domain'], tags['host'], tags['plugin']
+
+
+def list_series(config):
+    """
+    @return: {measurement: {(domain, host, plugin): (tags, {field: rrd_filename})}} from a 'fetch' configuration
+    """
+    series = defaultdict(dict)
+    for rrd_filename, (measurement, field) in config['metrics'].items():
+        # per measurement tags of older configurations are only right for a single host
+        tags = config.get('series', {}).get(rrd_filename) or config['tags'][measurement]
+        series[measurement].setdefault(tags_key(tags), (tags, {}))[1][field] = rrd_filename
+    return series
+
+
+def count_points(client, measurement, since, until, bucket):
+    """
+    Number of points of every series and field of a measurement per time bucket, with a single query
+
+    @return: {(domain, host, plugin): {field: {bucket start: count}}}
+    """
+    query = "SELECT COUNT(*) FROM \"{0}\" WHERE time >= {1}s AND time <= {2}s " \
+            "GROUP BY time({3}s), \"domain\", \"host\", \"plugin\"".format(measurement.replace('"', '\\"'),
+                                                                           since, until, bucket)
+    counts = defaultdict(lambda: defaultdict(dict))
+    for serie in client.query(query):
+        key = tags_key(serie['tags'])
+        for row in serie['values']:
+            # columns are "time", "count_<field>"...
+            for column, count in zip(serie['columns'][1:], row[1:]):
+                if count:
+                    counts[key][column[len("count_"):]][row[0]] = count
+    return counts
+
+
+def is_complete(rrd_filename, counts, bucket, since, until):
+    """
+    @param counts: {bucket start: count} of points in InfluxDB
+    @return: True if InfluxDB holds as many points as the RRD file has entries in every bucket, known from its header
+             without dumping it
+    """
+    try:
+        entries = count_rrd_entries_per_bucket(rrd_filename, bucket, since=since, until=until)
+    except Exception:
+        return False
+    return all(counts.get(start, 0) >= nb for start, nb in entries.items())
+
+
+def list_times(client, measurement, tags, fields, start, end):
+    """
+    Times of the points of a series holding each field, between start (included) and end (excluded)
+
+    @return: {field: set of times}
+    """
+    columns = ", ".join("\"{0}\"".format(field.replace('"', '\\"')) for field in fields)
+    conditions = " AND ".join("\"{0}\" = '{1}'".format(tag, tags[tag].replace("'", "\\'"))
+                              for tag in ("domain", "host", "plugin"))
+    query = "SELECT {0} FROM \"{1}\" WHERE {2} AND time >= {3}s AND time < {4}s".format(
+        columns, measurement.replace('"', '\\"'), conditions, start, end)
+    times = defaultdict(set)
+    for serie in client.query(query):
+        for row in serie['values']:
+            for column, value in zip(serie['columns'][1:], row[1:]):
+                if value is not None:
+                    times[column].add(row[0])
+    return times
+
+
+def find_missing(values, counts, bucket):
+    """
+    @param values: {time: value} read from the RRD file
+    @param counts: {bucket start: count} of points in InfluxDB
+    @return: set of bucket starts where InfluxDB holds fewer points than the RRD file has known values
+    """
+    expected = defaultdict(int)
+    for time_, value in values.items():
+        if value is not None:
+            expected[time_ - time_ % bucket] += 1
+    return {start for start, nb in expected.items() if counts.get(start, 0) < nb}
+
+
+def merge_ranges(starts, bucket):
+    """
+    @return: [(start, end), ...] of consecutive buckets
+    """
+    ranges = []
+    for start in sorted(starts):
+        if ranges and ranges[-1][1] == start:
+            ranges[-1][1] = start + bucket
+        else:
+            ranges.append([start, start + bucket])
+    return ranges
+
+
+def _format(timestamp):
+    return datetime.utcfromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M")
+
+
+def main(args):
+    telemetry = Telemetry("repair")
+    with open(args.config) as f:
+        config = json.load(f)
+        print("{0} Opened configuration: {1}".format(Symbol.OK_GREEN, f.name))
+
+    if config['influxdb'].get('targets'):
+        print("{0} Series are spread over several InfluxDB servers (fan-out), which 'repair' does not support "
+              "yet".format(Symbol.NOK_RED))
+        sys.exit(1)
+
+    client = LineProtocolWriter(config['influxdb']['host'],
+                                config['influxdb']['port'],
+                                config['influxdb']['user'],
+                                config['influxdb']['password'],
+                                config['influxdb']['database'])
+    try:
+        client.ping()
+    except LineProtocolError as e:
+        print("  {0} Could not connect to database: {1}".format(Symbol.WARN_YELLOW, e))
+        sys.exit(1)
+
+    now = int(time.time())
+    since = args.since if args.since is not None else now - 7*86400
+    # latest values may not have been fetched yet
+    until = args.until if args.until is not None else now - 900
+    print("Comparing RRD files and InfluxDB from {0} to {1} (UTC), by buckets of {2}s".format(_format(since), _format(until),
+                                                                                          args.bucket))
+
+    series = list_series(config)
+    integers = set(config.get('integers', ()))
+    group_fields = config['influxdb']['group_fields']
+    deadband = None
+    if config.get('deadband', {}).get('rules'):
+        # the rules 'fetch' applies, from a fresh state
+        deadband = Deadband(config['deadband']['rules'], config['deadband']['heartbeat'])
+    progress_bar = ProgressBar(max(len(config['metrics']), 1))
+    points, gaps, errors = [], [], []
+
+    for measurement in sorted(series):
+        try:
+            with telemetry.stage("query"):
+                counts = count_points(client, measurement, since, until, args.bucket)
+        except LineProtocolError as e:
+            errors.append("Could not count points of {0}: {1}".format(measurement, e))
+            progress_bar.update(sum(len(fields) for _, fields in series[measurement].values()))
+            continue
+
+        for key, (tags, fields) in sorted(series[measurement].items()):
+            rows = defaultdict(dict)
+            missing_buckets = set()
+            # {field: {time: value}} of the fields with missing buckets
+            contents = {}
+
+            for field, rrd_filename in sorted(fields.items()):
+                progress_bar.update()
+                # fields are written as "value" of a measurement per field when not grouped, the deadband rules
+                # match the latter
+                name = field if group_fields else measurement
+                rule = deadband.rule(tags['plugin'], name) if deadband else None
+                if rule is None and is_complete(rrd_filename, counts[key][field], args.bucket, since, until):
+                    # no gap possible, not even dumped
+                    telemetry.count("complete_files")
+                    continue
+
+                try:
+                    with telemetry.stage("dump"):
+                        values = read_rrd_file(rrd_filename, args.xml_temp_path, since, until)
+                except Exception as e:
+                    errors.append("Could not read {0}: {1}".format(rrd_filename, e))
+                    continue
+
+                if rule:
+                    # values 'fetch' dropped within the deadband are not missing
+                    with telemetry.stage("deadband"):
+                        values = dict(deadband.compress_series(tags['plugin'], ['time', name],
+                                                               [[time_, values[time_]] for time_ in sorted(values)]))
+
+                missing = find_missing(values, counts[key][field], args.bucket)
+                if missing:
+                    contents[field] = values
+                    missing_buckets.update(missing)
+
+            ranges = merge_ranges(missing_buckets, args.bucket)
+            covered = defaultdict(set)
+            try:
+                with telemetry.stage("query"):
+                    for start, end in ranges:
+                        for field, times in list_times(client, measurement, tags, sorted(contents), start, end).items():
+                            covered[field].update(times)
+            except LineProtocolError as e:
+                errors.append("Could not list points of {0} ({1}/{2}): {3}".format(measurement, tags['domain'],
+                                                                                  tags['host'], e))
+                continue
+
+            for field, values in contents.items():
+                for time_, value in values.items():
+                    # only the times InfluxDB does not hold yet, within the buckets missing points
+                    if value is not None and time_ - time_ % args.bucket in missing_buckets \
+                            and time_ not in covered[field]:
+                        # same field type as the import
+                        rows[time_][field] = int(round(value)) if fields[field] in integers else value
+
+            if rows:
+                gaps.append((measurement, tags, ranges, len(rows)))
+                points.extend({
+                    "measurement": measurement,
+                    "tags": tags,
+                    "time": time_,
+                    "fields": fields_values,
+                } for time_, fields_values in sorted(rows.items()))
+
+    print("\n{0}Gaps found{1}: {2} series, {3} points to backfill".format(Color.BOLD, Color.CLEAR, len(gaps), len(points)))
+    for measurement, tags, ranges, nb_points in gaps:
+        print("  - {0} ({1}/{2}): {3} points in {4}".format(measurement, tags['domain'], tags['host'], nb_points,
+                                                             ", ".join("{0} -> {1}".format(_format(start), _format(end))
+                                                                       for start, end in ranges)))
+
+    if not args.dry_run:
+        for start in range(0, len(points), BATCH_SIZE):
+            with telemetry.stage("serialize"):
+                body = make_lines(points[start:start + BATCH_SIZE])
+            try:
+                with telemetry.stage("write"):
+                    client.write(body, precision='s')
+            except LineProtocolError as e:
+                errors.append("Could not write data to database: {0}".format(e))
+            else:
+                telemetry.count("points", min(BATCH_SIZE, len(points) - start))
+                telemetry.count("bytes", len(body))
+        if points:
+            print("{0} Backfilled {1} points".format(Symbol.OK_GREEN, telemetry.counters['points']))
+
+    for error in errors:
+        print("  {0} {1}".format(Symbol.NOK_RED, error))
+    telemetry.count("errors", len(errors))
+    telemetry.print_summary()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="""
+    'repair' command finds the holes left in InfluxDB by 'fetch' outages, while values are still available in Munin's
+    RRD files, and uploads only the missing ranges.
+
+    For each series of the 'fetch' configuration, points are counted per time bucket in InfluxDB (one query per
+    measurement) and compared with the entries of the RRD file headers over the same period: only the RRD files of
+    fields missing points are dumped, their known values (less those the deadband rules drop) being compared again.
+    In the buckets still missing points, only the times InfluxDB does not hold are written.
+    """)
+    parser.add_argument('--config', default=Defaults.FETCH_CONFIG,
+                        help='overrides the default configuration file (default: %(default)s)')
+    parser.add_argument('--since', type=parse_time, metavar='DATE',
+                        help='start of the checked period: timestamp, YYYY-MM-DD[ HH:MM] (UTC) or duration like 30d '
+                             '(default: 7 days ago)')
+    parser.add_argument('--until', type=parse_time, metavar='DATE',
+                        help='end of the checked period (default: 15 minutes ago)')
+    parser.add_argument('--bucket', default="1h", type=parse_duration,
+                        help='size of the time buckets compared, like 30m or 1h (default: %(default)s)')
+    parser.add_argument('--xml-temp-path', default=Defaults.MUNIN_XML_FOLDER,
+                        help='set path where to store result of RRD exported files (default: %(default)s)')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='only report the gaps, nothing is written')
+    args = parser.parse_args()
+
+    try:
+        main(args)
+    except KeyboardInterrupt:
+        print("\n{0} Canceled.".format(Symbol.NOK_RED))
+        sys.exit(1)
@@ -0,0 +1,101 @@
+"""
+Domain-level rollups
+
+Fleet-wide views (total CPU, network of a whole domain) would otherwise aggregate hundreds of host series on every
+dashboard refresh: the sum/mean/max of each plugin field across the hosts of a domain are computed once, at import
+and on every fetch, and written to their own "<measurement>_domain" series tagged with "domain", "plugin" and
+"aggregate" (no "host" tag), with the same field names as the host series.
+"""
+from collections import defaultdict
+
+FUNCTIONS = ("sum", "mean", "max")
+MEASUREMENT_SUFFIX = "_domain"
+
+
+class DomainAggregator:
+    """
+    @param functions: subset of FUNCTIONS
+    @param step: if set, timestamps are rounded down to a multiple of step so that hosts updated at slightly
+                 different times of the same cycle share a bucket (fetch). RRD entries are already aligned (import).
+                 Only the latest bucket is then kept: a host last updated in a previous cycle would otherwise be
+                 aggregated alone and overwrite the complete aggregate written for that cycle.
+    """
+    def __init__(self, functions=FUNCTIONS, step=None):
+        self.functions = functions
+        self.step = step
+        # {(domain, plugin, measurement): {time: {field: [sum, count, max]}}}
+        self.accumulators = defaultdict(lambda: defaultdict(dict))
+        # with step: latest bucket, and number of samples of older ones left out
+        self.current = None
+        self.stale = 0
+
+    def add(self, domain, plugin, measurement, time, fields):
+        """
+        @param fields: {field: value} of a host at time, None values are ignored
+        """
+        if self.step:
+            time -= time % self.step
+            if self.current is not None and time < self.current:
+                self.stale += 1
+                return
+            if self.current is not None and time > self.current:
+                # what was added so far belongs to a previous cycle
+                self.stale += sum(accumulated[1] for buckets in self.accumulators.values()
+                                  for fields in buckets.values() for accumulated in fields.values())
+                self.accumulators.clear()
+            self.current = time
+
+        accumulator = self.accumulators[(domain, plugin, measurement)][time]
+        for field, value in fields.items():
+            if value is None:
+                continue
+            if field in accumulator:
+                current = accumulator[field]
+                current[0] += value
+                current[1] += 1
+                current[2] = max(current[2], value)
+            else:
+                accumulator[field] = [value, 1, value]
+
+    def add_series(self, domain, plugin, measurement, field_names, rows):
+        """
+        @param field_names, rows: ['time', field, ...] and [[time, value, ...], ...] as in InfluxdbClient.write_series()
+        """
+        for row in rows:
+            self.add(domain, plugin, measurement, row[0], dict(zip(field_names[1:], row[1:])))
+
+    @staticmethod
+    def _compute(function, accumulated):
+        # always floats: hosts may mix integer and float fields, InfluxDB field types must not change
+        total, count, maximum = accumulated
+        if function == "sum":
+            return float(total)
+        elif function == "mean":
+            return total / float(count)
+        else:
+            return float(maximum)
+
+    def iter_series(self):
+        """
+        @return: generator of (measurement, tags, field_names, rows), one series per domain, plugin and function
+        """
+        for (domain, plugin, measurement), accumulator in sorted(self.accumulators.items()):
+            field_names = ['time'] + sorted(set(field for fields in accumulator.values() for field in fields))
+            tags = {"domain": domain, "plugin": plugin}
+
+            for function in self.functions:
+                rows = [[time] + [DomainAggregator._compute(function, fields[field]) if field in fields else None
+                                  for field in field_names[1:]]
+                        for time, fields in sorted(accumulator.items())]
+                yield measurement + MEASUREMENT_SUFFIX, dict(tags, aggregate=function), field_names, rows
+
+    def to_points(self):
+        """
+        @return: list of points in the InfluxDB client's JSON format
+        """
+        return [{
+            "measurement": measurement,
+            "tags": tags,
+            "time": row[0],
+            "fields": {field: value for field, value in zip(field_names[1:], row[1:]) if value is not None},
+        } for measurement, tags, field_names, rows in self.iter_series() for row in rows]
@@ -0,0 +1,96 @@
+"""
+Columnar cache of parsed RRD data
+
+"rrdtool dump" and XML parsing dominate an import: the parsed series of every RRD file is saved to a compact binary
+file so that later runs (retries, other schema, second InfluxDB, file export...) skip both.
+
+One file per RRD, named after a hash of its path, modification time and size (any update invalidates it). The RRD
+file is only stat'ed once per run: its entry does not move if the file is updated between has(), put() and get().
+    header   "MICACHE1" + number of entries (uint32), little-endian
+    times    float64 array, sorted
+    values   float64 array, NaN for unknown values
+Arrays have a fixed layout and can be memory-mapped.
+"""
+import os
+import sys
+import math
+import errno
+import struct
+import hashlib
+from array import array
+
+MAGIC = "MICACHE1"
+HEADER = struct.Struct("<8sI")
+
+
+class SeriesCache:
+    """
+    @param stat: os.stat() like function, the one of remote.RemoteMaster for RRD files read over SSH
+    @param namespace: prefix of the keys, the remote host name so that masters sharing paths do not collide
+    """
+    def __init__(self, folder, stat=os.stat, namespace=""):
+        self.folder = folder
+        self.stat = stat
+        self.namespace = namespace
+        # {rrd filename: cache filename}
+        self.keys = {}
+
+    def filename(self, rrd_filename):
+        if rrd_filename not in self.keys:
+            stat = self.stat(rrd_filename)
+            key = "{0}{1}:{2}:{3}".format(self.namespace, os.path.abspath(rrd_filename), int(stat.st_mtime),
+                                          stat.st_size)
+            self.keys[rrd_filename] = os.path.join(self.folder, hashlib.sha1(key).hexdigest() + ".bin")
+        return self.keys[rrd_filename]
+
+    def has(self, rrd_filename):
+        try:
+            return os.path.exists(self.filename(rrd_filename))
+        except (IOError, OSError):
+            return False
+
+    def get(self, rrd_filename):
+        """
+        @return: {time: value} as returned by rrd.read_xml_file(), None if not cached
+        """
+        try:
+            with open(self.filename(rrd_filename), "rb") as f:
+                magic, count = HEADER.unpack(f.read(HEADER.size))
+                if magic != MAGIC:
+                    return None
+                times, values = array('d'), array('d')
+                times.fromfile(f, count)
+                values.fromfile(f, count)
+        except (IOError, OSError, EOFError, struct.error):
+            return None
+
+        if sys.byteorder != "little":
+            times.byteswap()
+            values.byteswap()
+
+        return {int(time): None if math.isnan(value) else value for time, value in zip(times, values)}
+
+    def put(self, rrd_filename, content):
+        """
+        @param content: {time: value} as returned by rrd.read_xml_file()
+        """
+        try:
+            os.makedirs(self.folder)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        ordered = sorted(content)
+        times = array('d', ordered)
+        values = array('d', (float('nan') if content[time] is None else content[time] for time in ordered))
+        if sys.byteorder != "little":
+            times.byteswap()
+            values.byteswap()
+
+        filename = self.filename(rrd_filename)
+        # written aside then renamed: an interrupted run never leaves a truncated entry
+        with open(filename + ".tmp", "wb") as f:
+            f.write(HEADER.pack(MAGIC, len(times)))
+            times.tofile(f)
+            values.tofile(f)
+        os.rename(filename + ".tmp", filename)
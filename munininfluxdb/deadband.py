@@ -0,0 +1,105 @@
+"""
+Deadband (change-only) compression
+
+Many Munin values (disk sizes, mostly idle counters...) stay constant for days: a value within the deadband of the
+last written one is dropped, except once 'heartbeat' seconds passed since the last written value and on the first value
+after a gap (unknown value), so that graphs and last() queries stay correct.
+"""
+from utils import match_patterns
+
+# default seconds after which a value is written even if unchanged
+HEARTBEAT = 3600
+
+
+def parse_rule(spec):
+    """
+    @param spec: "[plugin[.field]=]threshold[%]", plugin and field being glob or /regex/ patterns
+    @return: {"plugin": pattern, "field": pattern, "threshold": float, "relative": bool}
+
+    @example
+        parse_rule("0") -> only drop exact repetitions, for every field
+        parse_rule("df*=1%") -> changes of less than 1% of disk plugins values
+        parse_rule("uptime.uptime=3600")
+    """
+    target, _, threshold = spec.rpartition("=")
+    plugin, _, field = target.partition(".")
+    relative = threshold.endswith("%")
+    try:
+        threshold = float(threshold.rstrip("%"))
+    except ValueError:
+        raise ValueError("Invalid deadband: {0} (expected [plugin[.field]=]threshold[%])".format(spec))
+
+    return {
+        "plugin": plugin or "*",
+        "field": field or "*",
+        "threshold": threshold,
+        "relative": relative,
+    }
+
+
+class Deadband:
+    """
+    @param rules: list of rules as returned by parse_rule(), the last matching one wins
+    @param heartbeat: seconds after which a value is written even if unchanged
+    @param state: {key: [last written value, its time]}, kept between calls (and 'fetch' runs)
+    """
+    def __init__(self, rules, heartbeat=HEARTBEAT, state=None):
+        self.rules = rules
+        self.heartbeat = heartbeat
+        self.state = state if state is not None else {}
+        self.dropped = 0
+
+    def rule(self, plugin, field):
+        for rule in reversed(self.rules):
+            if match_patterns(plugin, [rule['plugin']]) and match_patterns(field, [rule['field']]):
+                return rule
+        return None
+
+    def keep(self, key, rule, value, time):
+        """
+        @param time: timestamp of value
+        @return: True if value must be written
+        """
+        if value is None:
+            # gap: next known value is written
+            self.state.pop(key, None)
+            return True
+
+        state = self.state.get(key)
+        if state is None or state[0] is None or time - state[1] >= self.heartbeat:
+            self.state[key] = [value, time]
+            return True
+
+        last = state[0]
+        threshold = rule['threshold'] * abs(last) / 100. if rule['relative'] else rule['threshold']
+        if abs(value - last) > threshold:
+            self.state[key] = [value, time]
+            return True
+
+        self.dropped += 1
+        return False
+
+    def compress_series(self, plugin, field_names, rows, resume=False, last=True):
+        """
+        Replaces the values within the deadband by None, in place
+
+        @param field_names: ['time', field, ...] as in InfluxdbClient.write_series()
+        @param rows: [[time, value, ...], ...] sorted by time
+        @param resume, last: rows are a time window of a series, following the previous one (resume) or ending the
+                             series (last), the state being kept across windows
+        """
+        for column, field in enumerate(field_names[1:], 1):
+            rule = self.rule(plugin, field)
+            if rule is None:
+                continue
+
+            # whole series at once: no state from a previous one
+            key = (plugin, field)
+            if not resume:
+                self.state.pop(key, None)
+            for row in rows:
+                if not self.keep(key, rule, row[column], row[0]):
+                    row[column] = None
+            if last:
+                self.state.pop(key, None)
+        return rows
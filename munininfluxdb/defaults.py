@@ -0,0 +1,29 @@
+"""
+Default paths and RRD constants, without dependencies: imported by 'fetch' on every cron run
+"""
+from os.path import expanduser
+
+# RRD types, by RRD filename suffix
+DATA_TYPES = {
+    'a': 'ABSOLUTE',
+    'c': 'COUNTER',
+    'd': 'DERIVE',
+    'g': 'GAUGE',
+}
+
+
+class Defaults:
+    MUNIN_RRD_FOLDER = "/var/lib/munin"
+    MUNIN_VAR_FOLDER = "/var/lib/munin"
+    MUNIN_WWW_FOLDER = "/var/cache/munin/www"
+    MUNIN_DATAFILE = "/var/lib/munin/datafile"
+    MUNIN_CONF = "/etc/munin/munin.conf"
+
+    TEMP_FOLDER = "/tmp/munin-influxdb"
+    FETCH_CONFIG = expanduser("~")+"/.config/munin-fetch-config.json"
+    GRAFANA_MANIFEST = expanduser("~")+"/.config/munin-grafana-manifest.json"
+    POLL_STATE = expanduser("~")+"/.config/munin-poll-state.json"
+    MUNIN_XML_FOLDER = TEMP_FOLDER+"/xml"
+    MUNIN_CACHE_FOLDER = TEMP_FOLDER+"/cache"
+
+    DEFAULT_RRD_INDEX = 42
@@ -0,0 +1,89 @@
+from __future__ import print_function
+import os
+import gzip
+import zlib
+import tempfile
+
+from lineprotocol import make_lines
+
+
+class LineProtocolFiles:
+    """
+    Writes series to sharded line protocol files, to be loaded with "influx -import -precision=s" (add "-compressed"
+    for gzip files) or copied to another site.
+
+    Every series lands in a single shard, picked from a hash of its measurement and tags. Within a shard, series are
+    written sorted by key then time, which is the order TSM files are compacted to: series blocks are first appended
+    to a temporary file as they come, then copied in order on close.
+
+    @example
+        files = LineProtocolFiles("/tmp/export", "munin", shards=4, compress=True)
+        files.write_points(points)
+        filenames = files.close()
+    """
+    def __init__(self, folder, database, shards=1, compress=False, retention_policy="autogen"):
+        self.folder = folder
+        self.database = database
+        self.shards = max(int(shards), 1)
+        self.compress = compress
+        self.retention_policy = retention_policy
+
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        # per shard: temporary file and {series key: [(offset, length), ...]}
+        self._spools = [tempfile.TemporaryFile(dir=folder) for _ in range(self.shards)]
+        self._index = [{} for _ in range(self.shards)]
+
+    @staticmethod
+    def series_key(point):
+        tags = ",".join("{0}={1}".format(tag, value) for tag, value in sorted(point.get('tags', {}).items()))
+        return u"{0},{1}".format(point['measurement'], tags)
+
+    def shard(self, key):
+        # stable across runs and Python versions, unlike hash()
+        return (zlib.crc32(key.encode('utf-8')) & 0xffffffff) % self.shards
+
+    def write_points(self, points):
+        """
+        @param points: points of a single series, in the InfluxDB client's JSON format
+        @return: size of the serialized points
+        """
+        if not points:
+            return 0
+
+        key = self.series_key(points[0])
+        shard = self.shard(key)
+        data = make_lines(sorted(points, key=lambda point: point['time']))
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+
+        spool = self._spools[shard]
+        spool.seek(0, os.SEEK_END)
+        self._index[shard].setdefault(key, []).append((spool.tell(), len(data)))
+        spool.write(data)
+
+        return len(data)
+
+    def _filename(self, shard):
+        return os.path.join(self.folder, "{0}-{1:04d}.lp{2}".format(self.database, shard, ".gz" if self.compress else ""))
+
+    def close(self):
+        """
+        @return: list of written files
+        """
+        filenames = []
+        for shard, (spool, index) in enumerate(zip(self._spools, self._index)):
+            filename = self._filename(shard)
+            output = gzip.open(filename, "wb") if self.compress else open(filename, "wb")
+            with output:
+                output.write("# DDL\nCREATE DATABASE {0}\n\n# DML\n# CONTEXT-DATABASE: {0}\n"
+                             "# CONTEXT-RETENTION-POLICY: {1}\n\n".format(self.database, self.retention_policy))
+                for key in sorted(index):
+                    for offset, length in index[key]:
+                        spool.seek(offset)
+                        output.write(spool.read(length))
+            spool.close()
+            filenames.append(filename)
+
+        return filenames
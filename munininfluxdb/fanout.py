@@ -0,0 +1,325 @@
+"""
+Write fan-out across several InfluxDB servers
+
+Series are spread over the targets with consistent hashing on their domain/host/plugin key, each one being written
+to 'replicas' distinct targets. Adding a target only moves about 1/N of the series, and the mapping used at import is
+saved to the 'fetch' configuration so that fresh values keep going where the history is.
+
+Every target has its own small pool of keep-alive connections and its own bounded retry queue: a failing server
+does not drop the writes of the others, and a series is only reported written (see FanoutWriter.completed()) once all
+its payloads were accepted by all its targets.
+"""
+import time
+import bisect
+import hashlib
+from Queue import Queue
+from threading import Lock
+from collections import deque, defaultdict
+from multiprocessing.pool import ThreadPool
+
+from lineprotocol import LineProtocolWriter, LineProtocolError, make_lines
+
+# bytes of failed payloads a target queues before writes wait for it
+MAX_PENDING = 64 * 1024 * 1024
+# seconds a failing target is waited for before payloads are given up
+MAX_WAIT = 600
+# seconds between retries, doubled after each failed one
+BACKOFF = 0.5
+MAX_BACKOFF = 30
+
+
+def target_name(target):
+    return "{0}:{1}".format(target['host'], target['port'] or 8086)
+
+
+def list_targets(influxdb):
+    """
+    @param influxdb: main connection settings, holding the other targets in "targets"
+    @return: handles of every target, the main one first, missing port/user/password taken from the main one
+    """
+    targets = [influxdb]
+    for target in influxdb.get('targets') or []:
+        targets.append({key: target.get(key) or influxdb.get(key) for key in ("host", "port", "user", "password")})
+    return targets
+
+
+def series_key(tags):
+    return u"{0}/{1}/{2}".format(tags.get('domain', ""), tags.get('host', ""), tags.get('plugin', ""))
+
+
+class HashRing:
+    """
+    Consistent hashing ring, each node being placed at 'vnodes' positions to even out the distribution
+    """
+    VNODES = 64
+
+    def __init__(self, nodes, vnodes=VNODES):
+        self.nodes = list(nodes)
+        self.ring = sorted((HashRing._hash(u"{0}#{1}".format(node, index)), node)
+                           for node in self.nodes for index in range(vnodes))
+        self.positions = [position for position, _ in self.ring]
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+    def lookup(self, key, count=1):
+        """
+        @return: the 'count' distinct nodes following key on the ring
+        """
+        count = min(count, len(self.nodes))
+        found = []
+        start = bisect.bisect(self.positions, HashRing._hash(key))
+        for offset in range(len(self.ring)):
+            node = self.ring[(start + offset) % len(self.ring)][1]
+            if node not in found:
+                found.append(node)
+                if len(found) == count:
+                    break
+        return found
+
+
+class TargetWriter:
+    """
+    A single InfluxDB server: pool of 'pool_size' connections and queue of the payloads to retry
+
+    Failed payloads are sent again, oldest first, before the next ones, waiting longer after each failed attempt (up
+    to MAX_BACKOFF). While more than 'max_pending' bytes are queued, write() blocks retrying them: the import slows down
+    to what the server takes. Once the server failed for more than 'max_wait' seconds, the oldest payloads beyond the
+    bound are given up rather than waited for.
+
+    @param on_result: called as on_result(tag, written) for every payload, once written or given up
+    """
+    def __init__(self, target, database, pool_size=2, timeout=10, max_pending=MAX_PENDING, max_wait=MAX_WAIT,
+                 on_result=None):
+        self.name = target_name(target)
+        self.database = database
+        self.pool = Queue()
+        for _ in range(pool_size):
+            self.pool.put(LineProtocolWriter(target['host'], target['port'], target['user'], target['password'],
+                                             database, timeout))
+        self.max_pending = max_pending
+        self.max_wait = max_wait
+        self.on_result = on_result or (lambda tag, written: None)
+
+        # (data, tag) of the payloads to retry, oldest first, and their size
+        self.retries = deque()
+        self.pending = 0
+        self.failing_since = None
+        self.next_retry = 0
+        self.backoff = BACKOFF
+        self.retried = 0
+        self.dropped = 0
+
+    def _call(self, method, *args):
+        writer = self.pool.get()
+        try:
+            return getattr(writer, method)(*args)
+        finally:
+            self.pool.put(writer)
+
+    def ping(self):
+        self._call("ping")
+
+    def create_database(self):
+        self._call("create_database", self.database)
+
+    def _send(self, data, tag):
+        try:
+            self._call("write", data, 's')
+        except LineProtocolError:
+            return False
+        self.on_result(tag, True)
+        return True
+
+    def _retry(self):
+        """
+        Sends the queued payloads again, oldest first, up to the first failure
+
+        @return: True once the queue is empty
+        """
+        while self.retries:
+            data, tag = self.retries[0]
+            self.retried += 1
+            if not self._send(data, tag):
+                self.next_retry = time.time() + self.backoff
+                self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+                return False
+            self.retries.popleft()
+            self.pending -= len(data)
+
+        self.failing_since = None
+        self.backoff = BACKOFF
+        return True
+
+    def _give_up(self):
+        data, tag = self.retries.popleft()
+        self.pending -= len(data)
+        self.dropped += 1
+        self.on_result(tag, False)
+
+    def write(self, data, tag=None):
+        """
+        @param tag: passed to on_result()
+        @return: True if written, False if queued for retry
+        """
+        if self.retries and time.time() >= self.next_retry:
+            self._retry()
+        # payloads are written in order: after the queued ones
+        if not self.retries and self._send(data, tag):
+            return True
+
+        if self.failing_since is None:
+            self.failing_since = time.time()
+            self.next_retry = time.time() + self.backoff
+        self.retries.append((data, tag))
+        self.pending += len(data)
+
+        while self.pending > self.max_pending and len(self.retries) > 1:
+            if time.time() - self.failing_since > self.max_wait:
+                # down for too long: make room rather than stall the whole import
+                while self.pending > self.max_pending and len(self.retries) > 1:
+                    self._give_up()
+                break
+            time.sleep(max(0, self.next_retry - time.time()))
+            self._retry()
+        return False
+
+    def flush(self, max_wait=None):
+        """
+        Sends the queued payloads again until they are all written or 'max_wait' seconds passed
+
+        @return: number of payloads given up
+        """
+        deadline = time.time() + (self.max_wait if max_wait is None else max_wait)
+        while self.retries and time.time() < deadline:
+            time.sleep(max(0, min(self.next_retry, deadline) - time.time()))
+            self._retry()
+
+        dropped = len(self.retries)
+        while self.retries:
+            self._give_up()
+        return dropped
+
+
+class FanoutWriter:
+    """
+    @param targets: connection handles as returned by utils.parse_handle()
+    @param replicas: number of targets each series is written to
+    @param mapping: {series key: [target name, ...]} of a previous run, kept for the series it covers
+
+    @example
+        writer = FanoutWriter([parse_handle("db1:8086"), parse_handle("db2:8086")], "munin", replicas=2)
+        writer.write_points(points, tag="series")
+        errors = writer.flush()
+        written = writer.completed()
+    """
+    def __init__(self, targets, database, replicas=1, mapping=None, pool_size=2, timeout=10, max_pending=MAX_PENDING,
+                 max_wait=MAX_WAIT):
+        self.targets = [TargetWriter(target, database, pool_size, timeout, max_pending, max_wait, self._on_result)
+                        for target in targets]
+        self.by_name = {target.name: target for target in self.targets}
+        self.replicas = max(1, min(replicas, len(self.targets)))
+        self.ring = HashRing(self.by_name)
+        self.mapping = mapping if mapping is not None else {}
+        self.pool = ThreadPool(len(self.targets))
+
+        # {tag: payloads neither written nor given up yet}, tags with a payload given up, tags all written
+        self.lock = Lock()
+        self.pending = {}
+        self.failed = set()
+        self.written = []
+
+    def _on_result(self, tag, written):
+        if tag is None:
+            return
+        with self.lock:
+            if not written:
+                self.failed.add(tag)
+            self.pending[tag] -= 1
+            if not self.pending[tag]:
+                del self.pending[tag]
+                if tag in self.failed:
+                    self.failed.discard(tag)
+                else:
+                    self.written.append(tag)
+
+    def route(self, tags):
+        """
+        @return: names of the targets a series is written to
+        """
+        key = series_key(tags)
+        names = [name for name in self.mapping.get(key, []) if name in self.by_name]
+        if len(names) < self.replicas:
+            names = self.ring.lookup(key, self.replicas)
+            self.mapping[key] = names
+        return names
+
+    def _each(self, func, targets=None):
+        return self.pool.map(func, self.targets if targets is None else targets)
+
+    def ping(self):
+        """
+        @return: list of (target name, error) of the unreachable targets
+        """
+        def _ping(target):
+            try:
+                target.ping()
+            except LineProtocolError as e:
+                return target.name, e
+        return [result for result in self._each(_ping) if result]
+
+    def create_database(self):
+        self._each(lambda target: target.create_database())
+
+    def write_points(self, points, precision='s', tag=None, last=True):
+        """
+        Writes each point to the targets of its series, all targets at once
+
+        @param tag: hashable naming these points, returned by completed() once all their payloads were written
+        @param last: False if more points are written with the same tag (windows of a series), the tag is not
+                     completed before the call with last=True
+        @return: size of the payloads sent, replicas included
+        """
+        assert precision == 's'
+        batches = defaultdict(list)
+        for point in points:
+            for name in self.route(point.get('tags', {})):
+                batches[name].append(point)
+
+        payloads = [(self.by_name[name], make_lines(batch)) for name, batch in batches.items()]
+        payloads = [(target, data) for target, data in payloads if data]
+        if tag is not None:
+            with self.lock:
+                # one more held by the tag itself until its last points
+                self.pending[tag] = self.pending.get(tag, 1) + len(payloads)
+        self._each(lambda payload: payload[0].write(payload[1], tag), payloads)
+        if tag is not None and last:
+            self._on_result(tag, True)
+        return sum(len(data) for _, data in payloads)
+
+    def completed(self):
+        """
+        @return: tags whose payloads were all written, since the previous call
+        """
+        with self.lock:
+            written, self.written = self.written, []
+        return written
+
+    @property
+    def retried(self):
+        """
+        @return: number of payloads sent again, all targets together
+        """
+        return sum(target.retried for target in self.targets)
+
+    def flush(self, max_wait=None):
+        """
+        @param max_wait: seconds each failing target is retried for, the targets' own 'max_wait' if None
+        @return: list of (target name, number of payloads given up), during the run included
+        """
+        self._each(lambda target: target.flush(max_wait))
+        return [(target.name, target.dropped) for target in self.targets if target.dropped]
+
+    def close(self):
+        self.pool.close()
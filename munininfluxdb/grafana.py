@@ -1,7 +1,12 @@
 from __future__ import print_function
 
+import os
+import errno
 import json
+import hashlib
 import urlparse
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from utils import ProgressBar, Color, Symbol
 from pprint import pprint
@@ -9,6 +14,7 @@ from settings import Settings
 from influxdbclient import InfluxdbClient
 
 import requests
+from requests.adapters import HTTPAdapter
 
 class Query:
     DEFAULT_FUNC = "mean"
@@ -18,6 +24,13 @@ class Query:
         self.measurement = measurement
         self.field = field
         self.alias = self.field
+        self.tags = []
+
+    def add_tag_filter(self, key, value, operator="="):
+        tag = {"key": key, "operator": operator, "value": value}
+        if self.tags:
+            tag["condition"] = "AND"
+        self.tags.append(tag)
 
     def to_json(self, settings):
         return {
@@ -31,6 +44,7 @@ class Query:
                 {"params": ["$interval"], "type": "time"},
                 {"params": ["null"], "type": "fill"}
             ],
+            "tags": self.tags,
             "resultFormat": "time_series",
             "alias": self.alias
         }
@@ -48,9 +62,14 @@ class Panel:
         self.thresholds = {}
         self.width = 6
         self.linewidth = 1
+        self.repeat = None
+        # tag filters applied to every query, i.e. template variables
+        self.tag_filters = []
 
     def add_query(self, field):
         query = Query(self.measurement, field)
+        for key, value, operator in self.tag_filters:
+            query.add_tag_filter(key, value, operator)
         self.queries.append(query)
         return query
 
@@ -172,6 +191,7 @@ class Panel:
             "aliasColors": self.alias_colors,
             "leftYAxisLabel": self.leftYAxisLabel,
             "linewidth": self.linewidth,
+            "repeat": self.repeat,
         }
 
 class HeaderPanel(Panel):
@@ -215,12 +235,43 @@ class Row:
             "showTitle": len(self.title) > 0
         }
 
+class Template:
+    """
+    Grafana template variable listing the values of an InfluxDB tag
+    """
+    def __init__(self, name, query, multi=False):
+        self.name = name
+        self.query = query
+        self.multi = multi
+
+    def to_json(self, settings):
+        return {
+            "name": self.name,
+            "label": self.name.capitalize(),
+            "type": "query",
+            "datasource": settings.influxdb['database'],
+            "query": self.query,
+            "refresh": 1,
+            "multi": self.multi,
+            "includeAll": self.multi,
+            "current": {},
+            "options": [],
+            "regex": "",
+            "sort": 1,
+            "hide": 0,
+        }
+
 class Dashboard:
-    def __init__(self, settings):
-        self.title = settings.grafana['title']
+    LAYOUTS = ("all", "plugin", "domain")
+
+    def __init__(self, settings, title=None, name=None):
+        self.title = title or settings.grafana['title']
         self.tags = settings.grafana['tags']
         self.rows = []
+        self.templates = []
         self.settings = settings
+        # distinguishes the dashboards of a templated layout (file name suffix), None for the single dashboard
+        self.name = name
 
     def prompt_setup(self):
         setup = self.settings.grafana
@@ -246,6 +297,9 @@ class Dashboard:
                 setup['access'] = raw_input("  - data source access [proxy]/direct: ").strip() or "proxy"
 
         self.title = raw_input("  Dashboard title [{0}]: ".format(self.title)).strip() or self.title
+        setup['layout'] = None
+        while setup['layout'] not in Dashboard.LAYOUTS:
+            setup['layout'] = raw_input("  One dashboard for all hosts or one per plugin/domain using template variables [all]/plugin/domain: ").strip() or "all"
         graph_per_row = raw_input("  Number of graphs per row [2]: ").strip() or "2"
         setup['graph_per_row'] = int(graph_per_row)
 
@@ -277,12 +331,18 @@ class Dashboard:
         self.rows.append(row)
         return row
 
+    def add_template(self, name, query, multi=False):
+        template = Template(name, query, multi)
+        self.templates.append(template)
+        return template
+
     def to_json(self, settings):
         return {
             "id": None,
             "title": self.title,
             "tags": self.tags,
             "rows": [row.to_json(settings) for row in self.rows],
+            "templating": {"list": [template.to_json(settings) for template in self.templates]},
             "timezone": "browser",
             "time": {"from": "now-5d", "to": "now"},
         }
@@ -290,10 +350,15 @@ class Dashboard:
     def save(self, filename=None):
         if filename is None:
             filename = self.settings.grafana['filename']
+            if self.name:
+                root, ext = os.path.splitext(filename)
+                filename = "{0}-{1}{2}".format(root, self.name, ext or ".json")
 
         with open(filename, "w") as f:
             json.dump(self.to_json(self.settings), f)
 
+        return filename
+
     def upload(self):
         api = GrafanaApi(self.settings)
         api.create_datasource(self.settings.influxdb['database'], self.settings.influxdb['database'])
@@ -339,14 +404,191 @@ class Dashboard:
                     panel.process_graph_thresholds(_plugin.fields)
                     panel.process_graph_types(_plugin.fields)
 
+    def _add_plugin_panel(self, row, plugin, instances, tag_filters):
+        """
+        Adds a panel for a plugin present on several hosts: fields are the union of every host's fields,
+        graph settings are taken from the first one
+        """
+        fields = OrderedDict()
+        for _plugin in instances:
+            for field in _plugin.fields:
+                fields.setdefault(field, _plugin.fields[field])
+        _plugin = instances[0]
+
+        panel = Panel(_plugin.settings["graph_title"] or plugin, plugin)
+        panel.tag_filters = tag_filters
+        row.panels.append(panel)
+
+        for field in fields:
+            query = panel.add_query(field)
+            if "label" in fields[field].settings:
+                query.alias = fields[field].settings["label"]
+
+        panel.width = 12//self.settings.grafana['graph_per_row']
+        panel.process_graph_settings(_plugin.settings)
+        panel.process_graph_thresholds(fields)
+        panel.process_graph_types(fields)
+        return panel
+
+    def generate_templated(self, layout="plugin"):
+        """
+        Generates one dashboard per plugin ("plugin" layout) or per domain ("domain" layout) rather than a single
+        one for all hosts. Hosts and domains are selected through Grafana template variables bound to the "domain"
+        and "host" tags so the number of panels (and queries) no longer depends on the size of the fleet.
+
+        @return: list of Dashboard
+        """
+        assert layout in ("plugin", "domain")
+        dashboards = []
+
+        if layout == "plugin":
+            plugins = OrderedDict()
+            for domain, host, plugin in self.settings.iter_plugins():
+                plugins.setdefault(plugin, []).append(self.settings.domains[domain].hosts[host].plugins[plugin])
+
+            progress_bar = ProgressBar(len(plugins))
+            for plugin in sorted(plugins):
+                dashboard = Dashboard(self.settings, "{0} - {1}".format(self.title, plugin), plugin)
+                dashboard.add_template("domain", "SHOW TAG VALUES FROM \"{0}\" WITH KEY = \"domain\"".format(plugin))
+                dashboard.add_template("host", "SHOW TAG VALUES FROM \"{0}\" WITH KEY = \"host\" WHERE \"domain\" =~ /^$domain$/".format(plugin),
+                                       multi=True)
+
+                # a single panel definition, repeated by Grafana for each selected host
+                row = dashboard.add_row()
+                panel = dashboard._add_plugin_panel(row, plugin, plugins[plugin], [("domain", "/^$domain$/", "=~"),
+                                                                                   ("host", "/^$host$/", "=~")])
+                panel.title = "{0} on $host".format(panel.title)
+                panel.repeat = "host"
+
+                dashboards.append(dashboard)
+                progress_bar.update()
+
+        else:
+            progress_bar = ProgressBar(len(self.settings.domains))
+            for domain in sorted(self.settings.domains):
+                dashboard = Dashboard(self.settings, "{0} - {1}".format(self.title, domain), domain)
+                dashboard.add_template("host", "SHOW TAG VALUES WITH KEY = \"host\" WHERE \"domain\" = '{0}'".format(domain))
+
+                plugins = OrderedDict()
+                for host in self.settings.domains[domain].hosts:
+                    for plugin, _plugin in self.settings.domains[domain].hosts[host].plugins.items():
+                        plugins.setdefault(plugin, []).append(_plugin)
+
+                row = dashboard.add_row("$host")
+                for plugin in plugins:
+                    dashboard._add_plugin_panel(row, plugin, plugins[plugin], [("domain", domain, "="),
+                                                                               ("host", "/^$host$/", "=~")])
+
+                dashboards.append(dashboard)
+                progress_bar.update()
+
+        return dashboards
+
+
+class UploadManifest:
+    """
+    Local record of the dashboards last uploaded to each Grafana host (hash of the dashboard) so that unchanged
+    dashboards are not uploaded again
+
+    {
+        "http://localhost:3000": {
+            "Munin Dashboard - cpu": {"hash": "3f1d...", "url": "http://..."}
+        }
+    }
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.content = {}
+
+        if filename and os.path.exists(filename):
+            with open(filename) as f:
+                self.content = json.load(f)
+
+    @staticmethod
+    def digest(data):
+        return hashlib.sha1(json.dumps(data, sort_keys=True)).hexdigest()
+
+    def is_uploaded(self, host, dashboard_json):
+        entry = self.content.get(host, {}).get(dashboard_json['title'])
+        return entry is not None and entry['hash'] == UploadManifest.digest(dashboard_json)
+
+    def update(self, host, dashboard_json, url):
+        self.content.setdefault(host, {})[dashboard_json['title']] = {
+            "hash": UploadManifest.digest(dashboard_json),
+            "url": url,
+        }
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.filename))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        with open(self.filename, "w") as f:
+            json.dump(self.content, f, indent=2, separators=(',', ': '))
+
+
+def upload_dashboards(settings, dashboards, force=False, workers=4):
+    """
+    Uploads the dashboards that changed since the last upload recorded in the manifest,
+    concurrently and over a shared HTTP session
+
+    @return: list of (dashboard, url, error), url being None for unchanged (skipped) dashboards
+    """
+    api = GrafanaApi(settings, pool_size=workers)
+    manifest = UploadManifest(settings.grafana['manifest'])
+
+    results = []
+    pending = []
+    for dashboard in dashboards:
+        content = dashboard.to_json(settings)
+        if not force and manifest.is_uploaded(api.host, content):
+            results.append((dashboard, None, None))
+        else:
+            pending.append((dashboard, content))
+
+    def _upload(item):
+        dashboard, content = item
+        try:
+            return dashboard, content, api.create_dashboard(content), None
+        except Exception as e:
+            return dashboard, content, None, e
+
+    if pending:
+        api.create_datasource(settings.influxdb['database'], settings.influxdb['database'])
+
+        pool = ThreadPool(min(workers, len(pending)))
+        try:
+            uploaded = pool.map(_upload, pending)
+        finally:
+            pool.close()
+
+        for dashboard, content, url, error in uploaded:
+            if error is None:
+                manifest.update(api.host, content, url)
+            results.append((dashboard, url, error))
+
+        if settings.grafana['manifest']:
+            manifest.save()
+
+    return results
+
 
 class GrafanaApi:
-    def __init__(self, config):
+    def __init__(self, config, pool_size=4):
         # OAuth2 tokens not yet supported
         self.auth = config.grafana['auth']
         self.host = config.grafana['host'].rstrip('/')
         self.config = config
 
+        # connections are reused for every request, including concurrent uploads
+        self.session = requests.Session()
+        self.session.auth = self.auth
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
     @staticmethod
     def test_host(host):
         # should return "unauthorized"
@@ -359,6 +601,10 @@ class GrafanaApi:
         return r.status_code == 200
 
     def create_datasource(self, name, dbname):
+        # already created by a previous run
+        if self.session.get(self.host + "/api/datasources/name/" + name).ok:
+            return True
+
         body = {
             "name": name,
             "database": dbname,
@@ -369,11 +615,11 @@ class GrafanaApi:
             "access": self.config.grafana['access'],
             "basicAuth": False
         }
-        r = requests.post(self.host + "/api/datasources", json=body, auth=self.auth)
+        r = self.session.post(self.host + "/api/datasources", json=body)
         return r.ok
 
     def create_dashboard(self, dashboardJson):
-        r = requests.post(self.host + "/api/dashboards/db", json={"dashboard": dashboardJson}, auth=self.auth)
+        r = self.session.post(self.host + "/api/dashboards/db", json={"dashboard": dashboardJson, "overwrite": True})
         if r.ok:
             return "".join([self.host, "/dashboard/db/", r.json()['slug']])
         else:
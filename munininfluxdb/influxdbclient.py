@@ -13,14 +13,25 @@ except (AssertionError, AttributeError) as e:
     raise ImportError("InfluxDB API is too old, please update (e.g: pip install influxdb --upgrade)")
 
 import rrd
-from utils import ProgressBar, parse_handle, Color, Symbol
-from rrd import read_xml_file
+from utils import ProgressBar, parse_handle, parse_duration, Color, Symbol
+from rrd import read_xml_file, dump_field
+from export import LineProtocolFiles
+from deadband import Deadband
+from aggregate import DomainAggregator
+from spill import SpilledJoin, count_windows
+from scheduler import Scheduler, make_jobs
+from fanout import FanoutWriter, list_targets, series_key
+from lineprotocol import LineProtocolError, make_lines
 from settings import Settings
 
 class InfluxdbClient:
     def __init__(self, settings):
         self.client = None
         self.valid = False
+        # with several targets, series are written through it rather than through the main client
+        self.fanout = None
+        # scheduler.Scheduler of the last iter_series(), for its per-job report
+        self.scheduler = None
 
         self.settings = settings
 
@@ -80,8 +91,36 @@ class InfluxdbClient:
             print("Error: could not query database: %s" % e)
             return False
 
+        if self.settings.influxdb.get('targets'):
+            return self.open_fanout(name)
+
+        return True
+
+    def open_fanout(self, database):
+        self.fanout = FanoutWriter(list_targets(self.settings.influxdb), database, self.settings.influxdb['replicas'],
+                                   self.settings.fanout_mapping)
+        for name, error in self.fanout.ping():
+            print("Error: could not connect to {0}: {1}".format(name, error))
+            return False
+        try:
+            self.fanout.create_database()
+        except LineProtocolError as e:
+            print("Error: could not create database: %s" % e)
+            return False
         return True
 
+    def retention_duration(self):
+        """
+        @return: duration in seconds of the default retention policy of the database, None if infinite
+        """
+        assert self.client
+        for policy in self.client.get_list_retention_policies(self.settings.influxdb['database']):
+            if policy.get('default'):
+                if policy['duration'] in ("0", "INF"):
+                    return None
+                return parse_duration(policy['duration']) or None
+        return None
+
     def list_db(self):
         assert self.client
         db_list = self.client.get_list_database()
@@ -143,10 +182,11 @@ class InfluxdbClient:
         group = raw_input("Group multiple fields of the same plugin in the same time series? [y]/n: ") or "y"
         setup['group_fields'] = group in ("y", "Y")
 
-    def write_series(self, measurement, tags, fields, time_and_values):
-        if len(fields) != len(time_and_values[0]):
-            raise Exception("Cannot insert in {0} series: expected {1} columns (contains {2})".format(measurement, len(fields), len(time_and_values[0])))
-
+    @staticmethod
+    def make_points(measurement, tags, fields, time_and_values):
+        """
+        @return: list of points in the InfluxDB client's JSON format, one per row with at least a non-null value
+        """
         body = []
         for row in time_and_values:
             # InfluxDB does not accept null values (nor field-less entries)
@@ -158,15 +198,60 @@ class InfluxdbClient:
                     "time": row[0],
                     "fields": valid_fields
                 })
+        return body
+
+    def write_series(self, measurement, tags, fields, time_and_values, last=True):
+        """
+        @param last: False if more windows of the series follow, in fan-out mode the series is only returned by
+                     self.fanout.completed() once the payloads of all its windows were written
+        """
+        if not time_and_values:
+            # no row within --since/--until: nothing to write
+            if self.fanout:
+                self.fanout.write_points([], tag=(measurement, series_key(tags)), last=last)
+            return
+
+        if len(fields) != len(time_and_values[0]):
+            raise Exception("Cannot insert in {0} series: expected {1} columns (contains {2})".format(measurement, len(fields), len(time_and_values[0])))
+
+        telemetry = self.settings.telemetry
+
+        with telemetry.stage("serialize"):
+            body = InfluxdbClient.make_points(measurement, tags, fields, time_and_values)
+            data = make_lines(body)
 
         if body:
             try:
-                self.client.write_points(body, time_precision='s')
+                # same request as client.write_points() but we keep the serialized payload to account for its size
+                with telemetry.stage("throttle"):
+                    self.settings.throttle.acquire(points=len(body), bytes=len(data))
+                with telemetry.stage("write"):
+                    if self.fanout:
+                        # failed writes are queued and retried per target
+                        size = self.fanout.write_points(body, tag=(measurement, series_key(tags)), last=last)
+                    else:
+                        self.client.request(url="write", method="POST",
+                                            params={"db": self.settings.influxdb['database'], "precision": 's'},
+                                            data=data, expected_response_code=204)
+                        size = len(data)
             except influxdb.client.InfluxDBClientError as e:
+                telemetry.count("write_errors")
                 raise Exception("Cannot insert in {0} series: {1}".format(measurement, e))
+            else:
+                telemetry.count("points", len(body))
+                telemetry.count("bytes", size)
         else:
             raise ValueError("Measurement {0} did not contain any non-null value".format(measurement))
 
+    def write_telemetry(self):
+        """
+        Writes the run's own timings and counters to the "munininfluxdb_internal" measurement
+        """
+        try:
+            self.client.write_points(self.settings.telemetry.to_points(), time_precision='s')
+        except influxdb.client.InfluxDBClientError as e:
+            print("  {0} Could not write telemetry: {1}".format(Symbol.WARN_YELLOW, e))
+
     def validate_record(self, name, fields):
         """
         Performs brief validation of the record made: checks that the named series exists
@@ -192,33 +277,195 @@ class InfluxdbClient:
 
         return True
 
-    def import_from_xml(self):
-        print("\nUploading data to InfluxDB:")
-        progress_bar = ProgressBar(self.settings.nb_rrd_files*3)  # nb_files * (read + upload + validate)
-        errors = []
+    def read_field(self, _field, since=None, until=None):
+        """
+        Parsed values of a field, from the cache if the RRD file did not change since it was parsed
 
-        def _upload_and_validate(measurement, tags, fields, packed_values):
-            try:
-                self.write_series(measurement, tags, fields, packed_values)
-            except Exception as e:
-                errors.append((Symbol.NOK_RED, "Error writing {0} to InfluxDB: {1}".format(measurement, e)))
-                return
-            finally:
-                progress_bar.update(len(fields)-1)  # 'time' column ignored
+        @return: {time: value}
+        """
+        cache = self.settings.series_cache()
+        if not cache:
+            return read_xml_file(_field.xml_filename, since=since, until=until)
+
+        content = cache.get(_field.rrd_filename)
+        if content is None:
+            if not os.path.exists(_field.xml_filename):
+                # not dumped as it was cached then, the entry went away since
+                dump_field(self.settings, _field)
+            # cached whole, the time window is applied afterwards
+            content = read_xml_file(_field.xml_filename)
+            cache.put(_field.rrd_filename, content)
+        else:
+            self.settings.telemetry.count("cache_hits")
+
+        if since is not None or until is not None:
+            content = {time: value for time, value in content.items()
+                       if (since is None or time >= since) and (until is None or time <= until)}
+        return content
 
+    def detect_integer_fields(self):
+        """
+        Marks the GAUGE fields whose known values are all integral to be written as InfluxDB integers, which the
+        storage engine compresses much better than floats. A field type is shared by all the series of a measurement:
+        the decision is taken across every host, from a first read of the values (kept by the cache when enabled).
+
+        @return: number of fields marked
+        """
+        since, until = self.settings.filters['since'], self.settings.filters['until']
+        group_fields = self.settings.influxdb['group_fields']
+
+        # {(measurement, InfluxDB field): [_field, ...]}
+        candidates = defaultdict(list)
+        for domain, host, plugin, field in self.settings.iter_fields():
+            _field = self.settings.domains[domain].hosts[host].plugins[plugin].fields[field]
+            if _field.rrd_exported:
+                candidates[(plugin, field) if group_fields else (field, 'value')].append(_field)
+
+        marked = 0
+        for fields in candidates.values():
+            if any(_field.settings.get('type', "GAUGE") != "GAUGE" for _field in fields):
+                continue
             try:
-                self.validate_record(measurement, fields)
-            except Exception as e:
-                errors.append((Symbol.WARN_YELLOW, "Validation error in {0}: {1}".format(measurement, e)))
-            finally:
-                progress_bar.update(len(fields)-1)  # 'time' column ignored
+                integral = all(value is None or (value.is_integer() and abs(value) < 2**53)
+                               for _field in fields for value in self.read_field(_field, since, until).values())
+            except Exception:
+                # reported when the series is read again
+                continue
+            if integral:
+                for _field in fields:
+                    _field.influxdb_integer = True
+                marked += len(fields)
 
-        try:
-            assert self.client and self.valid
-        except:
-            raise Exception("Not connected to a InfluxDB server")
+        self.settings.telemetry.count("integer_fields", marked)
+        return marked
+
+    def encode_values(self, _field, content):
+        """
+        Converts the values of integer fields, and accounts for the bytes saved over float formatting ("12.0")
+
+        @param content: {time: value} as returned by read_field()
+        """
+        telemetry = self.settings.telemetry
+        if _field.influxdb_integer:
+            content = {time: None if value is None else int(value) for time, value in content.items()}
+            integers = sum(1 for value in content.values() if value is not None)
+            # "12i"
+            telemetry.count("integer_values", integers)
+            telemetry.count("bytes_saved", integers)
         else:
-            print("  {0} Connection to database \"{1}\" OK".format(Symbol.OK_GREEN, self.settings.influxdb['database']))
+            # "12"
+            telemetry.count("bytes_saved", 2*sum(1 for value in content.values()
+                                                 if value is not None and value.is_integer() and abs(value) < 1e16))
+        return content
+
+    def _read_plugin(self, job, errors, progress_bar, since=None, until=None):
+        """
+        Reads and joins the fields of a plugin, in a scheduler worker
+
+        @return: (field_names, spill.SpilledJoin or None, values_with_time), values being spilled to disk rather than
+                 joined in memory when they would not fit in the memory budget
+        """
+        telemetry = self.settings.telemetry
+        _plugin = self.settings.domains[job.domain].hosts[job.host].plugins[job.plugin]
+        measurement = job.plugin
+
+        field_names = ['time']
+        values = defaultdict(list)
+        values_with_time = []
+        # out-of-core join, when the joined rows would not fit in the memory budget
+        join = None
+        nb_exported = len([field for field in job.fields if _plugin.fields[field].rrd_exported])
+
+        for field in job.fields:
+            _field = _plugin.fields[field]
+
+            if _field.rrd_exported:
+                field_names.append(field)
+                try:
+                    with telemetry.stage("parse"):
+                        content = self.read_field(_field, since, until)
+                except Exception as e:
+                    errors.append((Symbol.WARN_YELLOW, "Could not read file for {0}: {1}".format(field, e)))
+                else:
+                    telemetry.count("xml_files")
+                    content = self.encode_values(_field, content)
+                    with telemetry.stage("join"):
+                        if join is None and not values and self.settings.memory_budget:
+                            # the first field read gives the size of the whole plugin
+                            nb_windows = count_windows(len(content) * nb_exported, self.settings.memory_budget)
+                            if nb_windows > 1:
+                                join = SpilledJoin(nb_exported, nb_windows, self.settings.paths['xml'])
+                        if join:
+                            join.add(len(field_names) - 2, content, _field.influxdb_integer)
+                        else:
+                            [values[key].append(value) for key, value in content.items()]
+
+                    # keep track of influxdb storage info to allow 'fetch'
+                    _field.influxdb_measurement = measurement
+                    _field.influxdb_field = field
+                    _field.xml_imported = True
+
+            # update progress bar [######      ] 42 %
+            progress_bar.update()
+
+        if not join:
+            # join data with time as first column
+            with telemetry.stage("join"):
+                values_with_time.extend([[k]+v for k, v in values.items()])
+
+        return field_names, join, values_with_time
+
+    def _read_single_field(self, job, progress_bar, since=None, until=None):
+        """
+        Reads a field as its own series ("value" column), in a scheduler worker
+
+        @return: values_with_time
+        """
+        telemetry = self.settings.telemetry
+        _field = self.settings.domains[job.domain].hosts[job.host].plugins[job.plugin].fields[job.fields[0]]
+        values = defaultdict(list)
+        values_with_time = []
+
+        _field.influxdb_measurement = job.fields[0]
+        _field.influxdb_field = 'value'
+
+        with telemetry.stage("parse"):
+            content = self.read_field(_field, since, until)
+        telemetry.count("xml_files")
+        content = self.encode_values(_field, content)
+        with telemetry.stage("join"):
+            [values[key].append(value) for key, value in content.items()]
+        _field.xml_imported = True
+        progress_bar.update()
+
+        # join data with time as first column
+        with telemetry.stage("join"):
+            values_with_time.extend([[k]+v for k, v in values.items()])
+
+        return values_with_time
+
+    def iter_series(self, errors, progress_bar, aggregator=None):
+        """
+        Reads the exported XML files and joins them into series, whatever the destination (InfluxDB or files)
+
+        @param errors: list where (symbol, message) read errors are appended
+        @param aggregator: optional aggregate.DomainAggregator fed with every series (before deadband compression)
+        @return: generator of (measurement, tags, field_names, values_with_time, last), field_names starting with
+                 'time'. Series joined out-of-core (see spill.SpilledJoin) come as several consecutive time windows,
+                 'last' being True on the final one only
+        """
+        telemetry = self.settings.telemetry
+        since, until = self.settings.filters['since'], self.settings.filters['until']
+        deadband = Deadband(self.settings.deadband['rules'], self.settings.deadband['heartbeat']) \
+            if self.settings.deadband['rules'] else None
+
+        if self.settings.influxdb.get('integers'):
+            with telemetry.stage("detect"):
+                self.detect_integer_fields()
+
+        # jobs (plugins, or fields if not grouped) read largest first, under the memory budget
+        self.scheduler = Scheduler(self.settings.join_workers, self.settings.memory_budget)
+        jobs = make_jobs(self.settings, self.settings.influxdb['group_fields'])
 
         if self.settings.influxdb['group_fields']:
             """
@@ -234,46 +481,47 @@ class InfluxdbClient:
                 | ...                  |       |          |          |           |
                 +----------------------+-------+----------+----------+-----------+
             """
-            for domain, host, plugin in self.settings.iter_plugins():
-                _plugin = self.settings.domains[domain].hosts[host].plugins[plugin]
+            def _read(job):
+                return self._read_plugin(job, errors, progress_bar, since, until)
+
+            for job, (field_names, join, values_with_time) in self.scheduler.run(jobs, _read):
+                domain, host, plugin = job.domain, job.host, job.plugin
                 measurement = plugin
-                tags = {
-                    "domain": domain,
-                    "host": host,
-                    "plugin": plugin
-                }
-                if _plugin.is_multigraph:
-                    tags["is_multigraph"] = True
+                tags = self.settings.series_tags(domain, host, plugin)
+                if self.settings.domains[domain].hosts[host].plugins[plugin].is_multigraph:
                     print(host, plugin)
 
-                field_names = ['time']
-                values = defaultdict(list)
-                values_with_time = []
-
-                for field in _plugin.fields:
-                    _field = _plugin.fields[field]
+                if join:
+                    telemetry.count("spilled_series")
+                    telemetry.count("spilled_bytes", join.spilled)
+                    windows = join.windows()
+                else:
+                    windows = [values_with_time]
 
-                    if _field.rrd_exported:
-                        field_names.append(field)
-                        try:
-                            content = read_xml_file(_field.xml_filename)
-                        except Exception as e:
-                            errors.append((Symbol.WARN_YELLOW, "Could not read file for {0}: {1}".format(field, e)))
-                        else:
-                            [values[key].append(value) for key, value in content.items()]
-
-                            # keep track of influxdb storage info to allow 'fetch'
-                            _field.influxdb_measurement = measurement
-                            _field.influxdb_field = field
-                            _field.xml_imported = True
-
-                    # update progress bar [######      ] 42 %
-                    progress_bar.update()
-
-                # join data with time as first column
-                values_with_time.extend([[k]+v for k, v in values.items()])
-
-                _upload_and_validate(measurement, tags, field_names, values_with_time)
+                try:
+                    # windows are written one after the other, the last one holding known values completes the series
+                    final = join.last_window() if join else 0
+                    for index, values_with_time in enumerate(windows):
+                        last = index == final
+
+                        if aggregator:
+                            with telemetry.stage("aggregate"):
+                                aggregator.add_series(domain, plugin, measurement, field_names, values_with_time)
+
+                        if deadband:
+                            with telemetry.stage("deadband"):
+                                values_with_time.sort()
+                                deadband.compress_series(plugin, field_names, values_with_time,
+                                                         resume=index > 0, last=last)
+
+                        if last or join.known[index]:
+                            # nothing to write from windows of unknown values, still seen by the deadband (gaps)
+                            yield measurement, tags, field_names, values_with_time, last
+                        if last:
+                            break
+                finally:
+                    if join:
+                        join.close()
 
         else:  # non grouping
             """
@@ -290,34 +538,173 @@ class InfluxdbClient:
                 | ...                         |       |       |
                 +-----------------------------+-------+-------+
             """
-            for domain, host, plugin, field in self.settings.iter_fields():
-                _field = self.settings.domains[domain].hosts[host].plugins[plugin].fields[field]
-                if not _field.rrd_exported:
-                    continue
+            def _read(job):
+                return self._read_single_field(job, progress_bar, since, until)
+
+            for job, values_with_time in self.scheduler.run(jobs, _read):
+                domain, host, plugin, field = job.domain, job.host, job.plugin, job.fields[0]
                 measurement = field
-                tags = {
-                    "domain": domain,
-                    "host": host,
-                    "plugin": plugin
-                }
+                tags = self.settings.series_tags(domain, host, plugin)
                 field_names = ['time', 'value']
-                values = defaultdict(list)
-                values_with_time = []
 
-                _field.influxdb_measurement = measurement
-                _field.influxdb_field = 'value'
+                if aggregator:
+                    with telemetry.stage("aggregate"):
+                        aggregator.add_series(domain, plugin, measurement, field_names, values_with_time)
 
-                content = read_xml_file(_field.xml_filename)
-                [values[key].append(value) for key, value in content.items()]
-                _field.xml_imported = True
-                progress_bar.update()
+                if deadband:
+                    with telemetry.stage("deadband"):
+                        values_with_time.sort()
+                        deadband.compress_series(plugin, ['time', field], values_with_time)
 
-                # join data with time as first column
-                values_with_time.extend([[k]+v for k, v in values.items()])
-                _upload_and_validate(measurement, tags, field_names, values_with_time)
+                yield measurement, tags, field_names, values_with_time, True
+
+        if deadband:
+            telemetry.count("deadband_dropped", deadband.dropped)
+
+    def record_checkpoint(self, measurement, tags, fields):
+        """
+        Journals the fields of a series written to InfluxDB, so that a restarted shard skips them
+        """
+        _plugin = self.settings.domains[tags['domain']].hosts[tags['host']].plugins[tags['plugin']]
+        # grouped: one column per field, otherwise a series per field holding a "value" column
+        names = fields[1:] if self.settings.influxdb['group_fields'] else [measurement]
+        self.settings.checkpoint.record([{
+            "domain": tags['domain'],
+            "host": tags['host'],
+            "plugin": tags['plugin'],
+            "field": name,
+            "measurement": measurement,
+            "influxdb_field": _plugin.fields[name].influxdb_field,
+            "influxdb_integer": _plugin.fields[name].influxdb_integer,
+        } for name in names if _plugin.fields[name].xml_imported])
+
+    def import_from_xml(self):
+        print("\nUploading data to InfluxDB:")
+        progress_bar = ProgressBar(self.settings.nb_rrd_files*3)  # nb_files * (read + upload + validate)
+        errors = []
+        telemetry = self.settings.telemetry
+
+        # series joined out-of-core are written window by window, complete only if every window was
+        incomplete = set()
+        # fan-out: {(measurement, series key): record_checkpoint() arguments} of the series not written by every
+        # target yet
+        unjournaled = {}
+
+        def _journal_written():
+            for tag in self.fanout.completed():
+                if tag in unjournaled:
+                    self.record_checkpoint(*unjournaled.pop(tag))
+
+        def _upload_and_validate(measurement, tags, fields, packed_values, last=True):
+            try:
+                self.write_series(measurement, tags, fields, packed_values, last)
+            except Exception as e:
+                errors.append((Symbol.NOK_RED, "Error writing {0} to InfluxDB: {1}".format(measurement, e)))
+                incomplete.add(series_key(tags))
+            if not last:
+                return
+
+            progress_bar.update(len(fields)-1)  # 'time' column ignored
+            if series_key(tags) in incomplete:
+                return
+
+            if self.settings.checkpoint and self.fanout:
+                # payloads may still be queued for retry
+                unjournaled[(measurement, series_key(tags))] = (measurement, tags, fields)
+            elif self.settings.checkpoint:
+                self.record_checkpoint(measurement, tags, fields)
+
+            if self.fanout:
+                _journal_written()
+            if self.fanout or not packed_values:
+                # the main server does not hold every series, or nothing was written within --since/--until
+                progress_bar.update(len(fields)-1)
+                return
+
+            try:
+                with self.settings.telemetry.stage("validation"):
+                    self.validate_record(measurement, fields)
+            except Exception as e:
+                errors.append((Symbol.WARN_YELLOW, "Validation error in {0}: {1}".format(measurement, e)))
+            finally:
+                progress_bar.update(len(fields)-1)  # 'time' column ignored
+
+        try:
+            assert self.client and self.valid
+        except:
+            raise Exception("Not connected to a InfluxDB server")
+        else:
+            print("  {0} Connection to database \"{1}\" OK".format(Symbol.OK_GREEN, self.settings.influxdb['database']))
+
+        aggregator = DomainAggregator(self.settings.aggregate) if self.settings.aggregate else None
+        for measurement, tags, field_names, values_with_time, last in self.iter_series(errors, progress_bar, aggregator):
+            _upload_and_validate(measurement, tags, field_names, values_with_time, last)
+
+        if aggregator:
+            print("  Writing {0} domain aggregates".format("/".join(self.settings.aggregate)))
+            for measurement, tags, field_names, values_with_time in aggregator.iter_series():
+                try:
+                    self.write_series(measurement, tags, field_names, values_with_time)
+                except Exception as e:
+                    errors.append((Symbol.NOK_RED, "Error writing {0} aggregate of {1} to InfluxDB: {2}".format(
+                        tags['aggregate'], measurement, e)))
+
+        if self.fanout:
+            with telemetry.stage("write"):
+                for name, dropped in self.fanout.flush():
+                    errors.append((Symbol.NOK_RED, "Gave up writing {0} batches to {1}".format(dropped, name)))
+                    telemetry.count("write_errors", dropped)
+            telemetry.count("retries", self.fanout.retried)
+            _journal_written()
 
         for error in errors:
             print("  {} {}".format(error[0], error[1]))
+        telemetry.count("errors", len(errors))
+
+    def export_to_files(self, folder, shards=1, compress=False):
+        """
+        Writes the imported history to line protocol files instead of InfluxDB, see export.LineProtocolFiles
+
+        @return: list of written files
+        """
+        print("\nExporting data to line protocol files:")
+        progress_bar = ProgressBar(self.settings.nb_rrd_files*2)  # nb_files * (read + serialize)
+        errors = []
+        telemetry = self.settings.telemetry
+        files = LineProtocolFiles(folder, self.settings.influxdb['database'] or "munin", shards, compress)
+
+        def _write(measurement, tags, field_names, values_with_time):
+            if not values_with_time:
+                # no row within --since/--until
+                return
+            with telemetry.stage("serialize"):
+                body = InfluxdbClient.make_points(measurement, tags, field_names, values_with_time)
+                size = files.write_points(body)
+
+            if body:
+                telemetry.count("points", len(body))
+                telemetry.count("bytes", size)
+            else:
+                errors.append((Symbol.WARN_YELLOW, "Measurement {0} did not contain any non-null value".format(measurement)))
+
+        aggregator = DomainAggregator(self.settings.aggregate) if self.settings.aggregate else None
+        for measurement, tags, field_names, values_with_time, last in self.iter_series(errors, progress_bar, aggregator):
+            _write(measurement, tags, field_names, values_with_time)
+            if last:
+                progress_bar.update(len(field_names)-1)  # 'time' column ignored
+
+        if aggregator:
+            for measurement, tags, field_names, values_with_time in aggregator.iter_series():
+                _write(measurement, tags, field_names, values_with_time)
+
+        with telemetry.stage("write"):
+            filenames = files.close()
+
+        for error in errors:
+            print("  {} {}".format(error[0], error[1]))
+        telemetry.count("errors", len(errors))
+
+        return filenames
 
     def import_from_xml_folder(self, folder):
         raise DeprecationWarning
@@ -0,0 +1,134 @@
+"""
+Minimal InfluxDB line protocol writer
+
+Used by 'fetch' instead of the full influxdb client (and its requests/dateutil/pytz imports) since
+it runs every 5 minutes from cron and only ever pushes a few thousand points.
+Points get the same field types as with influxdb.line_protocol.make_lines(), floats being written in their shortest
+form: "12" rather than "12.0", both being floats for InfluxDB.
+"""
+import json
+import base64
+import urllib
+import httplib
+
+
+class LineProtocolError(Exception):
+    pass
+
+
+def _to_str(value):
+    # fetch config is read from JSON, hence unicode strings
+    return value.encode('utf-8') if isinstance(value, unicode) else str(value)
+
+
+def _escape_tag(value):
+    return _to_str(value).replace("\\", "\\\\").replace(" ", "\\ ").replace(",", "\\,").replace("=", "\\=")
+
+
+def _escape_measurement(value):
+    return _to_str(value).replace("\\", "\\\\").replace(" ", "\\ ").replace(",", "\\,")
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    elif isinstance(value, (int, long)):
+        return "{0}i".format(value)
+    elif isinstance(value, float):
+        if value.is_integer() and abs(value) < 1e16:
+            return "%d" % value
+        return repr(value)
+    else:
+        return "\"{0}\"".format(_to_str(value).replace("\\", "\\\\").replace("\"", "\\\""))
+
+
+def make_lines(points):
+    """
+    @param points: list of {"measurement": ..., "tags": {...}, "time": <int>, "fields": {...}} as used by the influxdb client
+    @return: line protocol payload, null fields and field-less points are skipped
+    """
+    lines = []
+    for point in points:
+        fields = ",".join("{0}={1}".format(_escape_tag(key), _format_value(value))
+                          for key, value in sorted(point['fields'].items()) if value is not None)
+        if not fields:
+            continue
+
+        key = _escape_measurement(point['measurement'])
+        tags = ",".join("{0}={1}".format(_escape_tag(tag), _escape_tag(value))
+                        for tag, value in sorted(point.get('tags', {}).items()) if value not in (None, ""))
+        if tags:
+            key = "{0},{1}".format(key, tags)
+
+        if point.get('time') is not None:
+            lines.append("{0} {1} {2}".format(key, fields, int(point['time'])))
+        else:
+            lines.append("{0} {1}".format(key, fields))
+
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+class LineProtocolWriter:
+    """
+    Writes line protocol payloads over a single keep-alive HTTP connection
+    """
+    def __init__(self, host, port, user, password, database, timeout=10):
+        self.database = database
+        self.connection = httplib.HTTPConnection(host, int(port or 8086), timeout=timeout)
+        self.headers = {"Content-Type": "application/octet-stream"}
+        if user:
+            self.headers["Authorization"] = "Basic " + base64.b64encode("{0}:{1}".format(user, password or ""))
+
+    def _request(self, method, path, params=None, body=None):
+        url = path + ("?" + urllib.urlencode(params) if params else "")
+        try:
+            self.connection.request(method, url, body, self.headers)
+            response = self.connection.getresponse()
+            content = response.read()
+        except (httplib.HTTPException, IOError) as e:
+            self.connection.close()
+            raise LineProtocolError(e)
+        return response.status, content
+
+    def ping(self):
+        status, _ = self._request("GET", "/ping")
+        if status != 204:
+            raise LineProtocolError("unexpected answer from /ping: HTTP {0}".format(status))
+
+    def create_database(self, name):
+        # CREATE statements must be POSTed
+        status, content = self._request("POST", "/query", {"q": "CREATE DATABASE \"{0}\"".format(name)})
+        if status != 200:
+            raise LineProtocolError("HTTP {0}: {1}".format(status, content))
+
+    def write(self, data, precision='s'):
+        status, content = self._request("POST", "/write", {"db": self.database, "precision": precision}, data)
+        if status != 204:
+            try:
+                error = json.loads(content)['error']
+            except (ValueError, KeyError, TypeError):
+                error = content
+            raise LineProtocolError("HTTP {0}: {1}".format(status, error))
+
+    def query(self, query, epoch='s'):
+        """
+        @return: list of series of the first statement: [{"name": ..., "tags": {...}, "columns": [...], "values": [...]}]
+        """
+        status, content = self._request("GET", "/query", {"db": self.database, "q": query, "epoch": epoch})
+        try:
+            result = json.loads(content)
+        except ValueError:
+            raise LineProtocolError("HTTP {0}: {1}".format(status, content))
+        if status != 200 or 'error' in result:
+            raise LineProtocolError("HTTP {0}: {1}".format(status, result.get('error')))
+
+        statement = result['results'][0]
+        if 'error' in statement:
+            raise LineProtocolError(statement['error'])
+        return statement.get('series', [])
+
+    def write_points(self, points, precision='s'):
+        data = make_lines(points)
+        if data:
+            self.write(data, precision)
+        return len(data)
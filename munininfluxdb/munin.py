@@ -1,7 +1,8 @@
 from __future__ import print_function
 import os
-import sys
 import pprint
+from multiprocessing import Pool, cpu_count
+from HTMLParser import HTMLParser, HTMLParseError
 
 from utils import ProgressBar, Symbol
 from settings import Settings
@@ -72,43 +73,123 @@ def discover_from_datafile(settings):
 
     return settings
 
-def discover_from_www(settings):
+class MuninPageParser(HTMLParser):
     """
-    Builds a Munin dashboard structure (domain/host/plugins) by reading the HTML files
-    rather than listing the cache folder because the later is likely to contain old data
+    Streaming extractor for the pages generated by munin-html, much lighter than a full DOM:
+      - domains: texts of the <span class="domain"> elements (overview page)
+      - links: (href, text) of the <a> elements within the element of id "content" (domain pages)
+    """
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.domains = []
+        self.links = []
+        # tag name of the content element, and its nesting depth while inside it
+        self._content_tag = None
+        self._content_depth = 0
+        self._in_domain = False
+        self._href = None
+        self._text = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if self._content_tag is None:
+            if attrs.get("id") == "content":
+                self._content_tag, self._content_depth = tag, 1
+        elif tag == self._content_tag:
+            self._content_depth += 1
+
+        if tag == "span" and "domain" in (attrs.get("class") or "").split():
+            self._in_domain, self._text = True, []
+        elif tag == "a" and self._content_depth and attrs.get("href"):
+            self._href, self._text = attrs["href"], []
+
+    def handle_endtag(self, tag):
+        if tag == "a" and self._href is not None:
+            self.links.append((self._href, "".join(self._text).strip()))
+            self._href = None
+        elif tag == "span" and self._in_domain:
+            self.domains.append("".join(self._text).strip())
+            self._in_domain = False
+
+        if self._content_depth and tag == self._content_tag:
+            self._content_depth -= 1
+
+    def handle_data(self, data):
+        if self._in_domain or self._href is not None:
+            self._text.append(data)
+
+    def handle_entityref(self, name):
+        self.handle_data(self.unescape("&{0};".format(name)))
+
+    def handle_charref(self, name):
+        self.handle_data(self.unescape("&#{0};".format(name)))
+
+
+def _parse_with_beautifulsoup(filename):
+    """
+    Slower fallback for pages HTMLParser chokes on, same result as parse_www_page()
     """
-
-    # delayed  import since this function should not be used in the "normal" case
     try:
         from bs4 import BeautifulSoup
     except ImportError:
+        from BeautifulSoup import BeautifulSoup
+
+    with open(filename) as f:
+        root = BeautifulSoup(f.read())
+
+    domains = [span.text for span in root.findAll("span", {"class": "domain"})]
+    content = root.find(id="content")
+    links = [(link.get("href"), link.text) for link in content.findAll("a") if link.get("href")] if content else []
+    return domains, links
+
+
+def parse_www_page(filename):
+    """
+    @return: (domains, links) as extracted by MuninPageParser, the file being read by chunks
+    """
+    parser = MuninPageParser()
+    try:
+        with open(filename) as f:
+            for chunk in iter(lambda: f.read(65536), ""):
+                parser.feed(chunk)
+        parser.close()
+    except HTMLParseError as e:
         try:
-            from BeautifulSoup import BeautifulSoup
+            return _parse_with_beautifulsoup(filename)
         except ImportError:
-            print("Please install BeautifulSoup to use this program")
-            print("  pip install beautifulsoup4 or easy_install beautifulsoup4")
-            sys.exit(1)
+            # BeautifulSoup is optional
+            raise e
+    return parser.domains, parser.links
+
 
+def discover_from_www(settings, workers=None):
+    """
+    Builds a Munin dashboard structure (domain/host/plugins) by reading the HTML files
+    rather than listing the cache folder because the later is likely to contain old data
+
+    @param workers: number of processes parsing domain pages (default: number of CPUs)
+    """
     folder = settings.paths['www']
 
     print("Reading Munin www cache: ({0})".format(folder))
-    with open(os.path.join(folder, "index.html")) as f:
-        root = BeautifulSoup(f.read())
-
-    domains = root.findAll("span", {"class": "domain"})
+    domains, _ = parse_www_page(os.path.join(folder, "index.html"))
 
     # hosts and domains are at the same level in the tree so let's open the file
-    for domain in domains:
-        with open(os.path.join(folder, domain.text, "index.html")) as f:
-            domain_root = BeautifulSoup(f.read())
+    # parsing is CPU bound: processes rather than threads
+    pool = Pool(workers or cpu_count())
+    try:
+        # get() with a timeout so that Ctrl-C is not swallowed by the pool
+        pages = pool.map_async(parse_www_page, [os.path.join(folder, domain, "index.html") for domain in domains]).get(86400)
+    finally:
+        pool.terminate()
 
-        links = domain_root.find(id="content").findAll("a")
-        progress_bar = ProgressBar(len(links), title=domain.text)
+    progress_bar = ProgressBar(sum(len(links) for _, links in pages), title="Domain pages")
 
-        for link in links:
+    for domain, (_, links) in zip(domains, pages):
+        for href, text in links:
             progress_bar.update()
 
-            elements = link.get("href").split("/")
+            elements = href.split("/")
             if len(elements) < 2 \
                 or elements[0].startswith("..") \
                 or elements[-1].startswith("index"):
@@ -125,9 +206,9 @@ def discover_from_www(settings):
                 continue
 
             plugin = plugin.replace(".html", "")
-            settings.domains[domain.text].hosts[host].plugins[plugin].is_multigraph = (len(elements) == 3)
-            settings.domains[domain.text].hosts[host].plugins[plugin].settings = {
-                'graph_title': link.text,
+            settings.domains[domain].hosts[host].plugins[plugin].is_multigraph = (len(elements) == 3)
+            settings.domains[domain].hosts[host].plugins[plugin].settings = {
+                'graph_title': text,
             }
             settings.nb_plugins += 1
 
@@ -0,0 +1,159 @@
+from __future__ import print_function
+from collections import defaultdict, OrderedDict
+
+from utils import ProgressBar, Color, Symbol
+from rrd import count_rrd_entries
+
+# average length of a serialized float value (repr) and of a timestamp in seconds in line protocol
+VALUE_LENGTH = 18
+TIME_LENGTH = 10
+
+# default throughputs used to project the import time, see "python -m benchmark.run" to measure yours
+DUMP_RATE = 20          # RRD files/sec ("rrdtool dump")
+PARSE_RATE = 15000      # points/sec (read_xml_file)
+WRITE_RATE = 25000      # points/sec (write to InfluxDB)
+
+
+def _line_length(measurement, tags, fields):
+    tags_length = sum(len(",{0}={1}".format(key, value)) for key, value in tags.items())
+    fields_length = sum(len(field) + 1 + VALUE_LENGTH for field in fields) + len(fields) - 1
+    return len(measurement) + tags_length + 1 + fields_length + 1 + TIME_LENGTH + 1
+
+
+class Plan:
+    SCHEMAS = ("grouped", "non-grouped")
+
+    def __init__(self):
+        # {domain: {"hosts", "plugins", "fields", "rrd_files", "entries", "series", "measurements", "points", "bytes"}}
+        # series/measurements/points/bytes are dicts keyed by schema
+        self.domains = OrderedDict()
+        # distinct measurement names across domains
+        self.measurements = {schema: set() for schema in Plan.SCHEMAS}
+        self.errors = []
+
+    def totals(self):
+        totals = defaultdict(int)
+        for domain in self.domains.values():
+            for key, value in domain.items():
+                if isinstance(value, dict):
+                    for schema in Plan.SCHEMAS:
+                        totals[(key, schema)] += value[schema]
+                else:
+                    totals[key] += value
+        for schema in Plan.SCHEMAS:
+            totals[('measurements', schema)] = len(self.measurements[schema])
+        return totals
+
+    def projected_time(self, schema, dump_rate=DUMP_RATE, parse_rate=PARSE_RATE, write_rate=WRITE_RATE):
+        totals = self.totals()
+        return totals['rrd_files']/float(dump_rate) \
+            + totals['entries']/float(parse_rate) \
+            + totals[('points', schema)]/float(write_rate)
+
+
+def plan_import(settings):
+    """
+    Estimates series cardinality, points and line protocol size of an import for both schemas,
+    from the discovered Munin structure and RRD headers only (nothing is dumped nor written)
+
+    Unknown (NaN) values are not skipped as they would be on import: points and bytes are upper bounds
+    """
+    plan = Plan()
+    progress_bar = ProgressBar(max(settings.nb_rrd_files, 1))
+
+    for domain, host, plugin in settings.iter_plugins():
+        if domain not in plan.domains:
+            plan.domains[domain] = {
+                "hosts": len(settings.domains[domain].hosts),
+                "plugins": 0,
+                "fields": 0,
+                "rrd_files": 0,
+                "entries": 0,
+                "series": {schema: 0 for schema in Plan.SCHEMAS},
+                "measurements": {schema: set() for schema in Plan.SCHEMAS},
+                "points": {schema: 0 for schema in Plan.SCHEMAS},
+                "bytes": {schema: 0 for schema in Plan.SCHEMAS},
+            }
+        current = plan.domains[domain]
+        _plugin = settings.domains[domain].hosts[host].plugins[plugin]
+        tags = {"domain": domain, "host": host, "plugin": plugin}
+
+        current['plugins'] += 1
+        entries = {}
+        for field in _plugin.fields:
+            _field = _plugin.fields[field]
+            current['fields'] += 1
+            if not _field.rrd_found:
+                continue
+
+            try:
+                entries[field] = count_rrd_entries(_field.rrd_filename, since=settings.filters['since'],
+                                                   until=settings.filters['until'])
+            except Exception as e:
+                plan.errors.append("Could not read header of {0}: {1}".format(_field.rrd_filename, e))
+            else:
+                current['rrd_files'] += 1
+                current['entries'] += entries[field]
+            progress_bar.update()
+
+        if not entries:
+            continue
+
+        # grouped: one series per plugin, one point per timestamp holding every field
+        # (fields of a plugin usually share the same archives layout)
+        current['series']['grouped'] += 1
+        current['measurements']['grouped'].add(plugin)
+        current['points']['grouped'] += max(entries.values())
+        current['bytes']['grouped'] += max(entries.values()) * _line_length(plugin, tags, list(entries))
+
+        # non grouped: one series per field, measurement named after the field
+        for field, nb_entries in entries.items():
+            current['series']['non-grouped'] += 1
+            current['measurements']['non-grouped'].add(field)
+            current['points']['non-grouped'] += nb_entries
+            current['bytes']['non-grouped'] += nb_entries * _line_length(field, tags, ['value'])
+
+    for current in plan.domains.values():
+        for schema, names in current['measurements'].items():
+            plan.measurements[schema].update(names)
+        current['measurements'] = {schema: len(names) for schema, names in current['measurements'].items()}
+
+    return plan
+
+
+def _human(value, units=("", "K", "M", "G", "T")):
+    for unit in units[:-1]:
+        if abs(value) < 1000:
+            return "{0:.1f}{1}".format(value, unit) if unit else str(int(value))
+        value /= 1000.
+    return "{0:.1f}{1}".format(value, units[-1])
+
+
+def print_plan(plan, dump_rate=DUMP_RATE, parse_rate=PARSE_RATE, write_rate=WRITE_RATE):
+    print("\n{0}Import plan{1} (nothing is written)".format(Color.BOLD, Color.CLEAR))
+    header = "  {0:<30}{1:>7}{2:>8}{3:>8}  {4:>21}  {5:>21}  {6:>21}  {7:>21}"
+    row = "  {0:<30}{1:>7}{2:>8}{3:>8}  {4:>10} {5:>10}  {6:>10} {7:>10}  {8:>10} {9:>10}  {10:>10} {11:>10}"
+    print(header.format("", "", "", "", "series", "measurements", "points", "bytes"))
+    print(row.format("domain", "hosts", "plugins", "fields", *(["grouped", "non-grp."]*4)))
+
+    def _print(name, values):
+        print(row.format(name[:30], values['hosts'], values['plugins'], values['fields'],
+                         *[_human(values[key][schema]) for key in ("series", "measurements", "points", "bytes")
+                           for schema in Plan.SCHEMAS]))
+
+    for domain, values in plan.domains.items():
+        _print(domain, values)
+
+    totals = plan.totals()
+    _print("total", {
+        key: {schema: totals[(key, schema)] for schema in Plan.SCHEMAS} if key in ("series", "measurements", "points", "bytes")
+        else totals[key] for key in ("hosts", "plugins", "fields", "series", "measurements", "points", "bytes")
+    })
+
+    print("\n  Projected import time (dump: {0} files/s, parse: {1} points/s, write: {2} points/s):".format(dump_rate, parse_rate, write_rate))
+    for schema in Plan.SCHEMAS:
+        seconds = int(plan.projected_time(schema, dump_rate, parse_rate, write_rate))
+        print("    - {0:<12} {1}h{2:02d}m{3:02d}s".format(schema, seconds // 3600, seconds % 3600 // 60, seconds % 60))
+
+    for error in plan.errors:
+        print("  {0} {1}".format(Symbol.WARN_YELLOW, error))
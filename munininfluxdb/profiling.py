@@ -0,0 +1,136 @@
+from __future__ import print_function
+import os
+import sys
+import errno
+import cProfile
+import pstats
+import threading
+from contextlib import contextmanager
+
+from utils import Color, Symbol
+
+try:
+    import resource
+except ImportError:
+    # not on Windows
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python < 3.4
+    tracemalloc = None
+
+# allocation sites reported in the memory summary (read_xml_file, import_from_xml, storable.deserialize...)
+MEMORY_FILTERS = ["*munininfluxdb*", "*storable*"]
+
+
+def peak_rss():
+    """
+    @return: peak resident memory of the process so far, in bytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Profiler:
+    """
+    Per-stage cProfile recording, driven by Telemetry.stage(), and optionally of the peak memory (RSS) each stage
+    reached and added, plus a tracemalloc snapshot of the allocation sites on Python 3.4+
+
+    Each stage's statistics are written to <folder>/<command>-<stage>.prof, readable with pstats or snakeviz. cProfile
+    only sees the thread enabling it: each thread (--join-workers) records its own stages, merged when saved.
+    """
+    def __init__(self, folder, memory=False):
+        self.folder = folder
+        # {(stage, thread name): cProfile.Profile}
+        self.profiles = {}
+        self.lock = threading.Lock()
+        # per thread: within a stage
+        self.local = threading.local()
+        self.memory = memory and resource is not None
+        # {stage: [peak RSS at its end, RSS growth while in it]}, bytes
+        self.peaks = {}
+
+        if memory and resource is None:
+            print("  {0} Memory profiling needs the resource module (Unix), ignored".format(Symbol.WARN_YELLOW))
+        if self.memory and tracemalloc is not None:
+            tracemalloc.start(10)
+
+    @contextmanager
+    def profile(self, name):
+        # nested stages are accounted to the outermost one
+        if getattr(self.local, "active", False):
+            yield
+            return
+
+        with self.lock:
+            profile = self.profiles.setdefault((name, threading.current_thread().name), cProfile.Profile())
+        self.local.active = True
+        before = peak_rss() if self.memory else 0
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.local.active = False
+            if self.memory:
+                # process wide: stages of other threads share it
+                after = peak_rss()
+                with self.lock:
+                    peak = self.peaks.setdefault(name, [0, 0])
+                    peak[0] = max(peak[0], after)
+                    peak[1] += after - before
+
+    def stages(self):
+        """
+        @return: {stage: pstats.Stats of all threads}
+        """
+        stages = {}
+        for (name, _), profile in sorted(self.profiles.items()):
+            if name in stages:
+                stages[name].add(profile)
+            else:
+                stages[name] = pstats.Stats(profile)
+        return stages
+
+    def save(self, command):
+        try:
+            os.makedirs(self.folder)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        for name, stats in self.stages().items():
+            stats.dump_stats(os.path.join(self.folder, "{0}-{1}.prof".format(command, name)))
+
+        if self.memory and tracemalloc is not None:
+            tracemalloc.take_snapshot().dump(os.path.join(self.folder, "{0}-memory.snapshot".format(command)))
+
+    def print_summary(self, limit=10):
+        if not self.profiles:
+            return
+
+        stats = pstats.Stats(*self.profiles.values())
+        hot = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:limit]
+
+        print("\n{0}Hot functions{1} (by own time, details in {2})".format(Color.BOLD, Color.CLEAR, self.folder))
+        for (filename, line, function), (_, nb_calls, own_time, cumulative_time, _) in hot:
+            print("  - {0:>8.3f}s {1:>8.3f}s cum. {2:>9} calls  {3}:{4}({5})".format(own_time, cumulative_time, nb_calls,
+                                                                                  os.path.basename(filename), line, function))
+
+        if self.memory:
+            print("\n{0}Peak memory{1} (RSS at the end of the stage, added by it)".format(Color.BOLD, Color.CLEAR))
+            for name, (peak, growth) in sorted(self.peaks.items(), key=lambda item: item[1][1], reverse=True):
+                print("  - {0:<12} {1:>9.1f} MB {2:>+9.1f} MB".format(name, peak/1024./1024., growth/1024./1024.))
+
+        if self.memory and tracemalloc is not None:
+            snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(True, pattern)
+                                                                  for pattern in MEMORY_FILTERS])
+            current, peak = tracemalloc.get_traced_memory()
+            print("\n{0}Top allocators{1} (peak traced memory: {2:.1f} MB)".format(Color.BOLD, Color.CLEAR, peak/1024./1024.))
+            for stat in snapshot.statistics('lineno')[:limit]:
+                frame = stat.traceback[0]
+                print("  - {0:>9.1f} KB {1:>9} blocks  {2}:{3}".format(stat.size/1024., stat.count,
+                                                                       os.path.basename(frame.filename), frame.lineno))
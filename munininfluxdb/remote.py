@@ -0,0 +1,144 @@
+"""
+Remote Munin master over SSH
+
+Migrates a Munin master without copying its RRD tree first: a single (compressed) SSH connection per master, the
+datafile and directory listings read over SFTP, and "rrdtool dump" run on the master with its XML output streamed back,
+several dumps at once on channels multiplexed over that connection.
+"""
+import os
+import errno
+import pipes
+import posixpath
+import threading
+
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
+
+SSH_PORT = 22
+
+
+class RemoteError(Exception):
+    pass
+
+
+def parse_ssh_handle(handle):
+    """
+    @param handle: [user@]host[:port]
+    @return: {"user": ..., "host": ..., "port": ...}
+
+    @example
+        munin@master.example.org:2222 -> {"user": "munin", "host": "master.example.org", "port": 2222}
+    """
+    user, _, host = handle.rpartition("@")
+    host, _, port = host.partition(":")
+    return {
+        "user": user or None,
+        "host": host,
+        "port": int(port) if port else SSH_PORT,
+    }
+
+
+class RemoteMaster:
+    """
+    @param handle: [user@]host[:port]
+    @param key_filename: private key, otherwise the SSH agent and default keys (~/.ssh/id_*) are tried
+    @param accept_unknown_host: add hosts missing from ~/.ssh/known_hosts instead of refusing them
+
+    @example
+        remote = RemoteMaster("munin@master1.example.org")
+        remote.get("/var/lib/munin/datafile", "/tmp/munin-influxdb/master1.example.org/datafile")
+        remote.dump("/var/lib/munin/example.org/web1-cpu-user-d.rrd", "/tmp/munin-influxdb/xml/web1-cpu-user-d.xml")
+    """
+    def __init__(self, handle, key_filename=None, password=None, compress=True, accept_unknown_host=False,
+                 timeout=10):
+        if paramiko is None:
+            raise ImportError("Paramiko is needed to import from a remote Munin master: pip install paramiko")
+
+        self.handle = parse_ssh_handle(handle)
+        self.name = self.handle['host']
+
+        self.client = paramiko.SSHClient()
+        self.client.load_system_host_keys()
+        if accept_unknown_host:
+            self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            self.client.connect(self.handle['host'], self.handle['port'], self.handle['user'], password,
+                                key_filename=os.path.expanduser(key_filename) if key_filename else None,
+                                timeout=timeout, compress=compress)
+        except (paramiko.SSHException, IOError) as e:
+            raise RemoteError("Could not connect to {0}: {1}".format(handle, e))
+
+        self.transport = self.client.get_transport()
+        self.transport.set_keepalive(30)
+
+        # SFTP requests share a single channel
+        self._sftp = None
+        self._lock = threading.Lock()
+        # {folder: set of file names}
+        self._listings = {}
+
+    def _call_sftp(self, method, *args):
+        with self._lock:
+            if self._sftp is None:
+                self._sftp = self.client.open_sftp()
+            return getattr(self._sftp, method)(*args)
+
+    def get(self, remote_path, local_path):
+        """
+        Copies a remote file to local_path
+        """
+        try:
+            os.makedirs(os.path.dirname(local_path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self._call_sftp("get", remote_path, local_path)
+
+    def stat(self, path):
+        """
+        @return: os.stat() like result (st_mtime, st_size...) of a remote file
+        """
+        return self._call_sftp("stat", path)
+
+    def exists(self, path):
+        """
+        Whether a remote file exists, folders being listed once rather than a request per file
+        """
+        folder, name = posixpath.split(path)
+        if folder not in self._listings:
+            try:
+                self._listings[folder] = set(self._call_sftp("listdir", folder))
+            except IOError:
+                self._listings[folder] = set()
+        return name in self._listings[folder]
+
+    def dump(self, rrd_filename, xml_filename):
+        """
+        Runs "rrdtool dump" on the master and writes its output to the local xml_filename
+
+        @return: 0, like subprocess.check_call()
+        """
+        channel = self.transport.open_session()
+        try:
+            channel.exec_command("rrdtool dump {0}".format(pipes.quote(rrd_filename)))
+            with open(xml_filename, "wb") as f:
+                while True:
+                    data = channel.recv(65536)
+                    if not data:
+                        break
+                    f.write(data)
+            code = channel.recv_exit_status()
+            if code != 0:
+                error = channel.makefile_stderr('rb').read().strip()
+                raise RemoteError("rrdtool dump {0} failed on {1} ({2}): {3}".format(rrd_filename, self.name, code,
+                                                                                     error))
+        finally:
+            channel.close()
+        return 0
+
+    def close(self):
+        if self._sftp:
+            self._sftp.close()
+        self.client.close()
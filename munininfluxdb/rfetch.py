@@ -1,65 +1,372 @@
 from __future__ import print_function
-from pprint import pprint
+import os
+import time
+import socket
+from itertools import groupby
+from multiprocessing.pool import ThreadPool
 
-try:
-    import paramiko
-except ImportError:
-    print("SSH library Paramiko missing, needed for remote plugins")
+from utils import compute_rate
 
-class MuninRunner:
-    def __init__(self):
-        pass
+MUNIN_NODE_PORT = 4949
 
-class HostRunner:
-    def __init__(self):
-        pass
 
+def parse_munin_conf(filename):
+    """
+    Reads host entries of a munin.conf file (and of its "includedir" folders)
 
-def main():
+    @return: {section: {'host': host_name, 'domain': domain_name, 'address': ..., 'port': ..., ...}}
+             sections without "address" (groups, top level settings) are left out
+    """
     content = {}
 
-    with open("../data/munin-conf/munin.conf") as f:
-        current_group = {}
-        current_group_name = "_top_level_"
-
-        for line in f.readlines():
-            line = line.strip()
-            # comment
-            if line.startswith('#') or not line:
-                pass
-
-            # group
-            elif line.startswith('['):
-                # save old group
-                content[current_group_name] = current_group
-
-                # init new one
-                line = line.strip('[]')
-                splitted = line.split(';')
-                if len(splitted) == 1:
-                    domain_name = ".".join(line.split('.')[-2:])
-                    host_name = line
-                else:
-                    domain_name, host_name = splitted
-
-                current_group = {
-                    'host': host_name,
-                    'domain': domain_name
-                }
-                current_group_name = line
-
-            # entry
-            else:
-                elements = line.split()
-                if len(elements) > 2:
-                    current_group[elements[0]] = elements[1:]
+    def _parse(filename):
+        with open(filename) as f:
+            current_group = {}
+            current_group_name = "_top_level_"
+
+            for line in f.readlines():
+                line = line.strip()
+                # comment
+                if line.startswith('#') or not line:
+                    pass
+
+                # group
+                elif line.startswith('['):
+                    # save old group
+                    content[current_group_name] = current_group
+
+                    # init new one
+                    line = line.strip('[]')
+                    splitted = line.split(';')
+                    if len(splitted) == 1:
+                        domain_name = ".".join(line.split('.')[-2:])
+                        host_name = line
+                    else:
+                        domain_name, host_name = splitted
+
+                    current_group = {
+                        'host': host_name,
+                        'domain': domain_name
+                    }
+                    current_group_name = line
+
+                # entry
                 else:
-                    current_group[elements[0]] = elements[1]
+                    elements = line.split()
+                    if elements[0] == 'includedir' and current_group_name == "_top_level_":
+                        folder = elements[1]
+                        for name in sorted(os.listdir(folder)):
+                            if not name.startswith('.') and os.path.isfile(os.path.join(folder, name)):
+                                content[current_group_name] = current_group
+                                _parse(os.path.join(folder, name))
+                    elif len(elements) > 2:
+                        current_group[elements[0]] = elements[1:]
+                    elif len(elements) == 2:
+                        current_group[elements[0]] = elements[1]
+
+            # save last one
+            content[current_group_name] = current_group
+
+    _parse(filename)
+
+    return {name: entry for name, entry in content.items()
+            if name != "_top_level_" and entry.get('host') and 'address' in entry}
+
+
+class MuninNodeError(Exception):
+    pass
+
+
+def parse_spoolfetch(lines):
+    """
+    Reads the output of "spoolfetch" (nodes running munin-async): plugin after plugin, a "multigraph <graph>" line
+    followed by its config and by all the values spooled since the requested time, as "<field>.value <time>:<value>"
+
+    @return: (types, samples) as {graph: {field: {'type': ..., 'min': ..., 'max': ...}}}
+             and [(time, graph, field, value), ...] sorted by time
+    """
+    types, samples = {}, []
+    graph = None
+
+    for line in lines:
+        if line.startswith("multigraph "):
+            graph = line.split(None, 1)[1]
+            continue
+        if graph is None:
+            continue
+
+        key, _, value = line.partition(" ")
+        field, _, attribute = key.rpartition(".")
+        if not field:
+            continue
+        if attribute == "value":
+            timestamp, _, value = value.strip().rpartition(":")
+            try:
+                timestamp = int(timestamp)
+                if value != "U":
+                    float(value)
+            except ValueError:
+                # malformed sample, the others are still read
+                continue
+            samples.append((timestamp, graph, field, value))
+        elif attribute in ("type", "min", "max"):
+            types.setdefault(graph, {}).setdefault(field, {"type": "GAUGE", "min": None, "max": None})[attribute] = value.strip()
+
+    samples.sort()
+    return types, samples
+
+
+class MuninNodeClient:
+    """
+    Client for the munin-node text protocol (TCP 4949)
+    """
+    def __init__(self, address, port=MUNIN_NODE_PORT, timeout=10):
+        self.socket = socket.create_connection((address, int(port)), timeout)
+        self.file = self.socket.makefile('rb')
+        # "# munin node at <name>"
+        self.node_name = self._readline().split()[-1]
+
+    def _readline(self):
+        line = self.file.readline()
+        if not line:
+            raise MuninNodeError("connection closed by node")
+        return line.rstrip("\n")
+
+    def _command(self, command):
+        self.socket.sendall(command + "\n")
+
+    def _read_block(self):
+        lines = []
+        error = None
+        while True:
+            line = self._readline()
+            if line == ".":
+                break
+            if line.startswith("# "):
+                # "# Unknown service", "# Bad exit"... still followed by the "." terminator: read up to it so that
+                # the next command does not get the end of this answer
+                error = error or line[2:]
+                continue
+            lines.append(line)
+
+        if error:
+            raise MuninNodeError(error)
+        return lines
+
+    def cap(self, capabilities=("multigraph",)):
+        self._command("cap " + " ".join(capabilities))
+        return self._readline().split()[1:]
+
+    def list(self, node_name=None):
+        self._command("list {0}".format(node_name or "").strip())
+        return self._readline().split()
+
+    def fetch(self, plugin):
+        """
+        @return: {graph: {field: (timestamp or None, value)}}, more than one graph for multigraph plugins
+        """
+        self._command("fetch " + plugin)
+        graphs = {}
+        graph = graphs.setdefault(plugin, {})
+
+        for line in self._read_block():
+            if line.startswith("multigraph "):
+                graph = graphs.setdefault(line.split(None, 1)[1], {})
+                continue
+
+            key, _, value = line.partition(" ")
+            if not key.endswith(".value"):
+                continue
+            # value can be "<timestamp>:<value>" with dirtyconfig or munin-async
+            timestamp, _, value = value.strip().rpartition(":")
+            try:
+                timestamp = int(timestamp) if timestamp else None
+                if value != "U":
+                    float(value)
+            except ValueError:
+                # malformed value, the other fields are still read
+                continue
+            graph[key[:-len(".value")]] = (timestamp, value)
+
+        return {name: fields for name, fields in graphs.items() if fields}
+
+    def config(self, plugin):
+        """
+        @return: {graph: {field: {'type': ..., 'min': ..., 'max': ...}}}
+        """
+        self._command("config " + plugin)
+        graphs = {}
+        graph = graphs.setdefault(plugin, {})
+
+        for line in self._read_block():
+            if line.startswith("multigraph "):
+                graph = graphs.setdefault(line.split(None, 1)[1], {})
+                continue
+
+            key, _, value = line.partition(" ")
+            field, _, attribute = key.rpartition(".")
+            if field and attribute in ("type", "min", "max"):
+                graph.setdefault(field, {"type": "GAUGE", "min": None, "max": None})[attribute] = value.strip()
+
+        return graphs
+
+    def spoolfetch(self, since):
+        """
+        @param since: timestamp of the last sample already read (watermark)
+        @return: (types, samples) as returned by parse_spoolfetch()
+        """
+        self._command("spoolfetch {0}".format(int(since)))
+        return parse_spoolfetch(self._read_block())
+
+    def quit(self):
+        try:
+            self._command("quit")
+        finally:
+            self.file.close()
+            self.socket.close()
+
+
+class HostRunner:
+    """
+    Polls every plugin of a single munin-node
+
+    @param state: this host's state, kept between runs: {"types": {graph: {field: {...}}}, "samples": {graph: {field: [time, value]}},
+                  "spoolfetch": time of the last spooled sample read}
+    @param spool: read every sample spooled by munin-async since the last run ("spoolfetch") rather than the
+                  current values, on nodes supporting it
+    @param backlog: with spool, how far back the first run of a node starts (seconds)
+    """
+    def __init__(self, name, entry, state, timeout=10, group_fields=True, spool=False, backlog=86400):
+        self.name = name
+        self.entry = entry
+        self.state = state
+        self.timeout = timeout
+        self.group_fields = group_fields
+        self.spool = spool
+        self.backlog = backlog
+
+        self.state.setdefault("types", {})
+        self.state.setdefault("samples", {})
+
+    def run(self):
+        """
+        @return: list of points in the InfluxDB client's JSON format
+        """
+        client = MuninNodeClient(self.entry['address'], self.entry.get('port', MUNIN_NODE_PORT), self.timeout)
+        try:
+            capabilities = client.cap(("multigraph", "spool") if self.spool else ("multigraph",))
+            if self.spool and "spool" in capabilities:
+                return self.run_spool(client)
+
+            use_node_name = self.entry.get('use_node_name', 'no') in ('yes', 'true', 'on', '1')
+            plugins = client.list(client.node_name if use_node_name else self.entry['host'])
+
+            points = []
+            for plugin in plugins:
+                try:
+                    graphs = client.fetch(plugin)
+                    now = int(time.time())
+
+                    # field types are read once, then only when new fields appear
+                    if any(field not in self.state["types"].get(graph, {})
+                           for graph, fields in graphs.items() for field in fields):
+                        self.state["types"].update(client.config(plugin))
+                except MuninNodeError:
+                    # plugin failing on the node, others may work
+                    continue
+
+                for graph, fields in graphs.items():
+                    points.extend(self.pack(graph, fields, now))
+        finally:
+            client.quit()
+
+        return points
+
+    def run_spool(self, client):
+        """
+        Reads the samples spooled since the node's watermark, which is moved to the latest one
+
+        @return: list of points in the InfluxDB client's JSON format, sorted by time
+        """
+        since = self.state.get("spoolfetch") or int(time.time()) - self.backlog
+        types, samples = client.spoolfetch(since)
+        for graph, fields in types.items():
+            self.state["types"].setdefault(graph, {}).update(fields)
+
+        points = []
+        # samples are sorted by time: rates are computed sample after sample, and fields of a graph sharing a time
+        # make a single point
+        for (timestamp, graph), group in groupby((sample for sample in samples if sample[0] > since),
+                                                 key=lambda sample: sample[:2]):
+            points.extend(self.pack(graph, {field: (timestamp, value) for _, _, field, value in group}, timestamp))
+            self.state["spoolfetch"] = timestamp
+
+        return points
+
+    def pack(self, graph, fields, now):
+        types = self.state["types"].get(graph, {})
+        samples = self.state["samples"].setdefault(graph, {})
+        tags = {"domain": self.entry['domain'], "host": self.entry['host'], "plugin": graph}
+        timestamp = now
+
+        values = {}
+        for field, (date, value) in fields.items():
+            latest = (date or now, value)
+            previous = samples.get(field)
+            samples[field] = list(latest)
+            timestamp = latest[0]
+
+            datatype = types.get(field, {}).get('type', "GAUGE")
+            if datatype != "GAUGE" and previous is None:
+                # rates need two samples
+                continue
+            try:
+                values[field] = compute_rate(datatype, latest, previous or latest,
+                                             types.get(field, {}).get('min'), types.get(field, {}).get('max'))
+            except ValueError:
+                # malformed min/max in the plugin config, only this field is left out
+                continue
+
+        if not values:
+            return []
+        elif self.group_fields:
+            return [{"measurement": graph, "tags": tags, "time": timestamp, "fields": values}]
+        else:
+            return [{"measurement": field, "tags": tags, "time": timestamp, "fields": {"value": value}}
+                    for field, value in values.items()]
+
+
+class MuninRunner:
+    """
+    Polls many munin-nodes concurrently, with at most 'concurrency' open connections
+    """
+    def __init__(self, hosts, state, concurrency=50, timeout=10, group_fields=True, spool=False, backlog=86400):
+        self.hosts = hosts
+        self.state = state
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.group_fields = group_fields
+        self.spool = spool
+        self.backlog = backlog
 
-    # save last one
-    content[current_group_name] = current_group
+    def _poll(self, name):
+        runner = HostRunner(name, self.hosts[name], self.state.setdefault(name, {}), self.timeout, self.group_fields,
+                            self.spool, self.backlog)
+        start = time.time()
+        try:
+            return name, runner.run(), None, time.time() - start
+        except (socket.error, MuninNodeError) as e:
+            return name, [], e, time.time() - start
 
-    pprint(content)
+    def run(self):
+        """
+        @return: list of (host, points, error, duration)
+        """
+        if not self.hosts:
+            return []
 
-if __name__ == "__main__":
-    main()
+        pool = ThreadPool(min(self.concurrency, len(self.hosts)))
+        try:
+            return pool.map(self._poll, sorted(self.hosts))
+        finally:
+            pool.close()
@@ -3,22 +3,50 @@ import os
 import errno
 import subprocess
 import math
+import struct
 from collections import defaultdict
+from itertools import imap
+from multiprocessing.pool import ThreadPool
 import xml.etree.ElementTree as ET
-from settings import Settings, Defaults
+from settings import Settings, Defaults, DATA_TYPES
 from utils import ProgressBar, Symbol
 
 
-# RRD types
-DATA_TYPES = {
-    'a': 'ABSOLUTE',
-    'c': 'COUNTER',
-    'd': 'DERIVE',
-    'g': 'GAUGE',
-}
+def stitch_archives(archives):
+    """
+    Computes how many rows of each archive are actually needed to rebuild a single time series
+
+    @param archives: list of (entry_delta, first_entry, nb_rows), finest resolution first
+    @return: list of nb_entries, the number of (oldest) rows of each archive not already covered by a finer one
+    """
+    result = []
+    covered_from = None
+    for entry_delta, first_entry, nb_rows in archives:
+        if covered_from is None:
+            nb_entries = nb_rows
+        else:
+            nb_entries = max(0, min(nb_rows, -(-(covered_from - first_entry) // entry_delta)))
+
+        if nb_entries and (covered_from is None or first_entry < covered_from):
+            covered_from = first_entry
+        result.append(nb_entries)
+
+    return result
 
 
-def read_xml_file(filename, keep_average_only=True, keep_null_values=True):
+def rows_in_window(first_entry, entry_delta, nb_entries, since=None, until=None):
+    """
+    @return: (start, stop) slice of the nb_entries rows starting at first_entry falling within [since, until]
+    """
+    start, stop = 0, nb_entries
+    if since is not None:
+        start = max(start, -(-(since - first_entry) // entry_delta))
+    if until is not None:
+        stop = min(stop, (until - first_entry) // entry_delta + 1)
+    return start, max(start, stop)
+
+
+def read_xml_file(filename, keep_average_only=True, keep_null_values=True, since=None, until=None):
     values = defaultdict(dict)
 
     tree = ET.parse(filename)
@@ -30,6 +58,8 @@ def read_xml_file(filename, keep_average_only=True, keep_null_values=True):
     if len(root.findall('ds')) > 1:
         print("  {0} Found more than one datasource in {1} which is not expected. Please report problem.".format(Symbol.NOK_RED, filename))
 
+    # compute time coverage of every archive before decoding anything
+    segments = []
     for rra in root.findall('rra'):
         if keep_average_only and rra.find('cf').text.strip() != "AVERAGE":
             # @todo store max and min in the same record but different column
@@ -38,34 +68,206 @@ def read_xml_file(filename, keep_average_only=True, keep_null_values=True):
         pdp_per_row = int(rra.find('pdp_per_row').text)
         entry_delta = pdp_per_row*step
         last_entry = last_update - last_update % entry_delta
-        nb_entries = len(rra.find("database"))
-        entry_date = first_entry = last_entry - (nb_entries-1)*entry_delta
+        rows = list(rra.find("database"))
+        first_entry = last_entry - (len(rows)-1)*entry_delta
+
+        segments.append((entry_delta, first_entry, rows))
 
-        # print("  + New segment from {0} to {1}. Nb entries: {2}. Granularity: {3} sec.".format(datetime.fromtimestamp(first_entry),
-        #                                                                                        datetime.fromtimestamp(last_entry),
-        #                                                                                        nb_entries,
-        #                                                                                        entry_delta))
+    # finest resolution first: values are 'fresher' and less likely to be averaged (CF'd)
+    segments.sort(key=lambda segment: segment[0])
 
-        # there should be only onv <v> entry per row, at least didn't see other cases with Munin
-        for v in rra.findall("./database/row/v"):
+    # only decode the rows older than what finer archives already cover
+    nb_decoded = stitch_archives([(entry_delta, first_entry, len(rows)) for entry_delta, first_entry, rows in segments])
+
+    for (entry_delta, first_entry, rows), nb_entries in zip(segments, nb_decoded):
+        # print("  + New segment from {0} ({1} entries of {2} sec.), {3} decoded".format(datetime.fromtimestamp(first_entry),
+        #                                                                                len(rows),
+        #                                                                                entry_delta,
+        #                                                                                nb_entries))
+
+        # rows outside of the selected time window are not even decoded
+        start, stop = rows_in_window(first_entry, entry_delta, nb_entries, since, until)
+
+        entry_date = first_entry + start*entry_delta
+        # there should be only one <v> entry per row, at least didn't see other cases with Munin
+        for row in rows[start:stop]:
             try:
-                value = float(v.text)
+                value = float(row.find('v').text)
                 if math.isnan(value) and keep_null_values:
                     value = None
-                # we don't want to override existing values as they are 'fresher' and less likely to be averaged (CF'd)
-                if not entry_date in values:
-                    values[entry_date] = value
-
+                values[entry_date] = value
             except:
-                value = None
+                pass
 
             entry_date += entry_delta
 
     return values
 
 
+# used by rrdtool to check the architecture of a RRD file
+RRD_FLOAT_COOKIE = 8.642135E130
+
+# (byte order, size of 'unsigned long', offset of the float cookie) of the native RRD format
+RRD_LAYOUTS = [('<', 8, 16), ('>', 8, 16), ('<', 4, 12), ('>', 4, 12)]
+
+
+def _read_native_rrd_header(filename):
+    with open(filename, 'rb') as f:
+        header = f.read(4096)
+
+    if not header.startswith("RRD\0"):
+        raise ValueError("{0} is not a RRD file".format(filename))
+
+    for order, word, cookie_offset in RRD_LAYOUTS:
+        (cookie,) = struct.unpack_from(order + 'd', header, cookie_offset)
+        if abs(cookie - RRD_FLOAT_COOKIE) < 1E125:
+            break
+    else:
+        raise ValueError("Unknown RRD architecture for {0}".format(filename))
+
+    ulong = order + ('Q' if word == 8 else 'I')
+    offset = cookie_offset + 8
+    ds_cnt, rra_cnt, step = struct.unpack_from(order + 3*ulong[1], header, offset)
+    offset += 3*word + 10*8         # stat_head: counters + par[10]
+    offset += ds_cnt*(20 + 20 + 10*8)  # ds_def: ds_nam[20], dst[20], par[10]
+
+    rra_name_size = -(-20 // word)*word
+    archives = []
+    for _ in range(rra_cnt):
+        cf = header[offset:offset+20].split("\0", 1)[0]
+        nb_rows, pdp_per_row = struct.unpack_from(order + 2*ulong[1], header, offset + rra_name_size)
+        archives.append((cf, pdp_per_row, nb_rows))
+        offset += rra_name_size + 2*word + 10*8
+
+    (last_update,) = struct.unpack_from(ulong, header, offset)
+    return step, last_update, archives
+
+
+def _read_rrdtool_info(filename):
+    step = last_update = None
+    archives = defaultdict(dict)
+    for line in subprocess.check_output(['rrdtool', 'info', filename]).splitlines():
+        key, _, value = line.partition(" = ")
+        if key == "step":
+            step = int(value)
+        elif key == "last_update":
+            last_update = int(value)
+        elif key.startswith("rra[") and key.endswith(("].cf", "].rows", "].pdp_per_row")):
+            index, _, name = key[4:].partition("].")
+            archives[int(index)][name] = value.strip('"')
+
+    return step, last_update, [(rra['cf'], int(rra['pdp_per_row']), int(rra['rows']))
+                               for _, rra in sorted(archives.items())]
+
+
+def read_rrd_header(filename):
+    """
+    Reads step, last update and archives layout of a RRD database without dumping it,
+    from the native (architecture dependent) header or with "rrdtool info" if not recognized
+
+    @return: (step, last_update, [(cf, pdp_per_row, nb_rows), ...])
+    """
+    try:
+        return _read_native_rrd_header(filename)
+    except (ValueError, struct.error):
+        return _read_rrdtool_info(filename)
+
+
+def _rrd_segments(filename, keep_average_only=True):
+    step, last_update, archives = read_rrd_header(filename)
+
+    segments = []
+    for cf, pdp_per_row, nb_rows in archives:
+        if keep_average_only and cf != "AVERAGE":
+            continue
+        entry_delta = pdp_per_row*step
+        last_entry = last_update - last_update % entry_delta
+        segments.append((entry_delta, last_entry - (nb_rows-1)*entry_delta, nb_rows))
+    segments.sort(key=lambda segment: segment[0])
+
+    return segments
+
+
+def count_rrd_entries(filename, keep_average_only=True, since=None, until=None):
+    """
+    Number of entries read_xml_file() would return for the RRD, from its header only
+    """
+    segments = _rrd_segments(filename, keep_average_only)
+    total = 0
+    for (entry_delta, first_entry, _), nb_entries in zip(segments, stitch_archives(segments)):
+        start, stop = rows_in_window(first_entry, entry_delta, nb_entries, since, until)
+        total += stop - start
+    return total
+
+
+def count_rrd_entries_per_bucket(filename, bucket, keep_average_only=True, since=None, until=None):
+    """
+    Number of entries read_xml_file() would return for the RRD per time bucket, from its header only
+
+    @return: {bucket start: number of entries}
+    """
+    segments = _rrd_segments(filename, keep_average_only)
+    counts = defaultdict(int)
+    for (entry_delta, first_entry, _), nb_entries in zip(segments, stitch_archives(segments)):
+        start, stop = rows_in_window(first_entry, entry_delta, nb_entries, since, until)
+        for row in range(start, stop):
+            time = first_entry + row*entry_delta
+            counts[time - time % bucket] += 1
+    return counts
+
+
+def filter_time_window(settings):
+    """
+    Skips the RRD files holding no entry within the "since"/"until" filters, from their header only (before any dump)
+
+    @return: number of skipped files
+    """
+    since, until = settings.filters['since'], settings.filters['until']
+    # headers of remote files are not read ahead, the window is applied after the dump
+    if (since is None and until is None) or settings.remote:
+        return 0
+
+    skipped = 0
+    for domain, host, plugin, field in settings.iter_fields():
+        _field = settings.domains[domain].hosts[host].plugins[plugin].fields[field]
+        if not _field.rrd_found:
+            continue
+
+        try:
+            segments = _rrd_segments(_field.rrd_filename)
+        except Exception:
+            # unreadable header, let "rrdtool dump" report it
+            continue
+        if not segments:
+            continue
+
+        oldest = min(first_entry for _, first_entry, _ in segments)
+        newest = max(first_entry + (nb_rows-1)*entry_delta for entry_delta, first_entry, nb_rows in segments)
+        if (since is not None and newest < since) or (until is not None and oldest > until):
+            _field.rrd_found = False
+            settings.nb_rrd_files -= 1
+            skipped += 1
+
+    return skipped
+
+
+def dump_field(settings, _field):
+    """
+    Dumps the RRD file of a field to its XML file, from the remote master if any
+
+    @return: exit code of "rrdtool dump"
+    """
+    settings.throttle.acquire(files=1)
+    if settings.remote:
+        # one SSH channel per dump, all multiplexed over the same connection
+        return settings.remote.dump(_field.rrd_filename, _field.xml_filename)
+    return subprocess.check_call(['rrdtool', 'dump', _field.rrd_filename, _field.xml_filename])
+
+
 def export_to_xml(settings):
     progress_bar = ProgressBar(settings.nb_rrd_files)
+    # RRD files already parsed by a previous run are not dumped again
+    cache = settings.series_cache()
 
     try:
         os.makedirs(settings.paths['xml'])
@@ -73,18 +275,55 @@ def export_to_xml(settings):
         if e.errno != errno.EEXIST:
             raise
 
+    fields = []
     for domain, host, plugin, field in settings.iter_fields():
         _field = settings.domains[domain].hosts[host].plugins[plugin].fields[field]
 
         if _field.rrd_found:
-            progress_bar.update()
-
-            code = subprocess.check_call(['rrdtool', 'dump', _field.rrd_filename, _field.xml_filename])
-            if code == 0:
+            if cache and cache.has(_field.rrd_filename):
+                progress_bar.update()
                 _field.rrd_exported = True
+                settings.telemetry.count("cached_files")
+            else:
+                fields.append(_field)
+
+    def _dump(_field):
+        return _field, dump_field(settings, _field)
+
+    # at most 'rrdtool_workers' concurrent rrdtool processes (or SSH channels)
+    pool = ThreadPool(settings.rrdtool_workers) if settings.rrdtool_workers > 1 else None
+    try:
+        with settings.telemetry.stage("dump"):
+            for _field, code in (pool.imap_unordered(_dump, fields) if pool else imap(_dump, fields)):
+                progress_bar.update()
+                if code == 0:
+                    _field.rrd_exported = True
+                    settings.telemetry.count("rrd_files")
+    finally:
+        if pool:
+            pool.close()
 
     return progress_bar.current
 
+def read_rrd_file(rrd_filename, folder=Defaults.MUNIN_XML_FOLDER, since=None, until=None):
+    """
+    Dumps a single RRD file to a temporary XML file in folder and parses it
+
+    @return: {time: value} as returned by read_xml_file()
+    """
+    try:
+        os.makedirs(folder)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    xml_filename = os.path.join(folder, os.path.basename(rrd_filename).replace(".rrd", ".xml"))
+    subprocess.check_call(['rrdtool', 'dump', rrd_filename, xml_filename])
+    try:
+        return read_xml_file(xml_filename, since=since, until=until)
+    finally:
+        os.remove(xml_filename)
+
 def export_to_xml_in_folder(source, destination=Defaults.MUNIN_XML_FOLDER):
     """
     Calls "rrdtool dump" to convert RRD database files in "source" folder to XML representation
@@ -196,7 +435,8 @@ def check_rrd_files(settings, folder=Defaults.MUNIN_RRD_FOLDER):
     for domain, host, plugin, field in settings.iter_fields():
         _field = settings.domains[domain].hosts[host].plugins[plugin].fields[field]
         # print("{0}[{1}]: {2}".format(plugin, field, _field.rrd_filename))
-        exists = os.path.exists(_field.rrd_filename)
+        exists = settings.remote.exists(_field.rrd_filename) if settings.remote \
+            else os.path.exists(_field.rrd_filename)
 
         if not exists:
             _field.rrd_found = False
@@ -0,0 +1,168 @@
+"""
+Memory-aware scheduling of the import jobs
+
+Plugin sizes vary by orders of magnitude: taken in discovery order, a huge plugin read last makes a long tail, and a
+few huge ones read together run out of memory. Each plugin (each field when fields are not grouped) is a job whose cost,
+the number of values to join, is estimated from the RRD headers. Jobs run largest first on 'workers' threads, a job
+only starting while the memory estimates of the jobs in flight (being read, or read and waiting to be written) fit in
+the budget: smaller jobs fill what the larger ones leave.
+"""
+from __future__ import print_function
+import os
+import time
+import traceback
+from Queue import Queue
+from multiprocessing.pool import ThreadPool
+
+from rrd import count_rrd_entries
+from spill import JOIN_VALUE_BYTES
+from utils import Color
+
+# size of a row of "rrdtool dump" output, to estimate entries when RRD headers cannot be read (remote master)
+XML_ROW_BYTES = 90
+
+
+class Job:
+    def __init__(self, domain, host, plugin, fields, values):
+        self.domain = domain
+        self.host = host
+        self.plugin = plugin
+        self.fields = fields
+        # estimated number of values to join
+        self.values = values
+        self.memory = values * JOIN_VALUE_BYTES
+
+        # seconds spent reading and joining (worker), and until the result was released (written)
+        self.join_time = None
+        self.wall_time = None
+
+    @property
+    def name(self):
+        if len(self.fields) == 1:
+            return "{0}/{1}/{2}.{3}".format(self.domain, self.host, self.plugin, self.fields[0])
+        return "{0}/{1}/{2}".format(self.domain, self.host, self.plugin)
+
+
+def estimate_values(settings, _field):
+    """
+    @return: number of values rrd.read_xml_file() returns for a field, from its RRD header or the size of its XML dump
+    """
+    if not settings.remote:
+        try:
+            return count_rrd_entries(_field.rrd_filename, since=settings.filters['since'],
+                                     until=settings.filters['until'])
+        except Exception:
+            pass
+    try:
+        return os.path.getsize(_field.xml_filename) // XML_ROW_BYTES
+    except (OSError, TypeError):
+        return 0
+
+
+def make_jobs(settings, grouped=True):
+    """
+    @param grouped: a job per plugin (all its fields), otherwise a job per exported field
+    @return: list of Job
+    """
+    jobs = []
+    for domain, host, plugin in settings.iter_plugins():
+        _plugin = settings.domains[domain].hosts[host].plugins[plugin]
+        values = {field: estimate_values(settings, _plugin.fields[field])
+                  for field in _plugin.fields if _plugin.fields[field].rrd_exported}
+        if grouped:
+            jobs.append(Job(domain, host, plugin, list(_plugin.fields), sum(values.values())))
+        else:
+            jobs.extend(Job(domain, host, plugin, [field], nb_values) for field, nb_values in values.items())
+    return jobs
+
+
+class Scheduler:
+    """
+    @param workers: number of jobs run at once
+    @param budget: bytes the jobs in flight may take together, unlimited if None; a larger job runs alone
+
+    @example
+        scheduler = Scheduler(workers=4, budget=2*1024**3)
+        for job, result in scheduler.run(make_jobs(settings), read_job):
+            write(result)
+        scheduler.print_stragglers()
+    """
+    def __init__(self, workers=1, budget=None):
+        self.workers = max(1, workers)
+        self.budget = budget
+        self.completed = []
+
+    def _fits(self, job, in_flight, memory):
+        return not in_flight or self.budget is None or memory + job.memory <= self.budget
+
+    def run(self, jobs, func):
+        """
+        Calls func(job) in worker threads, largest jobs first
+
+        @return: generator of (job, result) as jobs complete. A job holds its share of the budget until the next one
+                 is asked for, that is until the caller is done with its result
+        """
+        pending = sorted(jobs, key=lambda job: job.values, reverse=True)
+        if self.workers == 1:
+            # a single job at a time whatever the budget: run inline, without threads
+            for job in pending:
+                started = time.time()
+                result = func(job)
+                job.join_time = time.time() - started
+                yield job, result
+
+                job.wall_time = time.time() - started
+                self.completed.append(job)
+            return
+
+        done = Queue()
+        pool = ThreadPool(self.workers)
+        in_flight, memory = 0, 0
+
+        def _run(job, started):
+            try:
+                result, error = func(job), None
+            except Exception as e:
+                # the traceback does not follow the exception to the main thread: kept along for the report
+                e.worker_traceback = traceback.format_exc()
+                result, error = None, e
+            job.join_time = time.time() - started
+            done.put((job, started, result, error))
+
+        try:
+            while pending or in_flight:
+                # first fit: the largest pending jobs fitting in what is left of the budget
+                while pending and in_flight < self.workers:
+                    job = next((job for job in pending if self._fits(job, in_flight, memory)), None)
+                    if job is None:
+                        break
+                    pending.remove(job)
+                    in_flight += 1
+                    memory += job.memory
+                    pool.apply_async(_run, (job, time.time()))
+
+                # with a timeout: interruptible by Ctrl+C in Python 2
+                job, started, result, error = done.get(True, 86400)
+                if error:
+                    raise error
+                yield job, result
+
+                job.wall_time = time.time() - started
+                self.completed.append(job)
+                in_flight -= 1
+                memory -= job.memory
+        finally:
+            pool.terminate()
+
+    def print_stragglers(self, limit=5):
+        """
+        Prints the jobs which took the longest, from start to written
+        """
+        if not self.completed:
+            return
+        jobs = sorted(self.completed, key=lambda job: job.wall_time, reverse=True)
+        print("\n{0}Slowest jobs{1} ({2} jobs, largest first on {3} worker(s))".format(Color.BOLD, Color.CLEAR,
+                                                                                     len(jobs), self.workers))
+        for job in jobs[:limit]:
+            print("  - {0:>9.3f}s ({1:.3f}s reading) {2}: {3} fields, ~{4} values".format(
+                job.wall_time, job.join_time, job.name, len(job.fields), job.values))
@@ -2,9 +2,14 @@ from collections import defaultdict
 import os
 import pprint
 import json
-from os.path import expanduser
 
-from utils import parse_handle
+from utils import parse_handle, match_patterns
+from defaults import Defaults, DATA_TYPES
+from telemetry import Telemetry
+from deadband import HEARTBEAT
+from throttle import Throttle
+from shard import Checkpoint, shard_of
+from cache import SeriesCache
 
 get_field = lambda s, d, h, p, f: s.domains[d].hosts[h].plugins[p].fields[f]
 
@@ -27,6 +32,8 @@ class Field:
         # InfluxDB
         self.influxdb_measurement = None
         self.influxdb_field = None
+        # written as an integer field rather than a float
+        self.influxdb_integer = False
 
 
 class Plugin:
@@ -58,18 +65,6 @@ class Domain:
     def __repr__(self):
         return pprint.pformat(dict(self.hosts))
 
-class Defaults:
-    MUNIN_RRD_FOLDER = "/var/lib/munin"
-    MUNIN_VAR_FOLDER = "/var/lib/munin"
-    MUNIN_WWW_FOLDER = "/var/cache/munin/www"
-    MUNIN_DATAFILE = "/var/lib/munin/datafile"
-
-    TEMP_FOLDER = "/tmp/munin-influxdb"
-    FETCH_CONFIG = expanduser("~")+"/.config/munin-fetch-config.json"
-    MUNIN_XML_FOLDER = TEMP_FOLDER+"/xml"
-
-    DEFAULT_RRD_INDEX = 42
-
 class Settings:
     def __init__(self, cli_args=None):
         self.domains = defaultdict(Domain)
@@ -81,6 +76,12 @@ class Settings:
             self.influxdb = parse_handle(cli_args.influxdb)
             self.influxdb.update({
                 "group_fields": cli_args.group_fields,
+                "telemetry": cli_args.telemetry,
+                # other servers series are spread over, see fanout.FanoutWriter
+                "targets": [parse_handle(handle) for handle in cli_args.influxdb_target or []],
+                "replicas": cli_args.replicas,
+                # write integer-valued GAUGE fields as InfluxDB integers
+                "integers": cli_args.integer_fields,
             })
             self.paths = {
                 "munin": cli_args.munin_path,
@@ -88,6 +89,7 @@ class Settings:
                 "fetch_config": cli_args.fetch_config_path,
                 "www": cli_args.www,
                 "xml": cli_args.xml_temp_path,
+                "cache": cli_args.cache_path if cli_args.cache else None,
             }
             self.grafana = {
                 "create": cli_args.grafana,
@@ -96,19 +98,55 @@ class Settings:
                 "graph_per_row": cli_args.grafana_cols,
                 "tags": cli_args.grafana_tags,
                 "show_minmax": cli_args.show_minmax,
+                "layout": cli_args.grafana_layout,
+                "manifest": cli_args.grafana_manifest,
+                "force_upload": cli_args.grafana_force_upload,
+                "upload_workers": cli_args.grafana_upload_workers,
             }
+            self.filters = {
+                "domain": cli_args.domain,
+                "host": cli_args.host,
+                "plugin": cli_args.plugin,
+                "field": cli_args.field,
+                "since": cli_args.since,
+                "until": cli_args.until,
+                "trim_to_retention": cli_args.trim_to_retention,
+                # (i, N): only import the plugins of shard i out of N
+                "shard": cli_args.shard,
+            }
+            self.deadband = {
+                "rules": cli_args.deadband or [],
+                "heartbeat": cli_args.deadband_heartbeat,
+            }
+            # domain rollups to compute: subset of aggregate.FUNCTIONS
+            self.aggregate = cli_args.aggregate or []
+            self.throttle = Throttle(cli_args.max_points_per_sec, cli_args.max_bytes_per_sec,
+                                     cli_args.max_rrd_reads_per_sec,
+                                     cli_args.max_load if cli_args.adaptive else None,
+                                     cli_args.max_munin_update if cli_args.adaptive else None,
+                                     cli_args.munin_update_stats)
+            self.rrdtool_workers = cli_args.rrdtool_workers
+            # bytes the plugins read at once may take together, a larger plugin is joined out-of-core (spill.SpilledJoin)
+            self.memory_budget = cli_args.memory_budget
+            # plugins read and joined at once, see scheduler.Scheduler
+            self.join_workers = cli_args.join_workers
+            # journals of the fields imported by each shard, see shard.Checkpoint
+            self.checkpoint = Checkpoint(cli_args.checkpoint, cli_args.shard or (1, cli_args.merge_shards or 1)) \
+                if cli_args.checkpoint else None
         else:
             self.interactive = True
             self.verbose = 1
 
             self.influxdb = parse_handle("root@localhost:8086/db/munin")
-            self.influxdb.update({"group_fields": True})
+            self.influxdb.update({"group_fields": True, "telemetry": False, "targets": [], "replicas": 1,
+                                  "integers": False})
             self.paths = {
                 "munin": Defaults.MUNIN_VAR_FOLDER,
                 "datafile": os.path.join(Defaults.MUNIN_VAR_FOLDER, 'datafile'),
                 "fetch_config": Defaults.FETCH_CONFIG,
                 "www": Defaults.MUNIN_WWW_FOLDER,
                 "xml": Defaults.MUNIN_XML_FOLDER,
+                "cache": None,
             }
             self.grafana = {
                 "create": True,
@@ -117,13 +155,45 @@ class Settings:
                 "graph_per_row": 2,
                 "tags": "grafana munin",
                 "show_minmax": True,
+                "layout": "all",
+                "manifest": Defaults.GRAFANA_MANIFEST,
+                "force_upload": False,
+                "upload_workers": 4,
+            }
+            self.filters = {
+                "domain": None,
+                "host": None,
+                "plugin": None,
+                "field": None,
+                "since": None,
+                "until": None,
+                "trim_to_retention": False,
+                "shard": None,
             }
+            self.deadband = {
+                "rules": [],
+                "heartbeat": HEARTBEAT,
+            }
+            self.aggregate = []
+            self.throttle = Throttle()
+            self.rrdtool_workers = 1
+            self.memory_budget = None
+            self.join_workers = 1
+            self.checkpoint = None
 
 
         self.nb_plugins = 0
         self.nb_fields = 0
         self.nb_rrd_files = 0
 
+        self.telemetry = Telemetry("import")
+        # remote.RemoteMaster when importing from a Munin master over SSH
+        self.remote = None
+        # {series key: [target name, ...]} of the series written with fan-out
+        self.fanout_mapping = {}
+        # see series_cache()
+        self._series_cache = None
+
     def save_fetch_config(self):
         config = {
             "influxdb": self.influxdb,
@@ -142,12 +212,97 @@ class Settings:
                        for d, h, p, field in self.iter_fields()
                        if get_field(self, d, h, p, field).xml_imported
             },
+            # {rrd_filename: {"domain": ..., "host": ..., "plugin": ...}, ...} tags of the series each metric is written to
+            "series": {get_field(self, d, h, p, field).rrd_filename: self.series_tags(d, h, p)
+                       for d, h, p, field in self.iter_fields()
+                       if get_field(self, d, h, p, field).xml_imported
+            },
+            # {rrd_filename: {"type": "DERIVE", "min": "0", "max": None}, ...} to compute rates like RRD does
+            "datatypes": {get_field(self, d, h, p, field).rrd_filename: {
+                                "type": get_field(self, d, h, p, field).settings.get('type', "GAUGE"),
+                                "min": get_field(self, d, h, p, field).settings.get('min'),
+                                "max": get_field(self, d, h, p, field).settings.get('max'),
+                            }
+                       for d, h, p, field in self.iter_fields()
+                       if get_field(self, d, h, p, field).xml_imported
+            },
+            # [rrd_filename, ...] of the fields written as integers, 'fetch' must keep their type
+            "integers": [get_field(self, d, h, p, field).rrd_filename
+                         for d, h, p, field in self.iter_fields()
+                         if get_field(self, d, h, p, field).xml_imported and get_field(self, d, h, p, field).influxdb_integer
+            ],
+            # change-only mode, applied by 'fetch' as well: {"rules": [...], "heartbeat": seconds}
+            "deadband": self.deadband,
+            # domain rollups written by 'fetch' as well
+            "aggregate": self.aggregate,
+            # fan-out: targets each series was imported to, 'fetch' writes fresh values there as well
+            "mapping": self.fanout_mapping,
             "lastupdate": None
         }
 
         with open(self.paths['fetch_config'], 'w') as f:
             json.dump(config, f, indent=2, separators=(',', ': '))
 
+    def series_cache(self):
+        """
+        @return: cache.SeriesCache of the parsed RRD files, the same one for the whole run, None if disabled
+        """
+        if not self.paths.get('cache'):
+            return None
+        if self._series_cache is None or self._series_cache.folder != self.paths['cache']:
+            if self.remote:
+                self._series_cache = SeriesCache(self.paths['cache'], self.remote.stat, self.remote.name + ":")
+            else:
+                self._series_cache = SeriesCache(self.paths['cache'])
+        return self._series_cache
+
+    def series_tags(self, domain, host, plugin):
+        """
+        Tags of the series a plugin is imported to
+        """
+        tags = {"domain": domain, "host": host, "plugin": plugin}
+        if self.domains[domain].hosts[host].plugins[plugin].is_multigraph and self.influxdb['group_fields']:
+            tags["is_multigraph"] = True
+        return tags
+
+    def apply_filters(self, done=()):
+        """
+        Removes the domains, hosts, plugins and fields not matching the "filters" patterns or belonging to another
+        shard from the discovered structure, so they are neither dumped, parsed nor written
+
+        @param done: set of (domain, host, plugin, field) already imported, removed as well
+        @return: number of fields removed
+        """
+        shard = self.filters.get('shard')
+        removed = 0
+        for domain in list(self.domains):
+            for host in list(self.domains[domain].hosts):
+                for plugin in list(self.domains[domain].hosts[host].plugins):
+                    _plugin = self.domains[domain].hosts[host].plugins[plugin]
+                    keep_plugin = match_patterns(domain, self.filters['domain']) \
+                        and match_patterns(host, self.filters['host']) \
+                        and match_patterns(plugin, self.filters['plugin']) \
+                        and (not shard or shard_of(domain, host, plugin, shard[1]) == shard[0])
+
+                    for field in list(_plugin.fields):
+                        if not keep_plugin or not match_patterns(field, self.filters['field']) \
+                                or (domain, host, plugin, field) in done:
+                            if _plugin.fields[field].rrd_found:
+                                self.nb_rrd_files -= 1
+                            del _plugin.fields[field]
+                            self.nb_fields -= 1
+                            removed += 1
+
+                    if not _plugin.fields:
+                        del self.domains[domain].hosts[host].plugins[plugin]
+                        self.nb_plugins = max(0, self.nb_plugins - 1)
+                if not self.domains[domain].hosts[host].plugins:
+                    del self.domains[domain].hosts[host]
+            if not self.domains[domain].hosts:
+                del self.domains[domain]
+
+        return removed
+
     def iter_plugins(self):
         """
 
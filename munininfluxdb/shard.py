@@ -0,0 +1,126 @@
+"""
+Distributed import
+
+The field list is split across machines sharing the Munin RRD tree (NFS mount...): each one runs
+'import --shard i/N --checkpoint DIR' with the same other arguments and the same DIR. Plugins are assigned to shards
+from a stable hash of domain/host/plugin, so the fields of a grouped series are always imported together.
+
+Every shard appends the fields it has written to its own journal in DIR: a restarted shard skips them, and a final
+'import --checkpoint DIR --merge-shards' builds the 'fetch' configuration (and Grafana dashboards) from all journals.
+"""
+import os
+import json
+import zlib
+import errno
+
+
+def parse_shard(spec):
+    """
+    @param spec: "i/N", i from 1 to N
+    @return: (i, N)
+    """
+    try:
+        index, count = [int(part) for part in spec.split("/")]
+    except ValueError:
+        raise ValueError("Invalid shard: {0} (expected i/N, like 1/4)".format(spec))
+    if not 1 <= index <= count:
+        raise ValueError("Invalid shard: {0} (i must be between 1 and N)".format(spec))
+    return index, count
+
+
+def shard_of(domain, host, plugin, count):
+    """
+    @return: shard of a plugin, from 1 to count, stable across runs, machines and Python versions (unlike hash())
+    """
+    key = u"{0}/{1}/{2}".format(domain, host, plugin)
+    return (zlib.crc32(key.encode('utf-8')) & 0xffffffff) % count + 1
+
+
+class Checkpoint:
+    """
+    Journals of the fields imported by each shard, in a folder shared by all of them
+
+    @example
+        checkpoint = Checkpoint("/mnt/munin/checkpoint", (2, 4))
+        checkpoint.record([{"domain": ..., "host": ..., "plugin": ..., "field": ...,
+                            "measurement": ..., "influxdb_field": ..., "influxdb_integer": ...}])
+        checkpoint.finish()
+    """
+    def __init__(self, folder, shard=(1, 1)):
+        self.folder = folder
+        self.index, self.count = shard
+
+        try:
+            os.makedirs(folder)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _filename(self, index, extension):
+        return os.path.join(self.folder, "shard-{0}-of-{1}.{2}".format(index, self.count, extension))
+
+    def load(self, index=None):
+        """
+        @return: entries recorded by a shard (this one by default)
+        """
+        entries = []
+        try:
+            with open(self._filename(index or self.index, "jsonl")) as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # last line of an interrupted run
+                        continue
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        return entries
+
+    def done(self):
+        """
+        @return: set of (domain, host, plugin, field) already imported by this shard
+        """
+        return {(entry['domain'], entry['host'], entry['plugin'], entry['field']) for entry in self.load()}
+
+    def record(self, entries):
+        with open(self._filename(self.index, "jsonl"), "a") as f:
+            f.write("".join(json.dumps(entry) + "\n" for entry in entries))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def finish(self):
+        open(self._filename(self.index, "done"), "w").close()
+
+    def completed(self):
+        """
+        @return: list of shards which completed their import
+        """
+        return [index for index in range(1, self.count + 1) if os.path.exists(self._filename(index, "done"))]
+
+    def load_all(self):
+        return [entry for index in range(1, self.count + 1) for entry in self.load(index)]
+
+
+def restore_imported(settings, entries):
+    """
+    Marks the fields recorded in checkpoint journals as imported, as if this process had imported them
+
+    @return: number of entries not matching any discovered field
+    """
+    missing = 0
+    for entry in entries:
+        # get() rather than [], which would insert missing keys in the defaultdicts of the tree
+        _domain = settings.domains.get(entry['domain'])
+        _host = _domain and _domain.hosts.get(entry['host'])
+        _plugin = _host and _host.plugins.get(entry['plugin'])
+        _field = _plugin and _plugin.fields.get(entry['field'])
+        if not _field:
+            missing += 1
+            continue
+        _field.xml_imported = True
+        _field.influxdb_measurement = entry['measurement']
+        _field.influxdb_field = entry['influxdb_field']
+        # journals of older runs do not record it
+        _field.influxdb_integer = entry.get('influxdb_integer', False)
+    return missing
@@ -0,0 +1,133 @@
+"""
+Out-of-core join of the fields of a series
+
+Joining all fields of a plugin into rows takes in the order of JOIN_VALUE_BYTES per value: multigraph plugins with
+hundreds of fields (diskstats, if_*...) over years of history do not fit in memory. Above the memory budget, fields are
+read one at a time and their values spilled to one file per time window, then windows are loaded and joined one after
+the other: at most one window worth of rows is held at once, and each one is written as soon as it is joined.
+"""
+import os
+import math
+import bisect
+import shutil
+import tempfile
+from array import array
+
+# approximate memory taken by a value in the joined rows (float object, list slot, share of its row and dict entry)
+JOIN_VALUE_BYTES = 64
+# spill files opened at once
+MAX_WINDOWS = 256
+
+
+def count_windows(nb_values, budget):
+    """
+    @return: number of windows for nb_values joined values to fit in budget bytes, 1 if they fit whole
+    """
+    if not budget:
+        return 1
+    return min(int(math.ceil(nb_values * JOIN_VALUE_BYTES / float(budget))), MAX_WINDOWS) or 1
+
+
+class SpilledJoin:
+    """
+    @param nb_fields: number of value columns of the rows
+    @param nb_windows: number of time windows, cut at quantiles of the timestamps of the first field added so that
+                       each one holds about the same number of rows whatever the resolution of the RRD archives it spans
+    @param folder: where spill files are written, a temporary folder is created inside
+
+    @example
+        join = SpilledJoin(len(fields), count_windows(estimated_values, budget))
+        for index, field in enumerate(fields):
+            join.add(index, read_field(field))
+        for rows in join.windows():
+            write(rows)
+    """
+    def __init__(self, nb_fields, nb_windows, folder=None):
+        self.nb_fields = nb_fields
+        self.nb_windows = nb_windows
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.folder = tempfile.mkdtemp(prefix="join-", dir=folder)
+
+        self.boundaries = None
+        self.files = []
+        self.integers = set()
+        # number of known (not None) values per window
+        self.known = []
+        # bytes written to spill files, for telemetry
+        self.spilled = 0
+
+    def add(self, index, content, integer=False):
+        """
+        Spills the values of a field
+
+        @param index: column of the field, from 0
+        @param content: {time: value} as returned by rrd.read_xml_file()
+        @param integer: values are integers, restored as such when read back
+        """
+        if integer:
+            self.integers.add(index)
+
+        if self.boundaries is None:
+            times = sorted(content)
+            step = len(times) / float(self.nb_windows)
+            self.boundaries = sorted({times[int(step * i)] for i in range(1, self.nb_windows)}) if times else []
+            self.files = [open(os.path.join(self.folder, "{0}.bin".format(window)), "wb")
+                          for window in range(len(self.boundaries) + 1)]
+            self.known = [0] * len(self.files)
+
+        # records of (column, time, value) doubles, NaN for unknown values
+        buffers = [array('d') for _ in self.files]
+        for time, value in content.items():
+            window = bisect.bisect_right(self.boundaries, time)
+            if value is None:
+                buffers[window].extend((index, time, float('nan')))
+            else:
+                buffers[window].extend((index, time, value))
+                self.known[window] += 1
+
+        for buf, f in zip(buffers, self.files):
+            buf.tofile(f)
+            self.spilled += len(buf) * buf.itemsize
+
+    def last_window(self):
+        """
+        @return: index of the last window holding known values (the last one if none does), the following ones only
+                 hold unknown values
+        """
+        for window in reversed(range(len(self.known))):
+            if self.known[window]:
+                return window
+        return len(self.known) - 1
+
+    def windows(self):
+        """
+        Joins the spilled values, window after window, each spill file being removed once read
+
+        @return: generator of [[time, value of column 0, ...], ...] sorted by time
+        """
+        for f in self.files:
+            f.close()
+
+        for f in self.files:
+            records = array('d')
+            with open(f.name, "rb") as spill:
+                records.fromfile(spill, os.path.getsize(f.name) // records.itemsize)
+            os.remove(f.name)
+
+            rows = {}
+            for position in range(0, len(records), 3):
+                index, time, value = int(records[position]), int(records[position + 1]), records[position + 2]
+                row = rows.get(time)
+                if row is None:
+                    row = rows[time] = [time] + [None] * self.nb_fields
+                if not math.isnan(value):
+                    row[index + 1] = int(value) if index in self.integers else value
+            del records
+
+            yield [rows[time] for time in sorted(rows)]
+
+    def close(self):
+        for f in self.files:
+            f.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
@@ -0,0 +1,105 @@
+from __future__ import print_function
+import time
+import socket
+import threading
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+
+from utils import Color
+
+# dedicated measurement so munin-influxdb's own figures never mix with Munin data
+INTERNAL_MEASUREMENT = "munininfluxdb_internal"
+
+
+class Telemetry:
+    """
+    Collects per-stage timings and counters of an 'import' or 'fetch' run
+
+    Stages may run in several threads at once (--join-workers): a stage's duration is the wall time during which at
+    least one thread was in it, not the sum of the threads' times.
+
+    @example
+        telemetry = Telemetry("fetch")
+        with telemetry.stage("parse"):
+            ...
+        telemetry.count("points", len(data))
+    """
+    def __init__(self, command):
+        self.command = command
+        self.started = time.time()
+        self.timings = OrderedDict()   # {stage: [duration, calls]}
+        self.counters = defaultdict(int)
+        # {stage: [threads within, time the first one entered]}
+        self.running = {}
+        self.lock = threading.Lock()
+        # optional profiling.Profiler, records each stage separately
+        self.profiler = None
+
+    @contextmanager
+    def stage(self, name):
+        with self.lock:
+            running = self.running.setdefault(name, [0, None])
+            if not running[0]:
+                running[1] = time.time()
+            running[0] += 1
+        try:
+            if self.profiler:
+                with self.profiler.profile(name):
+                    yield
+            else:
+                yield
+        finally:
+            with self.lock:
+                timing = self.timings.setdefault(name, [0., 0])
+                running[0] -= 1
+                if not running[0]:
+                    timing[0] += time.time() - running[1]
+                timing[1] += 1
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def summary(self):
+        return {
+            "command": self.command,
+            "duration": time.time() - self.started,
+            "stages": OrderedDict((name, {"duration": duration, "calls": calls})
+                                  for name, (duration, calls) in self.timings.items()),
+            "counters": dict(self.counters),
+        }
+
+    def print_summary(self):
+        summary = self.summary()
+        print("\n{0}Run summary{1} ({2:.1f}s)".format(Color.BOLD, Color.CLEAR, summary['duration']))
+        for name, timing in summary['stages'].items():
+            print("  - {0:<12} {1:>9.3f}s ({2} calls)".format(name, timing['duration'], timing['calls']))
+        if summary['counters']:
+            print("  " + ", ".join("{0}: {1}".format(name, value) for name, value in sorted(summary['counters'].items())))
+
+    def to_points(self, time_=None):
+        """
+        @return: list of points in the InfluxDB client's JSON format:
+                 one per stage (duration, calls) plus a "total" one holding the counters
+        """
+        summary = self.summary()
+        time_ = int(time_ or time.time())
+        tags = {"command": self.command, "hostname": socket.gethostname()}
+
+        points = [{
+            "measurement": INTERNAL_MEASUREMENT,
+            "tags": dict(tags, stage=name),
+            "time": time_,
+            "fields": {"duration": timing['duration'], "calls": timing['calls']},
+        } for name, timing in summary['stages'].items()]
+
+        fields = {name: value for name, value in summary['counters'].items()}
+        fields["duration"] = summary['duration']
+        points.append({
+            "measurement": INTERNAL_MEASUREMENT,
+            "tags": dict(tags, stage="total"),
+            "time": time_,
+            "fields": fields,
+        })
+
+        return points
@@ -0,0 +1,146 @@
+"""
+Resource limits for imports running on a live Munin master
+
+A full speed import starves munin-update (which must complete within its 5 minutes window) and saturates the disk:
+writes and RRD reads can be capped, the process (and its rrdtool children) lowered in CPU/IO priority, and an
+adaptive mode slows everything down while the system load or munin-update's own duration are too high.
+"""
+from __future__ import print_function
+import os
+import time
+import subprocess
+import threading
+
+from utils import Symbol
+
+MUNIN_UPDATE_STATS = "/var/lib/munin/munin-update.stats"
+# munin-update must complete within Munin's 5 minutes period
+MUNIN_UPDATE_LIMIT = 240
+
+IONICE_CLASSES = {"idle": "3", "best-effort": "2"}
+
+
+class RateLimiter:
+    """
+    Token bucket allowing 'rate' units per second on average, with bursts of at most one second worth of units
+    """
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount=1, factor=1.):
+        """
+        Waits until amount units can be consumed, the rate being divided by factor
+        """
+        with self.lock:
+            rate = self.rate / factor
+            now = time.time()
+            self.tokens = min(rate, self.tokens + (now - self.updated) * rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / rate if self.tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+def read_munin_update_duration(filename=MUNIN_UPDATE_STATS):
+    """
+    @return: duration in seconds of the last munin-update run ("UT|..." line), None if unknown
+    """
+    try:
+        with open(filename) as f:
+            for line in f:
+                parts = line.strip().split("|")
+                if parts[0] == "UT" and len(parts) >= 2:
+                    return float(parts[-1])
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+class Throttle:
+    """
+    @param points_per_sec, bytes_per_sec: caps on what is written to InfluxDB
+    @param files_per_sec: cap on RRD files read (dumped) per second
+    @param max_load: adaptive mode, slow down while the 1 minute load average is above it
+    @param max_munin_update: adaptive mode, slow down while munin-update takes longer than this (seconds)
+
+    @example
+        throttle = Throttle(points_per_sec=20000, max_load=4)
+        throttle.acquire(points=len(body), bytes=len(data))
+    """
+    # adaptive mode: figures are checked at most every CHECK_INTERVAL seconds, rates divided by up to MAX_FACTOR
+    CHECK_INTERVAL = 5
+    MAX_FACTOR = 32
+
+    def __init__(self, points_per_sec=None, bytes_per_sec=None, files_per_sec=None,
+                 max_load=None, max_munin_update=None, munin_update_stats=MUNIN_UPDATE_STATS):
+        self.limiters = {name: RateLimiter(rate) for name, rate in (("points", points_per_sec),
+                                                                    ("bytes", bytes_per_sec),
+                                                                    ("files", files_per_sec)) if rate}
+        self.max_load = max_load
+        self.max_munin_update = max_munin_update
+        self.munin_update_stats = munin_update_stats
+
+        self.factor = 1.
+        self.checked = 0
+        self.lock = threading.Lock()
+        # number of adaptive slowdowns, for telemetry
+        self.backoffs = 0
+
+    @property
+    def adaptive(self):
+        return bool(self.max_load or self.max_munin_update)
+
+    def overloaded(self):
+        if self.max_load and os.getloadavg()[0] > self.max_load:
+            return True
+        if self.max_munin_update:
+            duration = read_munin_update_duration(self.munin_update_stats)
+            if duration is not None and duration > self.max_munin_update:
+                return True
+        return False
+
+    def _adapt(self):
+        now = time.time()
+        with self.lock:
+            if now - self.checked < Throttle.CHECK_INTERVAL:
+                return self.factor
+            self.checked = now
+
+            if self.overloaded():
+                self.factor = min(self.factor * 2, Throttle.MAX_FACTOR)
+                self.backoffs += 1
+            else:
+                self.factor = max(self.factor / 2, 1.)
+            factor = self.factor
+
+        if factor > 1:
+            # without explicit caps, slowing down means pausing
+            time.sleep(min(factor - 1, Throttle.CHECK_INTERVAL))
+        return factor
+
+    def acquire(self, points=0, bytes=0, files=0):
+        factor = self._adapt() if self.adaptive else 1.
+        for name, amount in (("points", points), ("bytes", bytes), ("files", files)):
+            if amount and name in self.limiters:
+                self.limiters[name].acquire(amount, factor)
+
+
+def lower_priority(nice=0, ionice=None):
+    """
+    Lowers CPU and IO priorities of the current process, inherited by the rrdtool processes it spawns
+
+    @param ionice: key of IONICE_CLASSES
+    """
+    if nice:
+        os.nice(nice)
+    if ionice:
+        # no ioprio_set() binding in Python 2, util-linux command instead
+        try:
+            subprocess.check_call(['ionice', '-c', IONICE_CLASSES[ionice], '-p', str(os.getpid())])
+        except (OSError, subprocess.CalledProcessError) as e:
+            print("  {0} Could not change IO priority: {1}".format(Symbol.WARN_YELLOW, e))
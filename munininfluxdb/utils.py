@@ -1,6 +1,11 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
+import re
 import sys
+import time
+import calendar
+import fnmatch
+from datetime import datetime
 
 
 class Color:
@@ -95,3 +100,120 @@ def parse_handle(handle):
         "port": port,
         "database": dbname
     }
+
+
+def compute_rate(datatype, latest, previous, minimum=None, maximum=None):
+    """
+    Converts the two latest raw samples of a DERIVE, COUNTER or ABSOLUTE field into a per second rate,
+    like RRD does on update, so fresh values are consistent with the imported history. GAUGE values are kept as is.
+
+    @param latest, previous: (date, value) as stored in Munin state files, 'U' being Munin value for unknown
+    @return: rate or None if unknown (missing sample, counter reset, out of bounds...)
+    """
+    (latest_date, latest_value), (previous_date, previous_value) = latest, previous
+    if latest_value == 'U':
+        return None
+    if datatype == "GAUGE":
+        return float(latest_value)
+
+    interval = int(latest_date) - int(previous_date)
+    if interval <= 0:
+        return None
+
+    if datatype == "ABSOLUTE":
+        # counter is reset on every read
+        rate = float(latest_value) / interval
+    else:
+        if previous_value == 'U':
+            return None
+        delta = float(latest_value) - float(previous_value)
+        if datatype == "COUNTER" and delta < 0:
+            # overflow: assume a 32 bit counter wrapped, then a 64 bit one
+            delta += 2**32
+            if delta < 0:
+                delta += 2**64 - 2**32
+        rate = delta / interval
+
+    if (minimum not in (None, "", "U") and rate < float(minimum)) \
+            or (maximum not in (None, "", "U") and rate > float(maximum)):
+        # most likely a counter reset, RRD would store unknown as well
+        return None
+    return rate
+
+
+def match_patterns(name, patterns):
+    """
+    @param patterns: shell-style globs ("web*") or regular expressions between slashes ("/^db[0-9]+$/")
+    @return: True if name matches at least one pattern, or if there is no pattern at all
+    """
+    if not patterns:
+        return True
+
+    for pattern in patterns:
+        if len(pattern) > 1 and pattern.startswith("/") and pattern.endswith("/"):
+            if re.search(pattern[1:-1], name):
+                return True
+        elif fnmatch.fnmatchcase(name, pattern):
+            return True
+    return False
+
+
+# InfluxDB duration units, in seconds
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7*86400}
+
+
+def parse_duration(value):
+    """
+    Parses InfluxDB-like durations
+
+    @example
+        parse_duration("30d") -> 2592000
+        parse_duration("168h0m0s") -> 604800
+    """
+    parts = re.findall(r"(\d+)([smhdw])", value)
+    if not parts or "".join(number + unit for number, unit in parts) != value.strip():
+        raise ValueError("Invalid duration: {0}".format(value))
+    return sum(int(number)*DURATION_UNITS[unit] for number, unit in parts)
+
+
+# size units, powers of 1024
+SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024**2, 'g': 1024**3}
+
+
+def parse_size(value):
+    """
+    Parses sizes in bytes, with an optional K/M/G suffix
+
+    @example
+        parse_size("512M") -> 536870912
+    """
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([kmg]?)b?\s*$", value, re.IGNORECASE)
+    if not match:
+        raise ValueError("Invalid size: {0}".format(value))
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).lower()])
+
+
+def parse_time(value, now=None):
+    """
+    Parses a point in time as a Unix timestamp (UTC)
+
+    @example
+        parse_time("1446336000") -> 1446336000
+        parse_time("2015-11-01") -> 1446336000
+        parse_time("2015-11-01 12:30") -> 1446381000
+        parse_time("30d") -> 30 days ago
+    """
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+
+    for format in ("%Y-%m-%d", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S"):
+        try:
+            return calendar.timegm(datetime.strptime(value, format).timetuple())
+        except ValueError:
+            pass
+
+    try:
+        return int(now or time.time()) - parse_duration(value)
+    except ValueError:
+        raise ValueError("Invalid date: {0} (expected a timestamp, YYYY-MM-DD[ HH:MM] or a duration like 30d)".format(value))
@@ -13,6 +13,7 @@ setup(
     py_modules=['munininfluxdb'],
     scripts=['muninflux'],
     install_requires=['influxdb>=2.12.0', 'requests'],
+    extras_require={'ssh': ['paramiko']},
     packages=find_packages(),
     classifiers=[
         'Development Status :: 4 - Beta',